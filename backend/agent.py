@@ -3,8 +3,15 @@ from container import Container
 from broker import broker
 from storage import Storage
 from llm_engine import LLMEngine
+from sync_manifest import SyncManifest, fingerprint
+from archives import is_archive, read_archive_manifest
+from context_builder import build_uploads_context
+from history import assemble_history, compact_history
+from stream_coalescer import StreamCoalescer
+from speculative_install import CodeFenceParser, extract_imports, install_missing_packages
+from metrics import Timer, phase_latency, record_phase, llm_tokens, llm_tokens_per_second, model_label
+from rate_limiter import llm_session
 
-from glob import glob
 from aioshutil import sync_to_async
 
 import asyncio
@@ -13,9 +20,12 @@ import mimetypes
 import hashlib
 import os
 import re
+import shutil
+import time
 import aiofiles
 import aiofiles.os
 import aioshutil
+import config
 
 
 SYSTEM_PROMPT = """You are an expert Python programming assistant that helps scientist users to write high-quality code to solve their tasks.
@@ -48,15 +58,79 @@ Here are some helpful previews for the dataset file(s):
 """
 
 
-ARCHIVE_FILE_EXTENSIONS = ['.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz']
+HASH_BUFFER_SIZE = 1024 * 1024
+
+# sampling temperatures cycled through when generating several candidate programs
+CANDIDATE_TEMPERATURES = [0.2, 0.6, 0.9, 0.4, 0.75, 1.0]
+
+
+@sync_to_async
+def scan_output_files(output_dir):
+    """Lists (path, size, mtime_ns) for every regular file below output_dir."""
+    results = []
+    for dirpath, _, filenames in os.walk(output_dir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            results.append((path, stat.st_size, stat.st_mtime_ns))
+    return results
+
+
+@sync_to_async
+def clear_dir(path):
+    """Removes the contents of path while keeping the directory itself (it may be bind mounted)."""
+    for entry in os.scandir(path):
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+        except Exception as e:
+            print(e)
+
+
+@sync_to_async
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+@sync_to_async
+def hash_file(path):
+    # hashlib releases the GIL for large updates, so this scales across executor threads
+    hasher = hashlib.new('sha256')
+    buf = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            hasher.update(view[:n])
+    return hasher.hexdigest()[0:32]
 
 
 class ScienceAgent():
     def __init__(self, agent_session: AgentSession, context_cutoff=60_000):
         self.context_cutoff = context_cutoff
         self.agent_session = agent_session
-
-    def get_sys_msg(self, llm_engine: LLMEngine, uploads_folder_tree: str, dataset_preview: str, task_inst: str, domain_knowledge: str, use_self_debug: bool, use_knowledge=True):
+        # path -> (size, mtime_ns, hash) of previously hashed output files
+        self.output_hash_cache = {}
+        self.sync_manifest = None
+        self.sync_lock = asyncio.Lock()
+        self.code_file_lock = asyncio.Lock()
+        # background dependency installs started while a response is still streaming
+        self.pending_installs = {}
+        self.speculated_modules = {}
+        # one pip install at a time per container, they share its site-packages
+        self.install_locks = {}
+
+    async def get_sys_msg(self, llm_engine: LLMEngine, uploads_folder_tree: str, dataset_preview: str, task_inst: str, domain_knowledge: str, use_self_debug: bool, use_knowledge=True):
         sys_msg = (
             SYSTEM_PROMPT + "\n\n" +
             (SELF_DEBUG_PROMPT + "\n\n" if use_self_debug else "") +
@@ -78,12 +152,8 @@ class ScienceAgent():
                 )
             )
 
-        trimmed_sys_msg = llm_engine.trim_messages(
-            [{'role': 'user', 'content': sys_msg}],
-            max_tokens=self.context_cutoff - 2000
-        )[0]["content"]
-
-        if len(trimmed_sys_msg) < len(sys_msg):
+        trimmed_sys_msg, truncated = await llm_engine.atruncate_text(sys_msg, self.context_cutoff - 2000)
+        if truncated:
             sys_msg = trimmed_sys_msg + "..."
 
         return sys_msg
@@ -97,69 +167,139 @@ class ScienceAgent():
 
 
     async def sync_uploads_dir(self, container: Container):
+        # candidate workspaces share the uploads directory, so syncs must not overlap
+        async with self.sync_lock:
+            with Timer(phase_latency, phase='sync_uploads'):
+                return await self._sync_uploads_dir(container)
+
+    async def _sync_uploads_dir(self, container: Container):
+        start_time = time.perf_counter()
         uploaded_files = await self.agent_session.get_uploaded_files()
         uploads_dir = container.get_uploads_dir()
 
-        for file in uploaded_files:
-            fname = f"{uploads_dir}/{file['name']}"
-            if not await aiofiles.os.path.exists(fname):
-                await aiofiles.os.makedirs(os.path.dirname(fname), exist_ok=True)
-                await Storage.download_file(file['object_name'], fname)
+        manifest = self.sync_manifest
+        if manifest is None or manifest.path != container.get_sync_manifest_path():
+            manifest = SyncManifest(container.get_sync_manifest_path())
+            await manifest.load()
+            self.sync_manifest = manifest
+
+        # the manifest is only trusted if the uploads directory it describes still exists,
+        # another connection may have destroyed the container and its directories
+        if not await aiofiles.os.path.isdir(uploads_dir):
+            manifest.reset()
+            await aiofiles.os.makedirs(uploads_dir, exist_ok=True)
+
+        digest = fingerprint(uploaded_files)
+        if manifest.digest == digest:
+            return {'downloaded': 0, 'removed': 0, 'extracted': 0, 'elapsed': time.perf_counter() - start_time}
+
+        current_files = {file['object_name']: file for file in uploaded_files}
+        stats = {'downloaded': 0, 'removed': 0, 'extracted': 0}
+
+        # remove local copies of files that are no longer part of the session
+        for object_name in [o for o in manifest.files if o not in current_files]:
+            entry = manifest.files.pop(object_name)
+            await remove_path(os.path.join(uploads_dir, entry['name']))
+            extract_dir = os.path.join(uploads_dir, entry['name'] + ".extracted")
+            if manifest.extracted.pop(entry['name'], None) is not None:
+                await remove_path(extract_dir)
+            stats['removed'] += 1
+
+        # collect new or changed files, archives extracted at upload time are synced through their members
+        downloads = [] # (object name, local path)
+        legacy_archives = []
+        for object_name, file in current_files.items():
+            file_hash = fingerprint(file)
+            entry = manifest.files.get(object_name)
+            if entry and entry['hash'] == file_hash:
+                continue
+            fname = os.path.join(uploads_dir, file['name'])
+            if file.get('extracted'):
+                await remove_path(fname + ".extracted")
+                for member in await read_archive_manifest(file['manifest']):
+                    downloads.append((member['object_name'], os.path.join(uploads_dir, member['name'])))
+                manifest.extracted[file['name']] = file_hash
+                stats['extracted'] += 1
+            else:
+                downloads.append((object_name, fname))
+                # archives uploaded before extraction moved to upload time are extracted here
+                if is_archive(file['name']) and not file.get('extract_error'):
+                    legacy_archives.append((file, fname, file_hash))
+            manifest.files[object_name] = {'name': file['name'], 'hash': file_hash}
+
+        download_semaphore = asyncio.Semaphore(config.MAX_CONCURRENT_UPLOADS)
+        async def _download(object_name, local_path, client):
+            async with download_semaphore:
+                await aiofiles.os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                await Storage.download_file(object_name, local_path, client=client)
 
-        # extract contents of archive files
-        for file in await sync_to_async(glob)(container.get_uploads_dir() + '/**/*', recursive=True):
-            if os.path.splitext(file)[1] in ARCHIVE_FILE_EXTENSIONS:
-                extract_dir = os.path.join(container.get_uploads_dir(), file+".extracted")
-                if not await aiofiles.os.path.exists(extract_dir):
-                    await aiofiles.os.mkdir(extract_dir)
-                    await aioshutil.unpack_archive(file, extract_dir)
+        try:
+            if downloads:
+                async with Storage.client() as client:
+                    await asyncio.gather(*[_download(object_name, local_path, client) for object_name, local_path in downloads])
+            stats['downloaded'] = len(downloads)
+
+            for file, fname, file_hash in legacy_archives:
+                extract_dir = fname + ".extracted"
+                await remove_path(extract_dir)
+                await aiofiles.os.mkdir(extract_dir)
+                await aioshutil.unpack_archive(fname, extract_dir)
+                manifest.extracted[file['name']] = file_hash
+                stats['extracted'] += 1
+        except BaseException:
+            # the in-memory manifest already lists files that may be missing, reload it next time
+            self.sync_manifest = None
+            raise
+
+        manifest.digest = digest
+        await manifest.save()
+
+        stats['elapsed'] = time.perf_counter() - start_time
+        print(f"Synced uploads for {self.agent_session.id}: {stats['downloaded']} downloaded, "
+              f"{stats['removed']} removed, {stats['extracted']} extracted in {stats['elapsed']:.2f}s")
+        return stats
 
 
     async def install(self, code_data, container: Container):
         print("Installing dependencies for code file:", code_data['filename'])
 
         err_msg = ""
-        _, exit_code = await container.run_command(
-            ["pipreqs", ".", "--savepath=requirements.in", "--mode", "no-pin"],
-            message_tag="install")
+        with Timer(phase_latency, phase='install_pipreqs'):
+            _, exit_code = await container.run_command(
+                ["pipreqs", ".", "--savepath=requirements.in", "--mode", "no-pin"],
+                message_tag="install")
         if exit_code != 0:
             err_msg = "There is a problem extracting packages used in the program. Please use packages that are easier to identify and install via pip."
 
             return True, err_msg
 
-        _, exit_code = await container.run_command(
-            ["pip-compile", "--upgrade-package", "numpy<2.0", "--resolver", "legacy", "--no-strip-extras", "--output-file", "eval_requirements.txt"],
-            message_tag="install")
-        if exit_code != 0:
-            print('Legacy resolver failed. Trying backtracking resolver...')
+        with Timer(phase_latency, phase='install_pip_compile'):
             _, exit_code = await container.run_command(
-                ["pip-compile", "--upgrade-package", "numpy<2.0", "--no-strip-extras", "--output-file", "eval_requirements.txt"],
+                ["pip-compile", "--upgrade-package", "numpy<2.0", "--resolver", "legacy", "--no-strip-extras", "--output-file", "eval_requirements.txt"],
                 message_tag="install")
+            if exit_code != 0:
+                print('Legacy resolver failed. Trying backtracking resolver...')
+                _, exit_code = await container.run_command(
+                    ["pip-compile", "--upgrade-package", "numpy<2.0", "--no-strip-extras", "--output-file", "eval_requirements.txt"],
+                    message_tag="install")
             if exit_code != 0:
                 err_msg = "There is a problem resolving the requirements of packages used in the program. Please use packages that do not have conflicts."
 
                 return True, err_msg
 
         #output, exit_code = await container.run_command(["pip-sync", "eval_requirements.txt"], message_tag="install")
-        output, exit_code = await container.run_command(["pip", "install", "-r", "eval_requirements.txt"], message_tag="install")
+        with Timer(phase_latency, phase='install_pip'):
+            output, exit_code = await container.run_command(["pip", "install", "-r", "eval_requirements.txt"], message_tag="install")
         if exit_code != 0:
             return True, output
 
         return False, err_msg
 
 
-    async def run_program(self, code_data, container: Container, timeout=900):
+    async def run_program(self, code_data, container: Container, timeout=900, collect_outputs=True):
         # clean out old files in the eval directory
         eval_dir = container.get_eval_dir()
-        for file in await aiofiles.os.listdir(eval_dir):
-            file_path = os.path.join(eval_dir, file)
-            try:
-                if await aiofiles.os.path.isfile(file_path):
-                    await aiofiles.os.unlink(file_path)
-                elif os.path.isdir(file_path):
-                    await aioshutil.rmtree(file_path)
-            except Exception as e:
-                print(e)
+        await clear_dir(eval_dir)
 
         # create the outputs directory
         await aiofiles.os.makedirs(os.path.join(eval_dir, "pred_results"), exist_ok=True)
@@ -176,35 +316,86 @@ class ScienceAgent():
             await f.write(content)
 
         module_name = code_data['filename'].replace("/", '.')[:-3] # remove ".py" suffix
-        run_output, exit_code = await container.run_command(
-            ["python", "-m", module_name], timeout=timeout, message_tag="run")
+        with Timer(phase_latency, phase='run_program'):
+            run_output, exit_code = await container.run_command(
+                ["python", "-m", module_name], timeout=timeout, message_tag="run")
 
+        if collect_outputs:
+            await self.collect_outputs(code_data, container)
+
+        return run_output, exit_code
+
+
+    async def collect_outputs(self, code_data, container: Container):
         output_dir = os.path.join(container.get_eval_dir(), 'pred_results')
-        outputs = await self.list_outputs(output_dir, code_data['id'])
+        with Timer(phase_latency, phase='hash_outputs'):
+            outputs = await self.list_outputs(output_dir, code_data['id'])
         existing_output_files = await self.agent_session.get_output_files()
+        existing_index = {(of['hash'], of['filename']) for of in existing_output_files}
         new_output_files = []
         for output in outputs:
-            is_duplicate = False
-            for of in existing_output_files:
-                if of['hash'] == output['hash'] and of['filename'] == output['filename']:
-                    is_duplicate = True
-                    break
-            
-            if not is_duplicate:
+            key = (output['hash'], output['filename'])
+            if key not in existing_index:
+                existing_index.add(key)
                 new_output_files.append(output)
-                await Storage.upload_file(os.path.join(output_dir, output['filename']), output['object_name'])
+
+        upload_semaphore = asyncio.Semaphore(config.MAX_CONCURRENT_UPLOADS)
+        async def _upload(output, client):
+            async with upload_semaphore:
+                await Storage.upload_file(os.path.join(output_dir, output['filename']), output['object_name'], client=client)
+        with Timer(phase_latency, phase='upload_outputs'):
+            if new_output_files:
+                async with Storage.client() as client:
+                    await asyncio.gather(*[_upload(output, client) for output in new_output_files])
 
         await self.agent_session.add_output_files(new_output_files)
         all_output_files = existing_output_files + new_output_files
         await broker.publish(self.agent_session.id, {'type': 'output_files', 'files': all_output_files})
 
-        return run_output, exit_code
 
+    def start_speculative_install(self, code: str, container: Container):
+        name = container.get_name()
+        # modules are only recorded once their install succeeded, so failed installs are retried
+        seen = self.speculated_modules.setdefault(name, set())
+        modules = [m for m in extract_imports(code) if m not in seen]
+        if not modules:
+            return
+
+        install_lock = self.install_locks.setdefault(name, asyncio.Lock())
+
+        async def _install():
+            try:
+                async with install_lock:
+                    # an install that finished while this one waited may have covered some modules
+                    remaining = [m for m in modules if m not in seen]
+                    if not remaining:
+                        return
+                    packages = await install_missing_packages(container, remaining)
+                    if packages is not None:
+                        seen.update(remaining)
+                if packages:
+                    print("Speculatively installed packages:", packages)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("Speculative install failed:", e)
+
+        self.pending_installs.setdefault(name, []).append(asyncio.create_task(_install()))
+
+
+    async def wait_for_installs(self, container: Container):
+        tasks = self.pending_installs.pop(container.get_name(), [])
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+    async def run_program_maybe_install(self, code_data, container: Container, timeout=900, collect_outputs=True):
+        # let any dependency install started during generation finish first
+        await self.wait_for_installs(container)
 
-    async def run_program_maybe_install(self, code_data, container: Container, timeout=900):
         # try to run the program
         try:
-            output, exit_code = await self.run_program(code_data, container, timeout=timeout)
+            output, exit_code = await self.run_program(code_data, container, timeout=timeout, collect_outputs=collect_outputs)
         except TimeoutError:
             return "Timeout", 1
 
@@ -214,7 +405,7 @@ class ScienceAgent():
             if install_err:
                 return err_msg, 1
             try:
-                output, exit_code = await self.run_program(code_data, container, timeout=timeout)
+                output, exit_code = await self.run_program(code_data, container, timeout=timeout, collect_outputs=collect_outputs)
             except TimeoutError:
                 return "Timeout", 1
 
@@ -234,20 +425,24 @@ class ScienceAgent():
         return output, exit_code
 
 
+    async def get_file_hash(self, fname, size, mtime_ns):
+        cached = self.output_hash_cache.get(fname)
+        if cached and cached[0] == size and cached[1] == mtime_ns:
+            return cached[2]
+        hash = await hash_file(fname)
+        self.output_hash_cache[fname] = (size, mtime_ns, hash)
+        return hash
+
+
     async def list_outputs(self, output_dir, code_data_id: str):
-        files = await sync_to_async(glob)(output_dir + '/**/*', recursive=True)
+        files = await scan_output_files(output_dir)
+        current = {fname for fname, _, _ in files}
+        for fname in [f for f in self.output_hash_cache if f not in current]:
+            del self.output_hash_cache[fname]
+        hashes = await asyncio.gather(*[self.get_file_hash(*file) for file in files])
         results = []
-        for fname in files:
-            hasher = hashlib.new('sha256')
-            async with aiofiles.open(fname, 'rb') as f:
-                while True:
-                    buf = await f.read(8192)
-                    if not buf:
-                        break
-                    hasher.update(buf)
-            hash = hasher.hexdigest()[0:32]
+        for (fname, size, _), hash in zip(files, hashes):
             relname = os.path.relpath(fname, output_dir)
-            size = await aiofiles.os.path.getsize(fname)
             object_name = f"{self.agent_session.id}/outputs/{hash}{os.path.splitext(fname)[1]}"
             results.append({
                 'id': str(uuid.uuid4()),
@@ -262,107 +457,192 @@ class ScienceAgent():
         return results
 
 
-    async def step(self, code_data, container: Container, llm_engine: LLMEngine, history: list, timeout=900):
+    async def check_program(self, code_data, container: Container, llm_engine: LLMEngine, timeout=900, collect_outputs=True):
+        """Runs a program and returns (success, error message for self-debugging, details)."""
         special_err = False
-        run_output, exit_code = await self.run_program_maybe_install(code_data, container, timeout=timeout)
-        if run_output == "Timeout":
+        run_output, exit_code = await self.run_program_maybe_install(code_data, container, timeout=timeout, collect_outputs=collect_outputs)
+        timed_out = run_output == "Timeout"
+        if timed_out:
             special_err = True
             err_msg = f"The program fails to finish execution within {timeout} seconds. Please try to reduce the execution time of your implementation."
 
-        if (not special_err) and exit_code == 0:
-            output_dir = os.path.join(container.get_eval_dir(), 'pred_results')
-            if len(await aiofiles.os.listdir(output_dir)) == 0:
-                special_err = True
-                err_msg = "The program does not save its output correctly. Please check if the functions are executed and the output path is correct."
+        output_dir = os.path.join(container.get_eval_dir(), 'pred_results')
+        has_outputs = await aiofiles.os.path.isdir(output_dir) and len(await aiofiles.os.listdir(output_dir)) > 0
+        if (not special_err) and exit_code == 0 and not has_outputs:
+            special_err = True
+            err_msg = "The program does not save its output correctly. Please check if the functions are executed and the output path is correct."
 
+        details = {'exit_code': exit_code, 'timed_out': timed_out, 'has_outputs': has_outputs}
         if (not special_err) and exit_code == 0:
-            return True, None, None
-        else:
-            if not special_err:
-                err_msg = run_output
+            return True, None, details
 
-                trimmed_err_msg = llm_engine.trim_messages(
-                    [{'role': 'user', 'content': err_msg}],
-                    max_tokens=5000
-                )[0]["content"]
+        if not special_err:
+            err_msg = run_output
 
-                if len(trimmed_err_msg) < len(err_msg):
-                    err_msg = trimmed_err_msg + "..."
+            trimmed_err_msg, truncated = await llm_engine.atruncate_text(err_msg, 5000)
+            if truncated:
+                err_msg = trimmed_err_msg + "..."
 
-            self_debug_history = [history[0], history[-1]]
-            _, new_code_data, new_history = await self.generate(llm_engine, err_msg, self_debug_history)
-            if new_code_data and new_code_data['content'].strip() == code_data['content'].strip():
-                # send early stopping signal if program is unchanged after debugging
-                return True, new_code_data, None
+        return False, err_msg, details
 
-            return False, new_code_data, new_history
 
+    async def self_debug(self, code_data, err_msg: str, llm_engine: LLMEngine, history: list, container: Container=None):
+        self_debug_history = [history[0], history[-1]]
+        _, new_code_data, new_history = await self.generate(llm_engine, err_msg, self_debug_history, prompt_tag="self_debug", container=container)
+        if new_code_data and new_code_data['content'].strip() == code_data['content'].strip():
+            # send early stopping signal if program is unchanged after debugging
+            return True, new_code_data, None
 
-    async def generate(self, llm_engine: LLMEngine, user_message: str, history: list, prompt_tag:str=None):
-        user_input = [
-            *history,
-            {'role': 'user', 'content': user_message},
-        ]
+        return False, new_code_data, new_history
 
-        prompt_history_id = str(uuid.uuid4())
-        response_history_id = str(uuid.uuid4())
 
-        await broker.publish(self.agent_session.id, {'type': 'response_start', 'role': 'user', 'tag': prompt_tag, 'id': prompt_history_id})
-        await broker.publish(self.agent_session.id, {'type': 'response_chunk', 'text': user_message, 'id': prompt_history_id})
-        await broker.publish(self.agent_session.id, {'type': 'response_end', 'id': prompt_history_id})
-        await broker.publish(self.agent_session.id, {'type': 'response_start', 'role': 'assistant', 'id': response_history_id})
+    async def step(self, code_data, container: Container, llm_engine: LLMEngine, history: list, timeout=900):
+        success, err_msg, _ = await self.check_program(code_data, container, llm_engine, timeout=timeout)
+        if success:
+            return True, None, None
+        return await self.self_debug(code_data, err_msg, llm_engine, history, container=container)
+
+
+    async def stream_response(self, llm_engine: LLMEngine, user_input: list, response_history_id: str, temperature=0.2, container: Container=None, publish=True):
+        """Streams an assistant response to the client and records its usage.
+
+        If a container is given, dependencies of each program are installed into it in the
+        background as soon as its code block is complete, while the rest is still streaming.
+        With `publish=False` the text is only returned, e.g. for candidates that may be
+        discarded, and can be sent later with publish_response().
+        """
+        code_fence_parser = CodeFenceParser() if container is not None else None
+        coalescer = StreamCoalescer(self.agent_session.id)
+        if publish:
+            await broker.publish(self.agent_session.id, {'type': 'response_start', 'role': 'assistant', 'id': response_history_id})
 
         assistant_output = ''
-        total_prompt_tokens = 0
-        total_completion_tokens = 0
-        async for chunk, prompt_tokens, completion_tokens in llm_engine.respond_stream(user_input, temperature=0.2, top_p=0.95):
-            total_prompt_tokens += prompt_tokens
-            total_completion_tokens += completion_tokens
-            if chunk:
-                assistant_output += chunk
-                await broker.publish(self.agent_session.id, {'type': 'response_chunk', 'text': chunk, 'id': response_history_id})
-
-        cost = llm_engine.get_cost(total_prompt_tokens, total_completion_tokens)
-
-        await broker.publish(self.agent_session.id, {'type': 'response_end', 'id': response_history_id})
+        usage = {'prompt_tokens': 0, 'completion_tokens': 0, 'cache_read_tokens': 0, 'cache_write_tokens': 0}
+        start_time = time.perf_counter()
+        first_token_time = None
+        # requests are queued per session when the engine is rate limited
+        session_token = llm_session.set(self.agent_session.id)
+        try:
+            async for chunk, chunk_usage in llm_engine.respond_stream(user_input, temperature=temperature, top_p=0.95):
+                if chunk_usage:
+                    for k in usage:
+                        usage[k] += chunk_usage.get(k, 0)
+                if chunk:
+                    if first_token_time is None:
+                        first_token_time = time.perf_counter()
+                        record_phase('generate_first_token', first_token_time - start_time)
+                    assistant_output += chunk
+                    if publish:
+                        await coalescer.add(response_history_id, chunk)
+                    if code_fence_parser:
+                        for code in code_fence_parser.feed(chunk):
+                            self.start_speculative_install(code, container)
+        finally:
+            llm_session.reset(session_token)
+            await coalescer.flush()
+        end_time = time.perf_counter()
+
+        total_prompt_tokens = usage['prompt_tokens']
+        total_completion_tokens = usage['completion_tokens']
+        record_phase('generate', end_time - start_time)
+        llm_tokens.inc(total_prompt_tokens, model=model_label(llm_engine.llm_engine_name), kind='prompt')
+        llm_tokens.inc(total_completion_tokens, model=model_label(llm_engine.llm_engine_name), kind='completion')
+        if first_token_time is not None and end_time > first_token_time and total_completion_tokens:
+            llm_tokens_per_second.observe(total_completion_tokens / (end_time - first_token_time), model=model_label(llm_engine.llm_engine_name))
+        cost = llm_engine.get_cost(total_prompt_tokens, total_completion_tokens, usage['cache_read_tokens'], usage['cache_write_tokens'])
+
+        if publish:
+            await broker.publish(self.agent_session.id, {'type': 'response_end', 'id': response_history_id})
         await broker.publish(self.agent_session.id, {
             'type': 'usage',
             'cost': cost,
             'prompt_tokens': total_prompt_tokens,
             'completion_tokens': total_completion_tokens,
+            'cache_read_tokens': usage['cache_read_tokens'],
+            'cache_write_tokens': usage['cache_write_tokens'],
         })
+        await self.agent_session.add_usage(total_completion_tokens, total_prompt_tokens, cost)
 
-        new_history = [
-            {'role': 'user', 'content': user_message, 'tag': prompt_tag, 'id': prompt_history_id},
-            {'role': 'assistant', 'content': assistant_output, 'llm_engine_name': llm_engine.llm_engine_name, 'id': response_history_id},
-        ]
+        # cache the token count with the history so follow-ups never re-tokenize old messages
+        response = {
+            'role': 'assistant', 'content': assistant_output, 'llm_engine_name': llm_engine.llm_engine_name, 'id': response_history_id,
+            'num_tokens': total_completion_tokens or await llm_engine.acount_tokens(assistant_output),
+        }
+        return response
 
-        tasks = [
-            self.agent_session.add_history(new_history),
-            self.agent_session.add_usage(total_completion_tokens, total_prompt_tokens, cost),
+
+    async def publish_response(self, response: dict):
+        """Sends a complete response that was generated with `publish=False`."""
+        await broker.publish(self.agent_session.id, {'type': 'response_start', 'role': response['role'], 'id': response['id']})
+        await broker.publish(self.agent_session.id, {'type': 'response_chunk', 'text': response['content'], 'id': response['id']})
+        await broker.publish(self.agent_session.id, {'type': 'response_end', 'id': response['id']})
+
+
+    async def publish_prompt(self, llm_engine: LLMEngine, user_message: str, prompt_tag: str=None):
+        prompt_history_id = str(uuid.uuid4())
+        await broker.publish(self.agent_session.id, {'type': 'response_start', 'role': 'user', 'tag': prompt_tag, 'id': prompt_history_id})
+        await broker.publish(self.agent_session.id, {'type': 'response_chunk', 'text': user_message, 'id': prompt_history_id})
+        await broker.publish(self.agent_session.id, {'type': 'response_end', 'id': prompt_history_id})
+        return {'role': 'user', 'content': user_message, 'tag': prompt_tag, 'id': prompt_history_id,
+                'num_tokens': await llm_engine.acount_tokens(user_message)}
+
+
+    def make_code_files(self, response: dict):
+        return [
+            {
+                'id': str(uuid.uuid4()),
+                'filename': None, # assigned when the code file is saved
+                'content': code_str, # original generated code
+                'user_content': code_str, # user modified code
+                'history_id': response['id'],
+                'block_index': i,
+                'is_gold': False,
+            }
+            for i, code_str in enumerate(self.extract_program(response['content']))
         ]
 
-        code_output = self.extract_program(assistant_output)
-        code_data = None
-        if len(code_output) > 0:
-            code_files = await self.agent_session.get_code_files()
-            for i, code_str in enumerate(code_output):
-                filename = f'program-{len(code_files)+i}.py'
-                code_data = {
-                    'id': str(uuid.uuid4()),
-                    'filename': filename,
-                    'content': code_str, # original generated code
-                    'user_content': code_str, # user modified code
-                    'history_id': response_history_id,
-                    'block_index': i,
-                    'is_gold': False,
-                }
+
+    async def save_turn(self, prompt: dict, response: dict, code_files: list):
+        """Persists a prompt/response pair with its code files and announces the code files."""
+        tasks = [self.agent_session.add_history([prompt, response])]
+        async with self.code_file_lock:
+            existing_code_files = await self.agent_session.get_code_files()
+            for i, code_data in enumerate(code_files):
+                code_data['filename'] = f'program-{len(existing_code_files)+i}.py'
                 tasks.append(self.agent_session.add_code_file(code_data))
                 await broker.publish(self.agent_session.id, {'type': 'code_file', 'code_file': code_data})
+            await asyncio.gather(*tasks)
+
+
+    async def generate(self, llm_engine: LLMEngine, user_message: str, history: list, prompt_tag:str=None, temperature=0.2, container: Container=None):
+        user_input = [
+            *[{'role': m['role'], 'content': m['content']} for m in history],
+            {'role': 'user', 'content': user_message},
+        ]
 
-        await asyncio.gather(*tasks)
+        prompt = await self.publish_prompt(llm_engine, user_message, prompt_tag)
+        response = await self.stream_response(llm_engine, user_input, str(uuid.uuid4()), temperature=temperature, container=container)
+        code_files = self.make_code_files(response)
+        await self.save_turn(prompt, response, code_files)
+
+        code_data = code_files[-1] if code_files else None
+        return response['content'], code_data, [prompt, response]
+
+    async def get_compacted_history(self, llm_engine: LLMEngine, history: list):
+        code_files, summaries = await asyncio.gather(
+            self.agent_session.get_code_files(),
+            self.agent_session.get_history_summaries(),
+        )
+        compacted, new_summaries = compact_history(history, code_files, summaries)
+        if new_summaries:
+            for summary in new_summaries.values():
+                summary['num_tokens'] = await llm_engine.acount_tokens(summary['content'])
+            for message in compacted:
+                if message.get('id') in new_summaries:
+                    message['num_tokens'] = new_summaries[message['id']]['num_tokens']
+            await self.agent_session.add_history_summaries(new_summaries)
+        return compacted
 
-        return assistant_output, code_data, new_history
 
     async def ask_follow_up(self, message: str, code_id: str, container: Container, llm_engine: LLMEngine, use_self_debug=True):
         code_data = None
@@ -377,7 +657,11 @@ class ScienceAgent():
             message = 'BEGIN_CONTEXT: \nHere is the latest program the user is working on:\n ```python' + code_data['user_content'] + '```\nEND_CONTEXT\n\n' + message
 
         history = await self.agent_session.get_history()
-        _, code_data, new_history = await self.generate(llm_engine, message, history)
+        compacted_history = await self.get_compacted_history(llm_engine, history)
+        prompt_history = await assemble_history(llm_engine, compacted_history, self.context_cutoff - 2000)
+        # packages are only installed speculatively when the program is going to be run
+        _, code_data, new_history = await self.generate(
+            llm_engine, message, prompt_history, container=container if use_self_debug else None)
         history = [*history, *new_history]
 
         if code_data is not None and use_self_debug:
@@ -389,17 +673,17 @@ class ScienceAgent():
                 if halt:
                     break
 
-    async def solve_task(self, container: Container, llm_engine: LLMEngine, use_self_debug=True):
+    async def solve_task(self, container: Container, llm_engine: LLMEngine, use_self_debug=True, num_candidates=1):
         await self.sync_uploads_dir(container)
-        uploads_folder_tree = await generate_folder_tree(container.get_uploads_dir())
-        dataset_preview = await generate_data_preview(container.get_uploads_dir())
+        uploads_folder_tree, dataset_preview = await build_uploads_context(
+            container.get_uploads_dir(), cache_key=self.sync_manifest.digest)
 
         # clear any previous history and outputs
         await self.agent_session.clear()
 
         session = await self.agent_session.get()
 
-        sys_msg = self.get_sys_msg(
+        sys_msg = await self.get_sys_msg(
             llm_engine,
             uploads_folder_tree,
             dataset_preview,
@@ -410,12 +694,20 @@ class ScienceAgent():
         )
 
         history = session['history']
-        _, code_data, new_history = await self.generate(
-            llm_engine, sys_msg, history, prompt_tag="system")
-        history = [*history, *new_history]
+        if num_candidates > 1:
+            halt, code_data, history = await self.solve_with_candidates(
+                container, llm_engine, sys_msg, history, num_candidates, use_self_debug)
+            if halt:
+                return
+            iterations = 2 # the candidate round already used one self-debug iteration
+        else:
+            _, code_data, new_history = await self.generate(
+                llm_engine, sys_msg, history, prompt_tag="system", container=container if use_self_debug else None)
+            history = [*history, *new_history]
+            iterations = 3
 
         if use_self_debug:
-            for t in range(3):
+            for t in range(iterations):
                 print("Running self-debug iteration", t)
                 halt, code_data, new_history = await self.step(code_data, container, llm_engine, history)
                 if new_history:
@@ -424,59 +716,108 @@ class ScienceAgent():
                     break
 
 
-async def generate_folder_tree(root_dir, indent=''):
-    """Generates a string representation of the folder tree."""
-    tree = ''
-    items = await aiofiles.os.listdir(root_dir)
-    num_items = len(items)
-
-    for index, item in enumerate(items):
-        item_path = os.path.join(root_dir, item)
-        is_last = index == num_items - 1
-
-        if index > 0:
-            tree += '\n'
-        tree += indent
-        tree += '└── ' if is_last else '├── '
-        tree += item
-
-        if await aiofiles.os.path.isdir(item_path):
-            new_indent = indent + ('    ' if is_last else '│   ')
-            tree += await generate_folder_tree(item_path, new_indent)
-    return tree
+    async def solve_with_candidates(self, container: Container, llm_engine: LLMEngine, sys_msg: str, history: list, num_candidates: int, use_self_debug: bool):
+        """Generates several candidate programs concurrently and runs them in parallel.
 
-
-async def generate_file_preview(filename):
-    _, ext = os.path.splitext(filename)
-    if not ext or ext in (".csv", ".tsv", ".txt") or "json" in ext:
+        Each candidate is sampled with a different temperature and executed in its own workspace
+        container. The first candidate that exits cleanly and writes outputs wins and the other
+        runs are cancelled. If none succeeds, only the most promising failure is self-debugged.
+        Candidates are generated and run without publishing, only the chosen candidate's response
+        and execution log are sent to the client and stored, as if it had been the only one.
+        Returns (halt, code_data, history) for the caller's remaining self-debug iterations.
+        """
+        user_input = [
+            *[{'role': m['role'], 'content': m['content']} for m in history],
+            {'role': 'user', 'content': sys_msg},
+        ]
+        prompt = await self.publish_prompt(llm_engine, sys_msg, "system")
+
+        temperatures = [CANDIDATE_TEMPERATURES[i % len(CANDIDATE_TEMPERATURES)] for i in range(num_candidates)]
+        responses = await asyncio.gather(*[
+            self.stream_response(llm_engine, user_input, str(uuid.uuid4()), temperature=t, publish=False) for t in temperatures
+        ])
+        candidates = [
+            {'response': response, 'code_files': self.make_code_files(response)}
+            for response in responses
+        ]
+        runnable = [c for c in candidates if c['code_files']]
+
+        if not use_self_debug or not runnable:
+            # nothing to run, keep the first candidate that produced a program (if any)
+            chosen = runnable[0] if runnable else candidates[0]
+            await self.publish_response(chosen['response'])
+            await self.save_turn(prompt, chosen['response'], chosen['code_files'])
+            code_data = chosen['code_files'][-1] if chosen['code_files'] else None
+            return not runnable, code_data, [*history, prompt, chosen['response']]
+
+        async def _check(candidate):
+            success, err_msg, details = await self.check_program(
+                candidate['code_data'], candidate['container'], llm_engine, collect_outputs=False)
+            candidate.update({'success': success, 'err_msg': err_msg, **details})
+            return candidate
+
+        # the candidate containers and their directories are removed however this phase ends
+        containers = []
+        tasks = []
         try:
-            async with aiofiles.open(filename) as f:
-                preview = await f.read(500)
-                final_char = await f.read(1)
-            if not final_char:
-                preview += '\n...'
-            preview += '\n'
-            return preview
-        except:
-            return None
-    elif ext in (".py"):
-        async with aiofiles.open(filename) as f:
-            return await f.read()
-    return None
-
-
-async def generate_data_preview(dir, root_dir='/uploads'):
-    items = await aiofiles.os.listdir(dir)
-    preview = ''
-    for item in items:
-        item_path = os.path.join(dir, item)
-        file_preview = await generate_file_preview(item_path)
-        if file_preview:
-            preview += f"[START Preview of {root_dir}/{item}]\n"
-            preview += file_preview
-            preview += f"[END Preview of {root_dir}/{item}]\n"
-        if await aiofiles.os.path.isdir(item_path):
-            # NOTE: subfolders can occur if the user uploads a zip file which is automatically extracted
-            preview += await generate_data_preview(item_path, root_dir+'/'+item)
-
-    return preview
+            for i, candidate in enumerate(runnable):
+                candidate['container'] = Container(self.agent_session, workspace=f"candidate-{i}")
+                candidate['container'].defer_logs()
+                containers.append(candidate['container'])
+                candidate['code_data'] = {**candidate['code_files'][-1], 'filename': f'candidate_{i}.py'}
+                await candidate['container'].make_dirs()
+
+            winner = None
+            tasks = [asyncio.create_task(_check(c)) for c in runnable]
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    candidate = await next_done
+                except Exception as e:
+                    print("Candidate run failed:", e)
+                    continue
+                if candidate['success']:
+                    winner = candidate
+                    break
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+            if winner is None:
+                finished = [c for c in runnable if 'success' in c]
+                winner = min(finished, key=rank_failure) if finished else runnable[0]
+
+            await self.publish_response(winner['response'])
+            await self.save_turn(prompt, winner['response'], winner['code_files'])
+            await winner['container'].publish_deferred_logs()
+            code_data = winner['code_files'][-1]
+            history = [*history, prompt, winner['response']]
+
+            if winner.get('success'):
+                await self.collect_outputs(code_data, winner['container'])
+                return True, code_data, history
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await asyncio.gather(*[c.destroy() for c in containers], return_exceptions=True)
+
+        if 'err_msg' not in winner:
+            # the fallback candidate never finished running, debug it the usual way
+            return False, code_data, history
+
+        halt, new_code_data, new_history = await self.self_debug(code_data, winner['err_msg'], llm_engine, history, container=container)
+        if new_history:
+            history = [*history, *new_history]
+        return halt, new_code_data, history
+
+
+def rank_failure(candidate):
+    """Sort key for failed candidates, most promising first."""
+    if candidate.get('exit_code') == 0:
+        return (0, 0) # ran cleanly but saved no outputs
+    if candidate.get('timed_out'):
+        return (3, 0)
+    # shorter error output usually means the program got further before failing
+    return (1 if candidate.get('has_outputs') else 2, len(candidate.get('err_msg') or ''))
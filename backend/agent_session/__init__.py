@@ -1,3 +1,4 @@
+from metrics import session_backend_latency, time_methods
 import config
 
 if config.AGENT_SESSION_BACKEND == "dynamodb":
@@ -5,4 +6,6 @@ if config.AGENT_SESSION_BACKEND == "dynamodb":
 elif config.AGENT_SESSION_BACKEND == "filesystem":
     from .filesystem_backend import FilesystemAgentSession as AgentSession
 else:
-    raise ValueError(f"Unsupported AGENT_SESSION_BACKEND: {config.AGENT_SESSION_BACKEND}")
\ No newline at end of file
+    raise ValueError(f"Unsupported AGENT_SESSION_BACKEND: {config.AGENT_SESSION_BACKEND}")
+
+time_methods(AgentSession, session_backend_latency)
@@ -16,6 +16,7 @@ def blank_session(prefill=None):
         'output_files': [],
         'code_files': [],
         'history': [],
+        'history_summaries': {}, # compacted contents of older history messages, by message id
         'total_prompt_tokens': 0,
         'total_completion_tokens': 0,
         'total_cost': 0,
@@ -30,6 +31,43 @@ def blank_session(prefill=None):
     return data
 
 
+def page(items: list, before: int = None, limit: int = 50):
+    """Returns up to `limit` items that precede index `before` (default: the end of the list)."""
+    total = len(items)
+    end = total if before is None else max(0, min(before, total))
+    start = max(0, end - limit)
+    return {'items': items[start:end], 'start': start, 'total': total}
+
+
+def compact_state(data: dict, history_limit: int, execution_log_limit: int):
+    """Returns a copy of a session for the initial websocket message.
+
+    Only the latest history and execution log entries are included; older ones can be paged
+    in with page(). Code files keep their metadata, only the latest one keeps its contents.
+    """
+    history = page(data.get('history', []), limit=history_limit)
+    execution_log = page(data.get('execution_log', []), limit=execution_log_limit)
+    code_files = data.get('code_files', [])
+    compact = {k: v for k, v in data.items() if k != 'history_summaries'}
+    compact.update({
+        'compact': True,
+        'history': history['items'],
+        'history_start': history['start'],
+        'execution_log': execution_log['items'],
+        'execution_log_start': execution_log['start'],
+        'code_files': [
+            cf if i == len(code_files) - 1 else {k: v for k, v in cf.items() if k not in ('content', 'user_content')}
+            for i, cf in enumerate(code_files)
+        ],
+    })
+    return compact
+
+
 class AgentSessionBase:
     def __init__(self, id: str):
         self.id = id
+
+    @staticmethod
+    def initialize():
+        """Creates backend clients ahead of the first request."""
+        pass
@@ -1,12 +1,9 @@
-import aioboto3
-from boto3.dynamodb.types import Decimal
+from decimal import Decimal
 from .base_backend import blank_session, AgentSessionBase
+from aws import get_boto3_session
 import config
 
 
-boto3_session = aioboto3.Session(region_name=config.AWS_REGION)
-
-
 def replace_decimals(obj):
     if isinstance(obj, list):
         for i in range(len(obj)):
@@ -26,10 +23,14 @@ def replace_decimals(obj):
 
 
 class AWSAgentSession(AgentSessionBase):
+    @staticmethod
+    def initialize():
+        get_boto3_session()
+
     @staticmethod
     async def create(prefill=None):
         data = blank_session(prefill)
-        async with boto3_session.resource('dynamodb') as db:
+        async with get_boto3_session().resource('dynamodb') as db:
             table = await db.Table(config.AGENT_SESSION_TABLE_NAME)
             await table.put_item(Item=data)
 
@@ -37,7 +38,7 @@ class AWSAgentSession(AgentSessionBase):
 
     @staticmethod
     async def get_benchmark_tasks():
-        async with boto3_session.resource('dynamodb') as db:
+        async with get_boto3_session().resource('dynamodb') as db:
             table = await db.Table(config.AGENT_SESSION_TABLE_NAME)
             
             all_items = []
@@ -65,19 +66,19 @@ class AWSAgentSession(AgentSessionBase):
 
     @staticmethod
     async def get_user_tasks(user_id: str):
-        async with boto3_session.resource('dynamodb') as db:
+        async with get_boto3_session().resource('dynamodb') as db:
             table = await db.Table(config.AGENT_SESSION_TABLE_NAME)
             response = await table.scan(FilterExpression="metadata.user_id = :user_id", ExpressionAttributeValues={':user_id': user_id})
             return replace_decimals(response.get('Items', []))
 
     async def get(self):
-        async with boto3_session.resource('dynamodb') as db:
+        async with get_boto3_session().resource('dynamodb') as db:
             table = await db.Table(config.AGENT_SESSION_TABLE_NAME)
             response = await table.get_item(Key={'id': self.id})
             return replace_decimals(response.get('Item', {}))
 
     async def clear(self):
-        async with boto3_session.resource('dynamodb') as db:
+        async with get_boto3_session().resource('dynamodb') as db:
             table = await db.Table(config.AGENT_SESSION_TABLE_NAME)
             
             # Keep gold files
@@ -87,11 +88,12 @@ class AWSAgentSession(AgentSessionBase):
             
             await table.update_item(
                 Key={'id': self.id},
-                UpdateExpression="SET output_files = :output_files, code_files = :code_files, history = :history, total_prompt_tokens = :total_prompt_tokens, total_completion_tokens = :total_completion_tokens, total_cost = :total_cost, execution_log = :execution_log",
+                UpdateExpression="SET output_files = :output_files, code_files = :code_files, history = :history, history_summaries = :history_summaries, total_prompt_tokens = :total_prompt_tokens, total_completion_tokens = :total_completion_tokens, total_cost = :total_cost, execution_log = :execution_log",
                 ExpressionAttributeValues={
                     ':output_files': [],
                     ':code_files': gold_code_files,
                     ':history': [],
+                    ':history_summaries': {},
                     ':total_prompt_tokens': 0,
                     ':total_completion_tokens': 0,
                     ':total_cost': 0,
@@ -100,7 +102,7 @@ class AWSAgentSession(AgentSessionBase):
             )
 
     async def update_inputs(self, task_inst: str, domain_knowledge: str, description: str):
-        async with boto3_session.resource('dynamodb') as db:
+        async with get_boto3_session().resource('dynamodb') as db:
             table = await db.Table(config.AGENT_SESSION_TABLE_NAME)
             await table.update_item(
                 Key={'id': self.id},
@@ -109,13 +111,13 @@ class AWSAgentSession(AgentSessionBase):
             )
 
     async def get_output_files(self):
-        async with boto3_session.resource('dynamodb') as db:
+        async with get_boto3_session().resource('dynamodb') as db:
             table = await db.Table(config.AGENT_SESSION_TABLE_NAME)
             response = await table.get_item(Key={'id': self.id}, AttributesToGet=['output_files'])
             return replace_decimals(response.get('Item', {}).get('output_files', []))
 
     async def add_output_files(self, outputs: list):
-        async with boto3_session.resource('dynamodb') as db:
+        async with get_boto3_session().resource('dynamodb') as db:
             table = await db.Table(config.AGENT_SESSION_TABLE_NAME)
             await table.update_item(
                 Key={'id': self.id},
@@ -124,13 +126,13 @@ class AWSAgentSession(AgentSessionBase):
             )
 
     async def get_uploaded_files(self):
-        async with boto3_session.resource('dynamodb') as db:
+        async with get_boto3_session().resource('dynamodb') as db:
             table = await db.Table(config.AGENT_SESSION_TABLE_NAME)
             response = await table.get_item(Key={'id': self.id}, AttributesToGet=['uploaded_files'])
             return replace_decimals(response.get('Item', {}).get('uploaded_files', []))
 
     async def get_code_files(self):
-        async with boto3_session.resource('dynamodb') as db:
+        async with get_boto3_session().resource('dynamodb') as db:
             table = await db.Table(config.AGENT_SESSION_TABLE_NAME)
             response = await table.get_item(Key={'id': self.id}, AttributesToGet=['code_files'])
             return replace_decimals(response.get('Item', {}).get('code_files', []))
@@ -146,7 +148,7 @@ class AWSAgentSession(AgentSessionBase):
         if index is None:
             return {"error": "Code file not found."}
         
-        async with boto3_session.resource('dynamodb') as db:
+        async with get_boto3_session().resource('dynamodb') as db:
             table = await db.Table(config.AGENT_SESSION_TABLE_NAME)
             await table.update_item(
                 Key={'id': self.id},
@@ -155,7 +157,7 @@ class AWSAgentSession(AgentSessionBase):
             )
 
     async def add_code_file(self, code_data: dict):
-        async with boto3_session.resource('dynamodb') as db:
+        async with get_boto3_session().resource('dynamodb') as db:
             table = await db.Table(config.AGENT_SESSION_TABLE_NAME)
             await table.update_item(
                 Key={'id': self.id},
@@ -164,13 +166,13 @@ class AWSAgentSession(AgentSessionBase):
             )
 
     async def get_history(self):
-        async with boto3_session.resource('dynamodb') as db:
+        async with get_boto3_session().resource('dynamodb') as db:
             table = await db.Table(config.AGENT_SESSION_TABLE_NAME)
             response = await table.get_item(Key={'id': self.id}, AttributesToGet=['history'])
             return response.get('Item', {}).get('history', [])
 
     async def add_history(self, history: list):
-        async with boto3_session.resource('dynamodb') as db:
+        async with get_boto3_session().resource('dynamodb') as db:
             table = await db.Table(config.AGENT_SESSION_TABLE_NAME)
             await table.update_item(
                 Key={'id': self.id},
@@ -178,8 +180,34 @@ class AWSAgentSession(AgentSessionBase):
                 ExpressionAttributeValues={':history': history},
             )
 
+    async def get_history_summaries(self):
+        async with get_boto3_session().resource('dynamodb') as db:
+            table = await db.Table(config.AGENT_SESSION_TABLE_NAME)
+            response = await table.get_item(Key={'id': self.id}, AttributesToGet=['history_summaries'])
+            return replace_decimals(response.get('Item', {}).get('history_summaries', {}))
+
+    async def add_history_summaries(self, summaries: dict):
+        if not summaries:
+            return
+        async with get_boto3_session().resource('dynamodb') as db:
+            table = await db.Table(config.AGENT_SESSION_TABLE_NAME)
+            # sessions created before summaries existed have no map to set keys in yet
+            await table.update_item(
+                Key={'id': self.id},
+                UpdateExpression="SET history_summaries = if_not_exists(history_summaries, :empty)",
+                ExpressionAttributeValues={':empty': {}},
+            )
+            names = {f"#id{i}": message_id for i, message_id in enumerate(summaries)}
+            values = {f":summary{i}": summary for i, summary in enumerate(summaries.values())}
+            await table.update_item(
+                Key={'id': self.id},
+                UpdateExpression="SET " + ", ".join(f"history_summaries.#id{i} = :summary{i}" for i in range(len(summaries))),
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+            )
+
     async def add_usage(self, prompt_tokens: int, completion_tokens: int, cost: float):
-        async with boto3_session.resource('dynamodb') as db:
+        async with get_boto3_session().resource('dynamodb') as db:
             table = await db.Table(config.AGENT_SESSION_TABLE_NAME)
             await table.update_item(
                 Key={'id': self.id},
@@ -187,8 +215,14 @@ class AWSAgentSession(AgentSessionBase):
                 ExpressionAttributeValues={':prompt_tokens': prompt_tokens, ':completion_tokens': completion_tokens, ':cost': Decimal(str(cost))},
             )
 
+    async def get_execution_log(self):
+        async with get_boto3_session().resource('dynamodb') as db:
+            table = await db.Table(config.AGENT_SESSION_TABLE_NAME)
+            response = await table.get_item(Key={'id': self.id}, AttributesToGet=['execution_log'])
+            return replace_decimals(response.get('Item', {}).get('execution_log', []))
+
     async def add_execution_log(self, log: dict):
-        async with boto3_session.resource('dynamodb') as db:
+        async with get_boto3_session().resource('dynamodb') as db:
             table = await db.Table(config.AGENT_SESSION_TABLE_NAME)
             await table.update_item(
                 Key={'id': self.id},
@@ -197,7 +231,7 @@ class AWSAgentSession(AgentSessionBase):
             )
 
     async def add_uploaded_file(self, file_info: dict):
-        async with boto3_session.resource('dynamodb') as db:
+        async with get_boto3_session().resource('dynamodb') as db:
             table = await db.Table(config.AGENT_SESSION_TABLE_NAME)
             await table.update_item(
                 Key={'id': self.id},
@@ -207,7 +241,7 @@ class AWSAgentSession(AgentSessionBase):
 
     async def remove_uploaded_file(self, filename):
         file_to_delete = None
-        async with boto3_session.resource('dynamodb') as db:
+        async with get_boto3_session().resource('dynamodb') as db:
             table = await db.Table(config.AGENT_SESSION_TABLE_NAME)
             response = await table.get_item(Key={'id': self.id}, AttributesToGet=['uploaded_files'])
             uploaded_files = response.get('Item', {}).get('uploaded_files', [])
@@ -50,6 +50,7 @@ class FilesystemAgentSession(AgentSessionBase):
         data['output_files'] = []
         data['code_files'] = [cf for cf in data.get('code_files', []) if cf.get('is_gold')]
         data['history'] = []
+        data['history_summaries'] = {}
         data['total_prompt_tokens'] = 0
         data['total_completion_tokens'] = 0
         data['total_cost'] = 0
@@ -111,6 +112,15 @@ class FilesystemAgentSession(AgentSessionBase):
         data['history'].extend(history)
         await self.save(data)
 
+    async def get_history_summaries(self):
+        data = await self.get()
+        return data.get('history_summaries', {})
+
+    async def add_history_summaries(self, summaries: dict):
+        data = await self.get()
+        data.setdefault('history_summaries', {}).update(summaries)
+        await self.save(data)
+
     async def add_usage(self, prompt_tokens: int, completion_tokens: int, cost: float):
         data = await self.get()
         data['total_prompt_tokens'] += prompt_tokens
@@ -118,6 +128,10 @@ class FilesystemAgentSession(AgentSessionBase):
         data['total_cost'] += cost
         await self.save(data)
 
+    async def get_execution_log(self):
+        data = await self.get()
+        return data.get('execution_log', [])
+
     async def add_execution_log(self, log: dict):
         data = await self.get()
         data['execution_log'].append(log)
@@ -6,6 +6,16 @@ from quart import Quart, request, jsonify
 from routes.tasks import tasks_blueprint, user_tasks_blueprint
 from routes.evaluation import evaluation_blueprint
 from routes.execution import execution_blueprint
+from routes.admin import admin_blueprint, require_admin
+from llm_engine import warm_llm_engine, get_http_client
+from broker import broker
+from metrics import render as render_metrics
+from diagnostics import loop_lag_monitor
+from container import initialize_docker
+from agent_session import AgentSession
+from storage import Storage
+import config
+import os
 
 
 logging.basicConfig(level=logging.INFO,
@@ -17,6 +27,7 @@ app.register_blueprint(tasks_blueprint, url_prefix='/api/tasks')
 app.register_blueprint(user_tasks_blueprint, url_prefix='/api/userTasks')
 app.register_blueprint(evaluation_blueprint, url_prefix='/api/evaluate')
 app.register_blueprint(execution_blueprint, url_prefix='/api/execution')
+app.register_blueprint(admin_blueprint, url_prefix='/api/admin')
 
 
 @app.after_request
@@ -34,6 +45,12 @@ async def handle_options(any):
     return await add_cors_headers(response)
 
 
+@app.route("/metrics", methods=["GET"])
+@require_admin
+async def metrics():
+    return render_metrics(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
 # Add signal handlers to avoid hanging async tasks
 # Only applies to Python 3.11+, see related GitHub issue: https://github.com/pallets/quart/issues/333
 @app.before_serving
@@ -42,6 +59,28 @@ async def startup():
     loop.add_signal_handler(signal.SIGINT, shutdown_handler)
     loop.add_signal_handler(signal.SIGTERM, shutdown_handler)
 
+    if config.LOOP_LAG_THRESHOLD:
+        loop_lag_monitor.start()
+
+    # clients are created here instead of at import time so the app module loads quickly
+    get_http_client()
+    AgentSession.initialize()
+    Storage.initialize()
+    try:
+        initialize_docker()
+    except Exception as e:
+        print("Failed to connect to Docker, it will be retried when a container starts:", e)
+    if config.LLM_ENGINE_NAME:
+        app.add_background_task(warm_llm_engine, config.LLM_ENGINE_NAME, api_key=os.getenv('LLM_API_KEY'),
+                                base_url=config.LLM_BASE_URL, fallback_engine_names=config.LLM_FALLBACK_ENGINES)
+
+
+@app.after_serving
+async def close_clients():
+    loop_lag_monitor.stop()
+    await get_http_client().aclose()
+    await broker.close()
+
 
 def shutdown_handler():
     for task in asyncio.all_tasks(asyncio.get_running_loop()):
@@ -0,0 +1,198 @@
+from concurrent.futures import ThreadPoolExecutor
+from storage import Storage
+
+import asyncio
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import zipfile
+import zlib
+import config
+
+
+ARCHIVE_FILE_EXTENSIONS = ['.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz']
+
+# raised by zipfile, tarfile and their decompressors for corrupt or truncated archives; unsafe
+# member names are skipped, and I/O errors are failures rather than a property of the archive
+ARCHIVE_ERRORS = (zipfile.BadZipFile, zipfile.LargeZipFile, tarfile.TarError, zlib.error, EOFError)
+
+EXTRACT_WORKERS = 4
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def is_archive(filename):
+    return any(filename.endswith(ext) for ext in ARCHIVE_FILE_EXTENSIONS)
+
+
+def safe_member_name(name):
+    """Normalizes an archive member name, returning None if it would escape the extraction dir."""
+    name = name.replace('\\', '/')
+    if name.startswith('/') or os.path.isabs(name):
+        return None
+    normalized = os.path.normpath(name)
+    if normalized == '.' or normalized.startswith('..'):
+        return None
+    return normalized
+
+
+def _extract_zip_members(archive_path, members, dest_dir, emit, stop):
+    # every worker needs its own handle since ZipFile objects are not thread safe
+    with zipfile.ZipFile(archive_path) as zf:
+        for info, name in members:
+            if stop.is_set():
+                return
+            local_path = os.path.join(dest_dir, name)
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            with zf.open(info) as src, open(local_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+            emit((name, local_path, info.file_size))
+
+
+def _extract_tar_members(archive_path, dest_dir, emit, stop):
+    # streaming mode reads the archive front to back once, without seeking
+    with tarfile.open(archive_path, 'r|*') as tf:
+        for member in tf:
+            if stop.is_set():
+                return
+            name = safe_member_name(member.name)
+            if not member.isfile() or name is None:
+                continue
+            local_path = os.path.join(dest_dir, name)
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            with tf.extractfile(member) as src, open(local_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+            emit((name, local_path, member.size))
+
+
+def _list_zip_members(archive_path):
+    with zipfile.ZipFile(archive_path) as zf:
+        members = []
+        for info in zf.infolist():
+            name = safe_member_name(info.filename)
+            if info.is_dir() or name is None:
+                continue
+            members.append((info, name))
+        return members
+
+
+async def extract_archive_to_storage(archive_path: str, archive_name: str, object_prefix: str):
+    """Extracts an archive once and uploads each member as its own storage object.
+
+    Zip members are extracted by several worker threads in parallel, tar archives are streamed
+    by a single thread. Members are uploaded as soon as they are written, so extraction and
+    upload overlap. The member entries, named `<archive_name>.extracted/<member>` to match the
+    layout of the session uploads directory, are stored in a manifest next to them. Returns the
+    number of members and the object name of the manifest. If anything fails, the members
+    uploaded so far are removed again.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    done = object()
+
+    def emit(item):
+        loop.call_soon_threadsafe(queue.put_nowait, item)
+
+    members = []
+    # the workers get their own executor so that they can be joined before the temporary
+    # directory they write into is removed, running executor jobs cannot be cancelled
+    executor = ThreadPoolExecutor(max_workers=EXTRACT_WORKERS, thread_name_prefix='extract-archive')
+    stop = threading.Event()
+    jobs = []
+
+    async def _join_workers():
+        stop.set()
+        await asyncio.gather(*[asyncio.wrap_future(job) for job in jobs], return_exceptions=True)
+
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dest_dir = os.path.join(tmp_dir, 'members')
+            if archive_name.endswith('.zip'):
+                zip_members = await loop.run_in_executor(executor, _list_zip_members, archive_path)
+                chunks = [zip_members[i::EXTRACT_WORKERS] for i in range(EXTRACT_WORKERS)]
+                jobs = [
+                    executor.submit(_extract_zip_members, archive_path, chunk, dest_dir, emit, stop)
+                    for chunk in chunks if chunk
+                ]
+            else:
+                jobs = [executor.submit(_extract_tar_members, archive_path, dest_dir, emit, stop)]
+
+            async def _wait_workers():
+                try:
+                    await asyncio.gather(*[asyncio.wrap_future(job) for job in jobs])
+                except BaseException:
+                    # the first error is raised once the other workers have stopped writing
+                    await _join_workers()
+                    raise
+                finally:
+                    queue.put_nowait(done)
+
+            upload_semaphore = asyncio.Semaphore(config.MAX_CONCURRENT_UPLOADS)
+
+            async def _upload(client, name, local_path, size):
+                async with upload_semaphore:
+                    object_name = f"{object_prefix}/{archive_name}.extracted/{name}"
+                    # recorded before the upload so that a failed run also removes partial objects
+                    members.append({
+                        'name': f"{archive_name}.extracted/{name}",
+                        'size': size,
+                        'object_name': object_name,
+                    })
+                    await Storage.upload_file(local_path, object_name, client=client)
+                    await loop.run_in_executor(None, os.remove, local_path)
+
+            async with Storage.client() as client:
+                wait_task = asyncio.create_task(_wait_workers())
+                uploads = []
+                try:
+                    while True:
+                        item = await queue.get()
+                        if item is done:
+                            break
+                        uploads.append(asyncio.create_task(_upload(client, *item)))
+                    await wait_task
+                    await asyncio.gather(*uploads)
+
+                    members.sort(key=lambda m: m['name'])
+                    manifest_path = os.path.join(tmp_dir, 'manifest.json')
+                    with open(manifest_path, 'w') as f:
+                        json.dump({'archive': archive_name, 'members': members}, f)
+                    manifest_object_name = f"{object_prefix}/{archive_name}.manifest.json"
+                    await Storage.upload_file(manifest_path, manifest_object_name, client=client)
+                except BaseException:
+                    for task in [wait_task, *uploads]:
+                        task.cancel()
+                    await asyncio.gather(wait_task, *uploads, return_exceptions=True)
+                    await _join_workers()
+                    await remove_members(members, client)
+                    raise
+    finally:
+        executor.shutdown(wait=False)
+
+    return len(members), manifest_object_name
+
+
+async def remove_members(members: list, client=None):
+    semaphore = asyncio.Semaphore(config.MAX_CONCURRENT_UPLOADS)
+
+    async def _remove(member):
+        async with semaphore:
+            try:
+                await Storage.remove_file(member['object_name'], client=client)
+            except FileNotFoundError:
+                pass # the upload never started
+            except Exception as e:
+                print("Failed to remove archive member", member['object_name'], e)
+
+    await asyncio.gather(*[_remove(member) for member in members])
+
+
+async def read_archive_manifest(manifest_object_name: str):
+    """Returns the member entries of an archive extracted at upload time."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        manifest_path = os.path.join(tmp_dir, 'manifest.json')
+        await Storage.download_file(manifest_object_name, manifest_path)
+        with open(manifest_path) as f:
+            return json.load(f)['members']
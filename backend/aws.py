@@ -0,0 +1,12 @@
+import config
+
+_boto3_session = None
+
+
+def get_boto3_session():
+    """Creates the aioboto3 session shared by the AWS backends on first use, importing it is slow."""
+    global _boto3_session
+    if _boto3_session is None:
+        import aioboto3
+        _boto3_session = aioboto3.Session(region_name=config.AWS_REGION)
+    return _boto3_session
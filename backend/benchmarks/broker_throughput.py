@@ -0,0 +1,76 @@
+# Measures publish-to-delivery throughput of the message brokers with many sessions.
+# Each session has a number of subscribers and one producer publishing execution_chunk-sized
+# messages as fast as it can. The Redis broker is measured against --redis-url, or against
+# fakeredis if it is installed and no URL is given. Run from the `backend` directory:
+#   python -m benchmarks.broker_throughput [--sessions 50] [--subscribers 2] [--messages 500] [--redis-url redis://localhost:6379]
+
+import argparse
+import asyncio
+import time
+import uuid
+from broker import LocalBroker, RedisBroker
+
+
+async def run(broker, num_sessions, num_subscribers, num_messages):
+    received = 0
+
+    async def _subscriber(session_id, ready):
+        nonlocal received
+        subscription = broker.subscribe(session_id)
+        first = asyncio.ensure_future(subscription.__anext__())
+        ready.set_result(None)
+        message = await first
+        while message['type'] != 'done':
+            received += 1
+            message = await subscription.__anext__()
+        await subscription.aclose()
+
+    async def _producer(session_id):
+        for i in range(num_messages):
+            await broker.publish(session_id, {'type': 'execution_chunk', 'id': str(i), 'text': 'x' * 80})
+        await broker.publish(session_id, {'type': 'done'})
+
+    session_ids = [str(uuid.uuid4()) for _ in range(num_sessions)]
+    subscribers = []
+    for session_id in session_ids:
+        for _ in range(num_subscribers):
+            ready = asyncio.get_running_loop().create_future()
+            subscribers.append(asyncio.create_task(_subscriber(session_id, ready)))
+            await ready
+    # give the Redis reader time to subscribe to every channel
+    await asyncio.sleep(0.5 if isinstance(broker, RedisBroker) else 0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[_producer(session_id) for session_id in session_ids])
+    await asyncio.gather(*subscribers)
+    return received, time.perf_counter() - start
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=50)
+    parser.add_argument('--subscribers', type=int, default=2, help="subscribers per session")
+    parser.add_argument('--messages', type=int, default=500, help="messages published per session")
+    parser.add_argument('--redis-url', default=None)
+    args = parser.parse_args()
+
+    brokers = [("local", LocalBroker())]
+    if args.redis_url:
+        brokers.append(("redis", RedisBroker(args.redis_url)))
+    else:
+        try:
+            import fakeredis
+            brokers.append(("redis (fakeredis)", RedisBroker(client=fakeredis.FakeAsyncRedis())))
+        except ImportError:
+            print("fakeredis is not installed and no --redis-url was given, skipping the Redis broker")
+
+    for label, broker in brokers:
+        received, wall = await run(broker, args.sessions, args.subscribers, args.messages)
+        published = args.sessions * args.messages
+        print(f"{label}: {published / wall:.0f} published/s, {received / wall:.0f} delivered/s "
+              f"({received} of {published * args.subscribers} delivered in {wall:.2f}s)")
+        await broker.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
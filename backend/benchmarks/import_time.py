@@ -0,0 +1,58 @@
+# Measures how long it takes to import the app, which bounds how fast a new worker can start
+# serving. Runs `python -X importtime` in a fresh interpreter, prints the total and the slowest
+# top-level imports, and exits with an error when the total is over the budget, so a heavy
+# module-level import that slips back in is caught. Run from the `backend` directory:
+#   python -m benchmarks.import_time [--module app] [--max-ms 1000] [--top 15] [--repeat 3]
+
+import argparse
+import re
+import subprocess
+import sys
+
+LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+
+def measure(module: str):
+    """Returns the import time of the module in microseconds and the cumulative time of each of its direct imports."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+    # nested imports are listed before the module that imported them, one level deeper
+    children = {}
+    for line in result.stderr.splitlines():
+        match = LINE.match(line)
+        if not match:
+            continue
+        cumulative, depth, name = int(match.group(2)), (len(match.group(3)) + 1) // 2, match.group(4)
+        if depth == 2:
+            children[name] = cumulative
+        elif depth == 1:
+            if name == module:
+                return cumulative, children
+            children = {}
+    raise RuntimeError(f"No import time reported for {module}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--module', default='app')
+    parser.add_argument('--max-ms', type=float, default=1000, help="fail when the import takes longer")
+    parser.add_argument('--top', type=int, default=15, help="slowest imports to list")
+    parser.add_argument('--repeat', type=int, default=3, help="runs to take the fastest of")
+    args = parser.parse_args()
+
+    runs = [measure(args.module) for _ in range(args.repeat)]
+    total, imports = min(runs, key=lambda run: run[0])
+    print(f"import {args.module}: {total / 1000:.0f}ms (fastest of {args.repeat}, budget {args.max_ms:.0f}ms)")
+    for name, cumulative in sorted(imports.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"  {cumulative / 1000:8.1f}ms  {name}")
+
+    if total / 1000 > args.max_ms:
+        print(f"Import time is over the budget of {args.max_ms:.0f}ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
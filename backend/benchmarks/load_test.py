@@ -0,0 +1,221 @@
+# Load test for one worker: opens concurrent websocket sessions against the Quart app through its
+# test client and drives each through solve_task, follow_up and run_program commands. The LLM and
+# the sandbox are replaced by fakes, so the numbers measure the app itself (broker, session backend,
+# agent bookkeeping) and not model or program latency.
+# Sessions, uploads and outputs are written to a temporary directory. Run from the `backend` directory:
+#   python -m benchmarks.load_test [--sessions 50] [--concurrency 20] [--token-rate 50] [--output-kib 64]
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import shutil
+import tempfile
+import time
+import uuid
+from metrics import Histogram
+
+CANNED_RESPONSE = """I will load the data, compute the statistics and save them to the output directory.
+
+```python
+import os
+
+def main():
+    os.makedirs("pred_results", exist_ok=True)
+    with open("pred_results/result.txt", "w") as f:
+        f.write("42")
+
+if __name__ == "__main__":
+    main()
+```
+"""
+
+
+class FakeLLMEngine:
+    """Streams a canned response at a fixed token rate."""
+
+    def __init__(self, token_rate: float, first_token_delay: float):
+        self.llm_engine_name = "fake"
+        self.token_rate = token_rate
+        self.first_token_delay = first_token_delay
+
+    async def respond_stream(self, messages, temperature=0.2, top_p=0.95):
+        await asyncio.sleep(self.first_token_delay)
+        tokens = CANNED_RESPONSE.split(' ')
+        for i, token in enumerate(tokens):
+            yield (token if i == 0 else ' ' + token), None
+            await asyncio.sleep(1 / self.token_rate)
+        yield '', {'prompt_tokens': sum(len(m['content']) // 4 for m in messages), 'completion_tokens': len(tokens),
+                   'cache_read_tokens': 0, 'cache_write_tokens': 0}
+
+    def get_cost(self, prompt_tokens, completion_tokens, cache_read_tokens=0, cache_write_tokens=0):
+        return 0.0
+
+    async def acount_tokens(self, text: str):
+        return len(text) // 4
+
+    async def atruncate_text(self, text: str, max_tokens: int):
+        if len(text) // 4 <= max_tokens:
+            return text, False
+        return text[:max_tokens * 4], True
+
+
+def make_fake_container(container_class, output_kib: float, duration: float):
+    class FakeContainer(container_class):
+        """Streams synthetic program output instead of running commands in Docker."""
+
+        async def start(self):
+            self.is_running = True
+
+        async def stop(self):
+            self.is_running = False
+
+        async def run_command(self, command: list, timeout: int = None, message_tag: str = None):
+            from broker import broker
+            await broker.publish(self.agent_session.id, {"type": "execution_start", "command": command, "tag": message_tag, "start_time": int(time.time())})
+            if message_tag != "run":
+                # dependency checks and installs: nothing is missing
+                output = "MISSING:\n"
+            else:
+                line = "x" * 79 + "\n"
+                lines = max(1, int(output_kib * 1024 / len(line)))
+                chunks = max(1, int(duration / 0.05))
+                output = ''
+                for i in range(chunks):
+                    text = line * (lines // chunks + (1 if i < lines % chunks else 0))
+                    output += text
+                    await broker.publish(self.agent_session.id, {"type": "execution_chunk", "output": text, "tag": message_tag})
+                    await asyncio.sleep(duration / chunks)
+                os.makedirs(os.path.join(self.get_eval_dir(), "pred_results"), exist_ok=True)
+                with open(os.path.join(self.get_eval_dir(), "pred_results", "result.txt"), "w") as f:
+                    f.write("42")
+            await self.agent_session.add_execution_log({'start_time': int(time.time()), 'end_time': int(time.time()), 'command': command,
+                                                        'output': output, 'exit_code': 0, 'tag': message_tag})
+            await broker.publish(self.agent_session.id, {"type": "execution_end", "exit_code": 0, "tag": message_tag, "end_time": int(time.time())})
+            return output, 0
+
+    return FakeContainer
+
+
+def rss_mib():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run_session(client, agent_session_class, args, delivery_latency: Histogram, open_sessions: list):
+    agent_session_id = await agent_session_class.create({'task_instruction': "Compute the answer and save it to pred_results/result.txt"})
+    code_ids = []
+
+    async def _command(ws, command: str, **data):
+        command_id = str(uuid.uuid4())
+        await ws.send(json.dumps({'command': command, 'command_id': command_id, **data}))
+        while True:
+            message = json.loads(await asyncio.wait_for(ws.receive(), timeout=args.command_timeout))
+            kind = message.get('type', 'result') # command results have no type
+            if 'published_at' in message:
+                delivery_latency.observe(time.perf_counter() - message['published_at'], type=kind)
+            if kind == 'code_file':
+                code_ids.append(message['code_file']['id'])
+            if message.get('command_id') == command_id and kind != 'timing':
+                if kind == 'error':
+                    raise RuntimeError(f"{command} failed: {message['message']}")
+                return message
+
+    async with client.websocket(f"/api/execution/ws/{agent_session_id}") as ws:
+        json.loads(await ws.receive()) # initial state
+        open_sessions[0] += 1
+        open_sessions[1] = max(open_sessions[1], open_sessions[0])
+        try:
+            await _command(ws, 'solve_task', use_self_debug=True)
+            for i in range(args.follow_ups):
+                await _command(ws, 'follow_up', message=f"Please also print the result ({i})", code_id=code_ids[-1] if code_ids else None)
+            for _ in range(args.runs):
+                if code_ids:
+                    await _command(ws, 'run_program', id=code_ids[-1])
+        finally:
+            open_sessions[0] -= 1
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=50, help="sessions to run in total")
+    parser.add_argument('--concurrency', type=int, default=20, help="sessions open at the same time")
+    parser.add_argument('--follow-ups', type=int, default=2, help="follow_up commands per session")
+    parser.add_argument('--runs', type=int, default=1, help="run_program commands per session")
+    parser.add_argument('--token-rate', type=float, default=50, help="fake LLM tokens per second")
+    parser.add_argument('--first-token-delay', type=float, default=0.5, help="fake LLM seconds to the first token")
+    parser.add_argument('--output-kib', type=float, default=64, help="program output per run")
+    parser.add_argument('--run-seconds', type=float, default=1, help="program duration per run")
+    parser.add_argument('--command-timeout', type=float, default=120)
+    args = parser.parse_args()
+
+    # the app uses relative paths for sessions and storage, keep them out of the working tree
+    work_dir = tempfile.mkdtemp(prefix="load-test-")
+    os.chdir(work_dir)
+    os.makedirs("agent_sessions")
+
+    import agent
+    import routes.execution
+    from agent_session import AgentSession
+    from app import app
+    from broker import broker
+
+    fake_llm = FakeLLMEngine(args.token_rate, args.first_token_delay)
+    routes.execution.get_llm_engine = lambda *a, **kw: fake_llm
+    fake_container = make_fake_container(routes.execution.Container, args.output_kib, args.run_seconds)
+    routes.execution.Container = fake_container
+    agent.Container = fake_container
+
+    # stamp events so clients can measure publish-to-receive latency
+    publish = broker.publish
+    async def _publish(agent_session_id, message):
+        await publish(agent_session_id, {**message, 'published_at': time.perf_counter()})
+    broker.publish = _publish
+
+    delivery_latency = Histogram('load_test_delivery_seconds', 'Publish to websocket receive latency', window=None)
+    client = app.test_client()
+    slots = asyncio.Semaphore(args.concurrency)
+    open_sessions = [0, 0] # current, peak
+    errors = []
+
+    async def _run():
+        async with slots:
+            try:
+                await run_session(client, AgentSession, args, delivery_latency, open_sessions)
+            except Exception as e:
+                errors.append(repr(e))
+
+    base_rss = rss_mib()
+    peak_rss = base_rss
+    async def _sample_memory():
+        nonlocal peak_rss
+        while True:
+            peak_rss = max(peak_rss, rss_mib())
+            await asyncio.sleep(0.2)
+    sampler = asyncio.create_task(_sample_memory())
+
+    start = time.perf_counter()
+    await asyncio.gather(*[_run() for _ in range(args.sessions)])
+    elapsed = time.perf_counter() - start
+    sampler.cancel()
+    os.chdir("/")
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    completed = args.sessions - len(errors)
+    print(f"{args.sessions} sessions ({args.concurrency} concurrent, peak {open_sessions[1]}) in {elapsed:.1f}s: "
+          f"{completed / elapsed:.2f} sessions/s, error rate {len(errors) / args.sessions:.1%}")
+    print(f"memory: {base_rss:.0f} MiB before, {peak_rss:.0f} MiB peak, "
+          f"{(peak_rss - base_rss) / max(1, open_sessions[1]):.2f} MiB per open session")
+    for row in sorted(delivery_latency.summary(), key=lambda r: -r['count']):
+        print(f"  {row['labels']['type']}: n={row['count']} p50={row['p50'] * 1000:.1f}ms "
+              f"p90={row['p90'] * 1000:.1f}ms p99={row['p99'] * 1000:.1f}ms")
+    for error in sorted(set(errors))[:10]:
+        print("error:", error)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,67 @@
+# Measures websocket frames and server CPU for streamed LLM deltas with and without coalescing.
+# Each simulated session streams deltas at a fixed rate to one subscriber that serializes
+# every message like the websocket handler does. Run from the `backend` directory:
+#   python -m benchmarks.stream_coalescing [--sessions 50] [--rate 100] [--seconds 5]
+
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from broker import broker
+from stream_coalescer import StreamCoalescer
+
+
+async def run(num_sessions, rate, seconds, window_ms):
+    frames = 0
+    frame_bytes = 0
+    send_time = 0
+
+    async def _subscriber(session_id):
+        nonlocal frames, frame_bytes, send_time
+        async for message in broker.subscribe(session_id):
+            start = time.perf_counter()
+            frames += 1
+            frame_bytes += len(json.dumps(message))
+            send_time += time.perf_counter() - start
+            if message['type'] == 'response_end':
+                break
+
+    async def _producer(session_id):
+        coalescer = StreamCoalescer(session_id, window_ms=window_ms)
+        response_id = str(uuid.uuid4())
+        interval = 1 / rate
+        for _ in range(int(rate * seconds)):
+            await coalescer.add(response_id, "token ")
+            await asyncio.sleep(interval)
+        await coalescer.flush()
+        await broker.publish(session_id, {'type': 'response_end', 'id': response_id})
+
+    session_ids = [str(uuid.uuid4()) for _ in range(num_sessions)]
+    subscribers = [asyncio.create_task(_subscriber(session_id)) for session_id in session_ids]
+    # let every subscriber register its queue before publishing starts
+    await asyncio.sleep(0)
+
+    start_cpu = time.process_time()
+    start_wall = time.perf_counter()
+    await asyncio.gather(*[_producer(session_id) for session_id in session_ids])
+    await asyncio.gather(*subscribers)
+    return frames, frame_bytes, send_time, time.process_time() - start_cpu, time.perf_counter() - start_wall
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sessions', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=100, help="deltas per second per session")
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--window-ms', type=float, default=30)
+    args = parser.parse_args()
+
+    for label, window_ms in [("uncoalesced", 0), (f"coalesced ({args.window_ms:g} ms)", args.window_ms)]:
+        frames, frame_bytes, send_time, cpu, wall = await run(args.sessions, args.rate, args.seconds, window_ms)
+        print(f"{label}: {frames} frames ({frames / wall:.0f}/s), {frame_bytes / 1024:.0f} KiB, "
+              f"serialization {send_time * 1000:.1f} ms, process CPU {cpu:.2f}s over {wall:.2f}s wall")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
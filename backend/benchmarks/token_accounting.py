@@ -0,0 +1,63 @@
+# Compares the CPU time spent on token accounting per generate() call before and after
+# incremental token counting. Run from the `backend` directory:
+#   python -m benchmarks.token_accounting [--model MODEL] [--traceback-mb 4]
+
+import argparse
+import asyncio
+import time
+import uuid
+from llm_engine import LLMEngine
+from history import assemble_history
+import config
+
+
+def make_traceback(size_bytes):
+    frame = '  File "/workspace/program-0.py", line 42, in <module>\n    result = model.fit(X, y)\n'
+    body = frame * (size_bytes // len(frame) + 1)
+    return "Traceback (most recent call last):\n" + body[:size_bytes] + "ValueError: shapes do not match\n"
+
+
+def make_history(num_turns, message_chars):
+    history = [{'role': 'user', 'content': 'x ' * (message_chars // 2), 'id': str(uuid.uuid4())}]
+    for _ in range(num_turns):
+        history.append({'role': 'assistant', 'content': 'def f():\n    pass\n' * (message_chars // 18), 'id': str(uuid.uuid4())})
+        history.append({'role': 'user', 'content': 'please fix the error', 'id': str(uuid.uuid4())})
+    return history
+
+
+def cpu_time(fn, repeat):
+    start = time.process_time()
+    for _ in range(repeat):
+        fn()
+    return (time.process_time() - start) / repeat
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', default=config.LLM_ENGINE_NAME)
+    parser.add_argument('--traceback-mb', type=float, default=4)
+    parser.add_argument('--turns', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    engine = LLMEngine(args.model)
+    err_msg = make_traceback(int(args.traceback_mb * 1024 * 1024))
+
+    old = cpu_time(lambda: engine.trim_messages([{'role': 'user', 'content': err_msg}], max_tokens=5000), args.repeat)
+    new = cpu_time(lambda: engine.truncate_text(err_msg, 5000), args.repeat)
+    print(f"error message ({args.traceback_mb} MB): trim_messages {old * 1000:.1f} ms, truncate_text {new * 1000:.1f} ms")
+
+    history = make_history(args.turns, 20_000)
+    old = cpu_time(lambda: engine.trim_messages([{'role': m['role'], 'content': m['content']} for m in history], max_tokens=58_000), args.repeat)
+
+    # the first call populates the per-message token counts, later calls reuse them
+    await assemble_history(engine, history, 58_000)
+    start = time.process_time()
+    for _ in range(args.repeat):
+        await assemble_history(engine, history, 58_000)
+    new = (time.process_time() - start) / args.repeat
+    print(f"history ({len(history)} messages): trim_messages {old * 1000:.1f} ms, assemble_history (cached) {new * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
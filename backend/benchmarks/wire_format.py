@@ -0,0 +1,90 @@
+# Measures bytes on the wire and server CPU per 1k websocket events for each wire format, with
+# and without the permessage-deflate extension browsers negotiate with Hypercorn (simulated with
+# the same zlib settings: raw deflate, shared context, sync flush per message). The event mix
+# resembles an execution-heavy session: mostly execution/response chunks with occasional
+# output_files and state messages. Run from the `backend` directory:
+#   python -m benchmarks.wire_format [--events 10000] [--state-kib 512]
+
+import argparse
+import json
+import random
+import time
+import uuid
+import zlib
+import wire_format
+from wire_format import WireFormat
+
+
+def make_state(size_kib):
+    history = []
+    while len(json.dumps(history)) < size_kib * 1024:
+        history.append({'id': str(uuid.uuid4()), 'role': 'assistant', 'tag': 'generate',
+                        'content': "Here is the program:\n```python\nimport pandas as pd\nprint(pd.read_csv('data.csv').describe())\n```\n" * 5})
+    return {'id': str(uuid.uuid4()), 'history': history, 'execution_log': [], 'code_files': [], 'output_files': []}
+
+
+def make_events(num_events, state_kib):
+    rng = random.Random(0)
+    state = make_state(state_kib)
+    output_files = [{'id': str(uuid.uuid4()), 'hash': uuid.uuid4().hex, 'filename': f'pred_results/figure_{i}.png',
+                     'size': rng.randint(1000, 100000), 'mimetype': 'image/png', 'code_data_id': str(uuid.uuid4()),
+                     'object_name': f'session/outputs/figure_{i}.png'} for i in range(200)]
+    events = []
+    for i in range(num_events):
+        roll = rng.random()
+        if roll < 0.001:
+            events.append({'type': 'state', 'state': state, 'has_default_llm': True, 'seq': i})
+        elif roll < 0.01:
+            events.append({'type': 'output_files', 'files': output_files, 'seq': i})
+        elif roll < 0.7:
+            events.append({'type': 'execution_chunk', 'output': f"epoch {i}: loss={rng.random():.6f} acc={rng.random():.4f}\n", 'tag': 'run', 'seq': i})
+        else:
+            events.append({'type': 'response_chunk', 'text': ' token' * rng.randint(1, 8), 'id': str(uuid.uuid4()), 'seq': i})
+    return events
+
+
+def permessage_deflate(encode):
+    """Wraps an encoder to return what RFC 7692 puts on the wire with context takeover."""
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    def _encode(message):
+        frame = encode(message)
+        if isinstance(frame, str):
+            frame = frame.encode('utf-8')
+        return (compressor.compress(frame) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+    return _encode
+
+
+def measure(encode, events):
+    start = time.process_time()
+    total = sum(len(frame) for frame in map(encode, events))
+    return total, time.process_time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=10000)
+    parser.add_argument('--state-kib', type=int, default=512, help="size of the session in state messages")
+    args = parser.parse_args()
+
+    events = make_events(args.events, args.state_kib)
+    formats = [("json (stdlib)", lambda message: json.dumps(message))]
+    if wire_format.orjson is not None:
+        formats.append(("json (orjson)", WireFormat().encode))
+    formats.append(("json + permessage-deflate", permessage_deflate(WireFormat().encode)))
+    if wire_format.msgpack is not None:
+        formats.append(("msgpack", WireFormat('msgpack').encode))
+        formats.append(("msgpack + permessage-deflate", permessage_deflate(WireFormat('msgpack').encode)))
+    else:
+        print("msgpack is not installed, skipping it")
+
+    baseline = None
+    for label, encode in formats:
+        total, cpu = measure(encode, events)
+        baseline = baseline or total
+        print(f"{label}: {total / len(events) * 1000 / 1024:.0f} KiB per 1k events ({total / baseline:.0%}), "
+              f"{cpu / len(events) * 1000 * 1000:.1f} ms CPU per 1k events")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,543 @@
+from collections import OrderedDict, deque
+from metrics import broker_queue_depth, broker_overflows
 import asyncio
+import hashlib
+import json
+import time
+import uuid
+import config
+
+# fields that are concatenated when queued chunks of the same stream are merged
+CHUNK_TEXT_FIELDS = {
+    'execution_chunk': ('tag', 'output'),
+    'response_chunk': ('id', 'text'),
+}
+# chunks that may be dropped when a subscriber falls behind, response text is only ever merged
+DROPPABLE_CHUNKS = {'execution_chunk'}
+
+
+def chunk_key(message: dict):
+    fields = CHUNK_TEXT_FIELDS.get(message.get('type'))
+    if fields is None:
+        return None
+    return message['type'], message.get(fields[0])
+
+
+def merge_chunks(first: dict, second: dict):
+    text_field = CHUNK_TEXT_FIELDS[first['type']][1]
+    # queued messages are shared between subscribers, so never modify them in place
+    merged = {**first, text_field: first[text_field] + second[text_field]}
+    if 'seq' in second:
+        merged['seq'] = second['seq']
+    return merged
+
+
+def session_label(agent_session_id: str):
+    """Identifies a session in metrics without exposing its id, which grants access to the session."""
+    return hashlib.sha256(agent_session_id.encode('utf-8')).hexdigest()[:12]
+
+
+def initial_seq():
+    # sequence numbers start at the current time in ms, so they keep increasing when a session's
+    # event log is lost (restart, eviction, expiry) and stale `since` values are detected as a gap
+    return time.time_ns() // 1_000_000
+
+
+def resume_messages(latest_seq: int, log: list, since: int):
+    """Returns the messages a subscriber resuming after `since` needs and the last seq they cover.
+
+    The first message is a `resume` marker followed by the missed events, or a `resync` marker
+    when some of them are no longer in the log and the client needs a full snapshot.
+    """
+    if since == latest_seq:
+        return [{'type': 'resume', 'seq': since}], since
+    if since > latest_seq or not log or log[0]['seq'] > since + 1:
+        return [{'type': 'resync', 'seq': latest_seq}], latest_seq
+    return [{'type': 'resume', 'seq': since}] + [m for m in log if m['seq'] > since], latest_seq
+
+
+def message_size(message: dict):
+    """Estimates the JSON size of a message for the event log bounds without serializing it.
+
+    Streamed chunks only hold short fields and their text, so their size is the length of the
+    strings plus a little per field. Nested values (state snapshots, file lists) are serialized,
+    they are rare compared to chunks.
+    """
+    size = 2
+    for key, value in message.items():
+        size += len(key) + 6
+        if isinstance(value, str):
+            size += len(value)
+        elif isinstance(value, (dict, list, tuple)):
+            size += len(json.dumps(value))
+        else:
+            size += 16
+    return size
+
+
+class EventLog:
+    """Assigns sequence numbers to a session's events and keeps the most recent ones.
+
+    At most `maxlen` events and `max_bytes` of them (as JSON) are kept, the oldest are dropped first.
+    """
+
+    def __init__(self, maxlen: int = None, max_bytes: int = None):
+        self.seq = initial_seq()
+        self.maxlen = config.BROKER_REPLAY_SIZE if maxlen is None else maxlen
+        self.max_bytes = config.BROKER_REPLAY_MAX_BYTES if max_bytes is None else max_bytes
+        self.messages = deque()
+        self.sizes = deque()
+        self.bytes = 0
+        self.used = time.monotonic()
+
+    def append(self, message: dict):
+        self.seq += 1
+        message = {**message, 'seq': self.seq}
+        size = message_size(message)
+        self.messages.append(message)
+        self.sizes.append(size)
+        self.bytes += size
+        while len(self.messages) > self.maxlen or (self.bytes > self.max_bytes and len(self.messages) > 1):
+            self.messages.popleft()
+            self.bytes -= self.sizes.popleft()
+        return message
+
+
+class SubscriberDisconnected(Exception):
+    pass
+
+
+class Subscription:
+    """Bounded message queue of a single subscriber.
+
+    put() never blocks. Once maxsize messages are queued the overflow policy decides what
+    happens: 'coalesce' merges adjacent output chunks of the same stream, 'drop' discards
+    execution output chunks, 'disconnect' closes the subscription. Response chunks are merged
+    with the queued chunk of the same response under any policy but never dropped, and other
+    messages (state changes, execution_end, errors...) are never dropped either: older
+    execution output chunks are evicted to make room, if there are none the queue grows.
+    """
+
+    def __init__(self, agent_session_id: str, maxsize: int = None, policy: str = None):
+        self.agent_session_id = agent_session_id
+        self.label = session_label(agent_session_id)
+        self.maxsize = config.BROKER_QUEUE_SIZE if maxsize is None else maxsize
+        self.policy = config.BROKER_OVERFLOW_POLICY if policy is None else policy
+        self.messages = deque()
+        self.event = asyncio.Event()
+        self.closed = False
+        self.compacted = False # the queue was compacted since the last get() and is still full
+        self.last_seq = 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def put(self, message: dict):
+        if self.closed:
+            return
+        seq = message.get('seq')
+        if seq is not None:
+            if seq <= self.last_seq:
+                return # already delivered by a replay
+            self.last_seq = seq
+        if len(self.messages) < self.maxsize:
+            self.messages.append(message)
+        else:
+            self._overflow(message)
+        self.event.set()
+
+    def replay(self, messages: list, last_seq: int):
+        """Queues messages ahead of the live ones, dropping live messages the replay already covers."""
+        live = [m for m in self.messages if m.get('seq', last_seq + 1) > last_seq]
+        self.messages = deque(messages + live)
+        self.last_seq = max(self.last_seq, last_seq)
+        self.event.set()
+
+    def _overflow(self, message: dict):
+        if self.policy == 'disconnect':
+            print(f"Disconnecting slow subscriber of session {self.agent_session_id}: {len(self.messages)} messages queued")
+            broker_overflows.inc(policy=self.policy, action='disconnected')
+            self.closed = True
+            self.messages.clear()
+            return
+
+        key = chunk_key(message)
+        if key is not None and chunk_key(self.messages[-1]) == key and (self.policy == 'coalesce' or key[0] not in DROPPABLE_CHUNKS):
+            self.messages[-1] = merge_chunks(self.messages[-1], message)
+            broker_overflows.inc(policy=self.policy, action='merged')
+            return
+        if self.policy == 'coalesce' and not self.compacted:
+            self._compact()
+            if len(self.messages) < self.maxsize:
+                self.messages.append(message)
+                return
+
+        if key is not None and key[0] in DROPPABLE_CHUNKS:
+            broker_overflows.inc(policy=self.policy, action='dropped')
+            return
+        for i, queued in enumerate(self.messages):
+            if queued.get('type') in DROPPABLE_CHUNKS:
+                del self.messages[i]
+                broker_overflows.inc(policy=self.policy, action='dropped')
+                break
+        self.messages.append(message)
+
+    def _compact(self):
+        compacted = deque()
+        for message in self.messages:
+            key = chunk_key(message)
+            if key is not None and compacted and chunk_key(compacted[-1]) == key:
+                compacted[-1] = merge_chunks(compacted[-1], message)
+            else:
+                compacted.append(message)
+        broker_overflows.inc(len(self.messages) - len(compacted), policy=self.policy, action='merged')
+        self.messages = compacted
+        self.compacted = len(self.messages) >= self.maxsize
+
+    async def get(self):
+        while not self.messages:
+            if self.closed:
+                raise SubscriberDisconnected()
+            self.event.clear()
+            await self.event.wait()
+        if self.closed:
+            raise SubscriberDisconnected()
+        self.compacted = False
+        return self.messages.popleft()
+
+
+def fan_out(agent_session_id: str, subscriptions: list, message: dict):
+    if not subscriptions:
+        return
+    depth = 0
+    for subscription in subscriptions:
+        subscription.put(message)
+        depth = max(depth, len(subscription))
+    broker_queue_depth.set(depth, session=subscriptions[0].label)
+
+
+async def iterate(subscription: Subscription):
+    try:
+        while True:
+            yield await subscription.get()
+    except SubscriberDisconnected:
+        return
+
 
 # A simple in-memory broker
 class LocalBroker:
+    """Keeps the event logs of up to BROKER_REPLAY_MAX_SESSIONS sessions and BROKER_REPLAY_MAX_TOTAL_BYTES.
+
+    The least recently used logs are evicted first and logs unused for BROKER_REPLAY_TTL seconds
+    are evicted too, except those of sessions with live subscribers.
+    """
+
     def __init__(self):
         self.connections = {}
+        self.logs = OrderedDict() # least recently used first
+        self.bytes = 0
+        self.next_expiry = 0
+
+    def _log(self, agent_session_id: str):
+        now = time.monotonic()
+        if now >= self.next_expiry:
+            self.next_expiry = now + 1
+            self._expire(now)
+
+        log = self.logs.get(agent_session_id)
+        if log is not None:
+            log.used = now
+            self.logs.move_to_end(agent_session_id)
+            return log
+
+        log = self.logs[agent_session_id] = EventLog()
+        self._evict()
+        return log
+
+    def _remove_log(self, agent_session_id: str):
+        self.bytes -= self.logs.pop(agent_session_id).bytes
+
+    def _expire(self, now: float):
+        idle = []
+        for id, log in self.logs.items():
+            if now - log.used < config.BROKER_REPLAY_TTL:
+                break
+            if id not in self.connections:
+                idle.append(id)
+        for id in idle:
+            self._remove_log(id)
+
+    def _evict(self):
+        while len(self.logs) > config.BROKER_REPLAY_MAX_SESSIONS or self.bytes > config.BROKER_REPLAY_MAX_TOTAL_BYTES:
+            evicted = next((id for id in self.logs if id not in self.connections), None)
+            if evicted is None:
+                break
+            self._remove_log(evicted)
+
+    async def latest_seq(self, agent_session_id: str):
+        return self._log(agent_session_id).seq
 
     async def publish(self, agent_session_id: str, message: dict):
-        for queue in self.connections.get(agent_session_id, []):
-            await queue.put(message)
+        log = self._log(agent_session_id)
+        size = log.bytes
+        message = log.append(message)
+        self.bytes += log.bytes - size
+        if self.bytes > config.BROKER_REPLAY_MAX_TOTAL_BYTES:
+            self._evict()
+        fan_out(agent_session_id, self.connections.get(agent_session_id, []), message)
 
-    async def subscribe(self, agent_session_id: str):
-        queue = asyncio.Queue()
-        self.connections.setdefault(agent_session_id, []).append(queue)
+    async def subscribe(self, agent_session_id: str, since: int = None):
+        subscription = Subscription(agent_session_id)
+        self.connections.setdefault(agent_session_id, []).append(subscription)
+        if since is not None:
+            log = self._log(agent_session_id)
+            subscription.replay(*resume_messages(log.seq, list(log.messages), since))
         try:
-            while True:
-                yield await queue.get()
+            async for message in iterate(subscription):
+                yield message
         finally:
-            self.connections[agent_session_id].remove(queue)
+            self.connections[agent_session_id].remove(subscription)
+            if not self.connections[agent_session_id]:
+                del self.connections[agent_session_id]
+                broker_queue_depth.remove(session=subscription.label)
+
+    async def close(self):
+        pass
+
+# attempts at a batch that fails with something other than a connection error before it is dropped
+PUBLISH_ATTEMPTS = 3
+
+# Assigns the next sequence number of a session, embeds it in the message, appends the message to
+# the session's event log and publishes it, all atomically.
+# KEYS: seq key, log key, publishers key, log bytes key; ARGV: message json, initial seq, log size,
+# ttl seconds, channel, publisher id, message number, log max bytes
+PUBLISH_SCRIPT = """
+-- KEYS[3] holds the last message number applied per publishing process, so a batch that is
+-- retried after a partial failure does not publish its applied messages again under new seqs
+if tonumber(ARGV[7]) <= tonumber(redis.call('HGET', KEYS[3], ARGV[6]) or '0') then
+    return 0
+end
+redis.call('HSET', KEYS[3], ARGV[6], ARGV[7])
+redis.call('EXPIRE', KEYS[3], ARGV[4])
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    redis.call('SET', KEYS[1], ARGV[2])
+end
+local seq = string.format('%d', redis.call('INCR', KEYS[1]))
+local data
+if ARGV[1] == '{}' then
+    data = '{"seq": ' .. seq .. '}'
+else
+    data = '{"seq": ' .. seq .. ', ' .. string.sub(ARGV[1], 2)
+end
+local length = redis.call('RPUSH', KEYS[2], data)
+local size = redis.call('INCRBY', KEYS[4], string.len(data))
+while length > 1 and (length > tonumber(ARGV[3]) or size > tonumber(ARGV[8])) do
+    size = redis.call('DECRBY', KEYS[4], string.len(redis.call('LPOP', KEYS[2])))
+    length = length - 1
+end
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+redis.call('EXPIRE', KEYS[4], ARGV[4])
+redis.call('PUBLISH', ARGV[5], data)
+return seq
+"""
 
 # To support multiple websocket connections to the same session across multiple processes/servers,
 # a pub/sub system like ElastiCache/Redis is needed
 class RedisBroker:
-    pass
-        
-broker = LocalBroker()
+    """Redis pub/sub broker with the same interface as LocalBroker.
+
+    Publishes are queued locally and sent by a single background task that pipelines up to
+    batch_size publishes per round trip, preserving publish order. Each publish runs a script
+    that sequences the message and appends it to the session's event log. Messages are numbered
+    per process, so the script skips the ones a failed batch already applied when it is retried.
+    While Redis is unreachable at most BROKER_PUBLISH_QUEUE_SIZE messages wait, the oldest are dropped. Each process holds one
+    pub/sub connection subscribed to the channels of its local subscribers and fans incoming
+    messages out to their queues. Both sides reconnect with backoff if the connection drops.
+    A client (e.g. fakeredis) can be passed in instead of a URL for testing.
+    """
+
+    def __init__(self, url: str = None, client=None, channel_prefix='science-agent:session:', batch_size=256, max_retry_delay=5.0):
+        import redis.asyncio as redis
+        from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+        if client is None:
+            client = redis.from_url(url)
+        self.client = client
+        self.connection_errors = (RedisConnectionError, RedisTimeoutError, OSError)
+        self.channel_prefix = channel_prefix
+        self.batch_size = batch_size
+        self.max_retry_delay = max_retry_delay
+
+        self.connections = {}
+        self.pending = deque()
+        self.pending_event = None
+        self.publisher_id = uuid.uuid4().hex
+        self.published = 0
+        self.publisher_task = None
+        self.pubsub = None
+        self.reader_task = None
+        self.pubsub_lock = None
+        self.publish_script = client.register_script(PUBLISH_SCRIPT)
+
+    def _channel(self, agent_session_id: str):
+        return self.channel_prefix + agent_session_id
+
+    def _keys(self, agent_session_id: str):
+        return [self._channel(agent_session_id) + ':seq', self._channel(agent_session_id) + ':events']
+
+    def _publisher_key(self, agent_session_id: str):
+        return self._channel(agent_session_id) + ':publishers'
+
+    async def latest_seq(self, agent_session_id: str):
+        seq = await self.client.get(self._keys(agent_session_id)[0])
+        return int(seq) if seq is not None else 0
+
+    async def _read_log(self, agent_session_id: str):
+        seq_key, log_key = self._keys(agent_session_id)
+        pipe = self.client.pipeline(transaction=True)
+        pipe.get(seq_key)
+        pipe.lrange(log_key, 0, -1)
+        seq, log = await pipe.execute()
+        return int(seq) if seq is not None else 0, [json.loads(data) for data in log]
+
+    def _ensure_started(self):
+        if self.pending_event is None:
+            self.pending_event = asyncio.Event()
+            self.pubsub_lock = asyncio.Lock()
+        if self.publisher_task is None or self.publisher_task.done():
+            self.publisher_task = asyncio.create_task(self._publish_loop(), name="redis-broker-publisher")
+
+    async def publish(self, agent_session_id: str, message: dict):
+        self._ensure_started()
+        if len(self.pending) >= config.BROKER_PUBLISH_QUEUE_SIZE:
+            self.pending.popleft()
+            broker_overflows.inc(policy='redis_publish', action='dropped')
+        self.published += 1
+        self.pending.append((agent_session_id, self.published, json.dumps(message)))
+        self.pending_event.set()
+
+    async def _send(self, batch: list):
+        pipe = self.client.pipeline(transaction=False)
+        for agent_session_id, number, data in batch:
+            await self.publish_script(
+                keys=self._keys(agent_session_id) + [self._publisher_key(agent_session_id), self._channel(agent_session_id) + ':bytes'],
+                args=[data, initial_seq(), config.BROKER_REPLAY_SIZE, config.BROKER_REPLAY_TTL, self._channel(agent_session_id),
+                      self.publisher_id, number, config.BROKER_REPLAY_MAX_BYTES],
+                client=pipe)
+        results = await pipe.execute(raise_on_error=False)
+        for (agent_session_id, _, data), result in zip(batch, results):
+            if isinstance(result, self.connection_errors):
+                raise result
+            if isinstance(result, Exception):
+                print(f"Redis publish to session {agent_session_id} failed, dropping the message:", result, data[:200])
+
+    async def _publish_loop(self):
+        retry_delay = 0.1
+        failures = 0
+        batch = []
+        while True:
+            if not batch and not self.pending:
+                await self.pending_event.wait()
+                self.pending_event.clear()
+                continue
+            if not batch:
+                batch = [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+            try:
+                await self._send(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                failures += 1
+                if not isinstance(e, self.connection_errors) and failures >= PUBLISH_ATTEMPTS:
+                    print(f"Redis publish failed {failures} times, dropping {len(batch)} messages:", repr(e))
+                    broker_overflows.inc(len(batch), policy='redis_publish', action='dropped')
+                    batch, failures = [], 0
+                    continue
+                print(f"Redis publish failed, retrying in {retry_delay:.1f}s:", repr(e))
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(self.max_retry_delay, retry_delay * 2)
+                continue
+            retry_delay = 0.1
+            failures = 0
+            batch = []
+
+    async def _connect_pubsub(self):
+        self.pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        channels = [self._channel(session_id) for session_id in self.connections]
+        if channels:
+            await self.pubsub.subscribe(*channels)
+
+    async def _read_loop(self):
+        retry_delay = 0.1
+        while self.connections:
+            try:
+                if self.pubsub is None:
+                    async with self.pubsub_lock:
+                        await self._connect_pubsub()
+                message = await self.pubsub.get_message(timeout=1.0)
+                retry_delay = 0.1
+            except self.connection_errors as e:
+                print(f"Redis subscription failed, reconnecting in {retry_delay:.1f}s:", e)
+                self.pubsub = None
+                await asyncio.sleep(retry_delay)
+                retry_delay = min(self.max_retry_delay, retry_delay * 2)
+                continue
+
+            if message is None or message.get('type') != 'message':
+                continue
+            channel = message['channel']
+            if isinstance(channel, bytes):
+                channel = channel.decode('utf-8')
+            agent_session_id = channel[len(self.channel_prefix):]
+            fan_out(agent_session_id, self.connections.get(agent_session_id, []), json.loads(message['data']))
+        self.reader_task = None
+
+    async def subscribe(self, agent_session_id: str, since: int = None):
+        self._ensure_started()
+        subscription = Subscription(agent_session_id)
+        is_new_channel = agent_session_id not in self.connections
+        self.connections.setdefault(agent_session_id, []).append(subscription)
+        try:
+            # subscribe to the channel before reading the log, so no event falls in between
+            async with self.pubsub_lock:
+                try:
+                    if self.pubsub is None:
+                        await self._connect_pubsub()
+                    elif is_new_channel:
+                        await self.pubsub.subscribe(self._channel(agent_session_id))
+                except self.connection_errors as e:
+                    print("Redis subscribe failed, the reader will retry:", e)
+                    self.pubsub = None
+            if self.reader_task is None or self.reader_task.done():
+                self.reader_task = asyncio.create_task(self._read_loop(), name="redis-broker-reader")
+            if since is not None:
+                subscription.replay(*resume_messages(*await self._read_log(agent_session_id), since))
+
+            async for message in iterate(subscription):
+                yield message
+        finally:
+            self.connections[agent_session_id].remove(subscription)
+            if not self.connections[agent_session_id]:
+                del self.connections[agent_session_id]
+                broker_queue_depth.remove(session=subscription.label)
+                if self.pubsub is not None:
+                    try:
+                        await self.pubsub.unsubscribe(self._channel(agent_session_id))
+                    except Exception as e:
+                        print("Redis unsubscribe failed:", e)
+
+    async def close(self):
+        for task in [self.publisher_task, self.reader_task]:
+            if task is not None:
+                task.cancel()
+        if self.pubsub is not None:
+            await self.pubsub.aclose()
+        await self.client.aclose()
+
+
+if config.BROKER_BACKEND == "redis":
+    broker = RedisBroker(config.REDIS_URL)
+elif config.BROKER_BACKEND == "local":
+    broker = LocalBroker()
+else:
+    raise ValueError(f"Unsupported BROKER_BACKEND: {config.BROKER_BACKEND}")
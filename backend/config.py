@@ -3,6 +3,18 @@
 STORAGE_BACKEND = 'filesystem'  # Options: 's3', 'filesystem'
 STORAGE_DIR = 'file_storage' # for 'filesystem' storage
 S3_BUCKET = 'science-agent-interface' # for 's3' storage
+MAX_CONCURRENT_UPLOADS = 8 # storage transfers in flight per output collection, archive extraction or uploads sync
+
+BROKER_BACKEND = 'local' # Options: 'local' (single process), 'redis' (multiple workers/servers)
+REDIS_URL = 'redis://localhost:6379/0' # for 'redis' broker
+BROKER_QUEUE_SIZE = 1000 # messages buffered per websocket subscriber before the overflow policy applies
+BROKER_REPLAY_SIZE = 1000 # recent events kept per session so reconnecting websockets can resume with ?since=<seq>
+BROKER_REPLAY_MAX_BYTES = 1024 * 1024 # size of the events kept per session, as JSON
+BROKER_REPLAY_MAX_SESSIONS = 1000 # sessions whose event logs are kept by the 'local' broker
+BROKER_REPLAY_MAX_TOTAL_BYTES = 256 * 1024 * 1024 # size of all event logs kept by the 'local' broker
+BROKER_REPLAY_TTL = 3600 # seconds an idle session's event log is kept
+BROKER_PUBLISH_QUEUE_SIZE = 100000 # messages waiting to be sent by the 'redis' broker, the oldest are dropped while Redis is unreachable
+BROKER_OVERFLOW_POLICY = 'coalesce' # Options: 'coalesce' (merge queued output chunks, then drop execution output chunks), 'drop' (drop execution output chunks), 'disconnect' (close the slow subscriber)
 
 AGENT_SESSION_BACKEND = 'filesystem'  # Options: 'dynamodb', 'filesystem'
 AGENT_SESSION_TABLE_NAME = 'science-agent-interface-sessions'
@@ -10,4 +22,31 @@ AWS_REGION = 'us-east-2'
 
 LLM_REGION_NAME = 'us-west-2' # Region for LMM provider (e.g. AWS Bedrock)
 LLM_ENGINE_NAME = 'bedrock/anthropic.claude-3-5-haiku-20241022-v1:0' # any litellm compatible model name
-LLM_BASE_URL = None  # Derived from LLM_ENGINE_NAME if not provided
\ No newline at end of file
+LLM_BASE_URL = None  # Derived from LLM_ENGINE_NAME if not provided
+LLM_FALLBACK_ENGINES = [] # engine names tried in order if the default engine fails before responding
+LLM_FIRST_TOKEN_TIMEOUT = 60 # seconds to wait for the first streamed token
+LLM_REQUEST_TIMEOUT = 600 # seconds for a whole response
+LLM_MAX_RETRIES = 3 # retries per engine on throttling, timeouts and provider errors
+LLM_RETRY_BASE_DELAY = 1.0 # seconds, doubled on every retry with full jitter
+LLM_RATE_LIMITS = {} # engine name -> {'rpm': requests/min, 'tpm': tokens/min, 'concurrency': requests in flight} for the server's credentials, per worker
+LLM_HEDGE_AFTER_MS = None # send a second request if the first token has not arrived after this many ms
+LLM_PROMPT_CACHING = True # Mark the stable prompt prefix as cacheable for providers that need explicit breakpoints (e.g. Anthropic, Bedrock)
+
+STREAM_COALESCE_WINDOW_MS = 30 # batch streamed LLM deltas for this long before sending them to clients (0 disables)
+STREAM_COALESCE_MAX_BYTES = 1024 # send a batch early once it holds this much text
+
+STATE_HISTORY_LIMIT = 50 # history messages sent in a compact initial state (?state=compact), older ones are paged in
+STATE_EXECUTION_LOG_LIMIT = 20 # execution log entries sent in a compact initial state
+
+EVALUATION_CONCURRENCY = 2 # evaluation scripts run at the same time, further jobs wait in a queue
+EVALUATION_TIMEOUT = 1800 # seconds before an evaluation script is killed
+
+LOOP_LAG_THRESHOLD = 0.5 # seconds the event loop may be blocked before the blocking stack is logged (None disables)
+LOOP_LAG_INTERVAL = 0.1 # seconds between event loop heartbeats
+PROFILE_MAX_SECONDS = 120 # longest profile /api/admin/profile will capture (requires the ADMIN_TOKEN env variable)
+
+MAX_CANDIDATES = 4 # upper bound on the number of candidate programs a client may request for solve_task
+
+LLM_CACHE_MODE = None  # Options: None (disabled), 'record' (replay hits, store misses), 'replay' (hits only, fail on a miss)
+LLM_CACHE_DIR = 'llm_cache'
+LLM_CACHE_MAX_BYTES = 1024 * 1024 * 1024
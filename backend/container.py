@@ -2,42 +2,60 @@ from typing import Optional
 import os
 import time
 import sys
-import aiodocker
 import asyncio
 from aioshutil import rmtree, sync_to_async
 from typing import Optional
 from broker import broker
 from agent_session import AgentSession
+from metrics import Timer, phase_latency
 
 SESSION_DIR = './agent_sessions'
 PIP_CACHE_DIR = './agent_sessions/pip_cache'
 
-docker: aiodocker.Docker = None
+docker = None
 
 def initialize_docker():
     global docker
     if docker is None:
+        import aiodocker # deferred, it is slow to import and only needed once a container starts
         docker = aiodocker.Docker()
     return docker
 
 class Container:
-    def __init__(self, agent_session: AgentSession):
+    def __init__(self, agent_session: AgentSession, workspace: Optional[str] = None):
         self.container = None
         self.is_running = False
         self.agent_session = agent_session
+        # additional workspaces (e.g. for parallel candidate programs) get their own eval
+        # directory and container but share the session's uploads directory
+        self.workspace = workspace
+        # execution log entries held back by defer_logs()
+        self.deferred_logs = None
+
+    def get_name(self):
+        if self.workspace:
+            return f"science-agent-{self.agent_session.id}-{self.workspace}"
+        return f"science-agent-{self.agent_session.id}"
 
     def get_session_dir(self):
         return os.path.join(SESSION_DIR, self.agent_session.id)
 
     def get_eval_dir(self):
+        if self.workspace:
+            return os.path.join(SESSION_DIR, self.agent_session.id, f'eval-{self.workspace}')
         return os.path.join(SESSION_DIR, self.agent_session.id, 'eval')
 
     def get_output_cache_dir(self):
+        if self.workspace:
+            return os.path.join(SESSION_DIR, self.agent_session.id, f'pred_results-{self.workspace}')
         return os.path.join(SESSION_DIR, self.agent_session.id, 'pred_results')
 
     def get_uploads_dir(self):
         return os.path.join(SESSION_DIR, self.agent_session.id, 'uploads')
 
+    def get_sync_manifest_path(self):
+        return os.path.join(SESSION_DIR, self.agent_session.id, 'uploads_manifest.json')
+
     @sync_to_async
     def make_dirs(self):
         os.makedirs(self.get_session_dir(), exist_ok=True)
@@ -53,7 +71,8 @@ class Container:
         initialize_docker()
 
         if self.container:
-            await self.container.start()
+            with Timer(phase_latency, phase='container_start'):
+                await self.container.start()
             self.is_running = True
             return
 
@@ -75,11 +94,13 @@ class Container:
             "WorkingDir": "/workspace",
             "User": f"{uid}:{gid}"
         }
-        self.container = await docker.containers.create_or_replace(
-            name=f"science-agent-{self.agent_session.id}",
-            config=config,
-        )
-        await self.container.start()
+        with Timer(phase_latency, phase='container_create'):
+            self.container = await docker.containers.create_or_replace(
+                name=self.get_name(),
+                config=config,
+            )
+        with Timer(phase_latency, phase='container_start'):
+            await self.container.start()
         self.is_running = True
 
     async def destroy(self):
@@ -88,8 +109,13 @@ class Container:
             await self.container.stop()
             await self.container.delete()
 
-        print("Removing temp session data for", self.agent_session.id)
-        await rmtree(self.get_uploads_dir(), ignore_errors=True)
+        print("Removing temp session data for", self.agent_session.id, self.workspace or '')
+        if not self.workspace:
+            await rmtree(self.get_uploads_dir(), ignore_errors=True)
+            try:
+                os.remove(self.get_sync_manifest_path())
+            except FileNotFoundError:
+                pass
         await rmtree(self.get_eval_dir(), ignore_errors=True)
         await rmtree(self.get_output_cache_dir(), ignore_errors=True)
 
@@ -100,6 +126,22 @@ class Container:
         await self.container.stop()
         self.is_running = False
 
+    def defer_logs(self):
+        """Holds back execution events and log entries until publish_deferred_logs() is called.
+
+        Used for candidate workspaces, whose output is only shown if the candidate is chosen.
+        """
+        self.deferred_logs = []
+
+    async def publish_deferred_logs(self):
+        entries, self.deferred_logs = self.deferred_logs or [], None
+        for entry in entries:
+            await broker.publish(self.agent_session.id, {"type": "execution_start", "command": entry['command'], "tag": entry['tag'], "start_time": entry['start_time']})
+            if entry['output']:
+                await broker.publish(self.agent_session.id, {"type": "execution_chunk", "output": entry['output'], "tag": entry['tag']})
+            await self.agent_session.add_execution_log(entry)
+            await broker.publish(self.agent_session.id, {"type": "execution_end", "exit_code": entry['exit_code'], "tag": entry['tag'], "end_time": entry['end_time']})
+
     async def run_command(self, command: list[str], timeout: int=None, message_tag: Optional[str]=None):
         await self.start()
 
@@ -113,7 +155,9 @@ class Container:
         stream = resp.start(detach=False, timeout=timeout)
 
         timestamp_start = int(time.time())
-        await broker.publish(self.agent_session.id, {"type": "execution_start", "command": command, "tag": message_tag, "start_time": timestamp_start})
+        deferred = self.deferred_logs is not None
+        if not deferred:
+            await broker.publish(self.agent_session.id, {"type": "execution_start", "command": command, "tag": message_tag, "start_time": timestamp_start})
 
         output = ''
         try:
@@ -124,7 +168,8 @@ class Container:
                 text = chunk[1].decode('utf-8')
                 print(text, end='')
                 output += text
-                await broker.publish(self.agent_session.id, {"type": "execution_chunk", "output": text, "tag": message_tag})
+                if not deferred:
+                    await broker.publish(self.agent_session.id, {"type": "execution_chunk", "output": text, "tag": message_tag})
             exit_code = (await resp.inspect())['ExitCode']
             print(f"Process exited with exit code {exit_code}")
         except asyncio.CancelledError:
@@ -133,16 +178,19 @@ class Container:
             raise
         finally:
             timestamp_end = int(time.time())
-            await self.agent_session.add_execution_log({
+            entry = {
                 'start_time': timestamp_start,
                 'end_time': timestamp_end,
                 'command': command,
                 'output': output,
                 'exit_code': exit_code,
                 'tag': message_tag,
-            })
-
-            await broker.publish(self.agent_session.id, {"type": "execution_end", "exit_code": exit_code, "tag": message_tag, "end_time": timestamp_end})
+            }
+            if deferred:
+                self.deferred_logs.append(entry)
+            else:
+                await self.agent_session.add_execution_log(entry)
+                await broker.publish(self.agent_session.id, {"type": "execution_end", "exit_code": exit_code, "tag": message_tag, "end_time": timestamp_end})
 
             await stream.close()
 
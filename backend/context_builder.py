@@ -0,0 +1,258 @@
+from aioshutil import sync_to_async
+from collections import OrderedDict, Counter, defaultdict
+
+import json
+import os
+import zipfile
+
+
+# Rough conversion used to keep the prompt context within budget without running a tokenizer
+CHARS_PER_TOKEN = 4
+
+TREE_TOKEN_BUDGET = 3_000
+PREVIEW_TOKEN_BUDGET = 12_000
+
+MAX_DIR_ENTRIES = 25 # directories with more entries are collapsed into a summary
+MAX_FILES_PER_GROUP = 2 # representative files previewed per (directory, extension) group
+TEXT_PREVIEW_CHARS = 500
+CODE_PREVIEW_CHARS = 2_000
+MAX_TABLE_ROWS = 5
+MAX_ARRAY_ENTRIES = 20
+
+MAX_CACHED_CONTEXTS = 32
+_context_cache = OrderedDict()
+
+
+def _sorted_entries(path):
+    try:
+        entries = list(os.scandir(path))
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return []
+    return sorted(entries, key=lambda e: (not e.is_dir(follow_symlinks=False), e.name))
+
+
+def _summarize_entries(entries):
+    num_dirs = sum(1 for e in entries if e.is_dir(follow_symlinks=False))
+    extensions = Counter(os.path.splitext(e.name)[1] or '(no extension)' for e in entries if not e.is_dir(follow_symlinks=False))
+    parts = []
+    if num_dirs:
+        parts.append(f"{num_dirs} folders")
+    parts.extend(f"{count} {ext}" for ext, count in extensions.most_common(5))
+    if len(extensions) > 5:
+        parts.append(f"{len(extensions) - 5} other file types")
+    return ", ".join(parts)
+
+
+def build_folder_tree(root_dir, char_budget):
+    """Generates a string representation of the folder tree, collapsing large directories."""
+    lines = []
+    used = 0
+    truncated = False
+
+    def _add(line):
+        nonlocal used, truncated
+        if used + len(line) + 1 > char_budget:
+            truncated = True
+            return False
+        lines.append(line)
+        used += len(line) + 1
+        return True
+
+    def _walk(path, indent):
+        entries = _sorted_entries(path)
+        shown = entries
+        hidden = []
+        if len(entries) > MAX_DIR_ENTRIES:
+            shown = entries[:MAX_DIR_ENTRIES - 5]
+            hidden = entries[MAX_DIR_ENTRIES - 5:]
+
+        for index, entry in enumerate(shown):
+            is_last = index == len(shown) - 1 and not hidden
+            if not _add(indent + ('└── ' if is_last else '├── ') + entry.name):
+                return False
+            if entry.is_dir(follow_symlinks=False):
+                if not _walk(entry.path, indent + ('    ' if is_last else '│   ')):
+                    return False
+
+        if hidden:
+            return _add(indent + f"└── ... {len(hidden)} more entries ({_summarize_entries(hidden)})")
+        return True
+
+    _walk(root_dir, '')
+    if truncated:
+        lines.append('... (folder tree truncated)')
+    return '\n'.join(lines)
+
+
+def _preview_text(filename, max_chars):
+    with open(filename, errors='replace') as f:
+        preview = f.read(max_chars)
+        final_char = f.read(1)
+    if final_char:
+        preview += '\n...'
+    return preview + '\n'
+
+
+def _format_npy_header(f):
+    import numpy as np
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    return f"numpy array: shape={shape}, dtype={dtype}, fortran_order={fortran_order}"
+
+
+def _preview_npy(filename):
+    # only the header is read, the array data is never loaded
+    with open(filename, 'rb') as f:
+        return _format_npy_header(f) + '\n'
+
+
+def _preview_npz(filename):
+    lines = []
+    with zipfile.ZipFile(filename) as zf:
+        names = [n for n in zf.namelist() if n.endswith('.npy')]
+        for name in names[:MAX_ARRAY_ENTRIES]:
+            with zf.open(name) as f:
+                lines.append(f"{name[:-4]}: {_format_npy_header(f)}")
+        if len(names) > MAX_ARRAY_ENTRIES:
+            lines.append(f"... {len(names) - MAX_ARRAY_ENTRIES} more arrays")
+    return '\n'.join(lines) + '\n'
+
+
+def _preview_parquet(filename):
+    import pyarrow.parquet as pq
+    parquet_file = pq.ParquetFile(filename)
+    metadata = parquet_file.metadata
+    preview = f"parquet: {metadata.num_rows} rows, {metadata.num_row_groups} row groups\n"
+    preview += str(parquet_file.schema_arrow) + '\n'
+    # iter_batches decodes only as many rows as the first batch needs, not a whole row group
+    head = next(parquet_file.iter_batches(batch_size=MAX_TABLE_ROWS), None)
+    if head is not None:
+        preview += head.to_pandas().to_string() + '\n'
+    return preview
+
+
+def _preview_hdf5(filename):
+    import h5py
+    lines = []
+
+    def _visit(name, obj):
+        if len(lines) >= MAX_ARRAY_ENTRIES:
+            return True
+        if isinstance(obj, h5py.Dataset):
+            lines.append(f"{name}: dataset shape={obj.shape}, dtype={obj.dtype}")
+        else:
+            lines.append(f"{name}/: group")
+
+    with h5py.File(filename, 'r') as f:
+        f.visititems(_visit)
+    if len(lines) >= MAX_ARRAY_ENTRIES:
+        lines.append('...')
+    return '\n'.join(lines) + '\n'
+
+
+def _preview_xlsx(filename):
+    import openpyxl
+    workbook = openpyxl.load_workbook(filename, read_only=True, data_only=True)
+    try:
+        lines = []
+        for sheet in workbook.worksheets[:MAX_ARRAY_ENTRIES]:
+            lines.append(f"sheet '{sheet.title}' ({sheet.max_row} rows x {sheet.max_column} columns):")
+            for row in sheet.iter_rows(max_row=MAX_TABLE_ROWS, values_only=True):
+                lines.append(", ".join("" if v is None else str(v) for v in row))
+        return '\n'.join(lines) + '\n'
+    finally:
+        workbook.close()
+
+
+PREVIEW_HANDLERS = {
+    '.npy': _preview_npy,
+    '.npz': _preview_npz,
+    '.parquet': _preview_parquet,
+    '.h5': _preview_hdf5,
+    '.hdf5': _preview_hdf5,
+    '.xlsx': _preview_xlsx,
+}
+
+
+def generate_file_preview(filename):
+    _, ext = os.path.splitext(filename)
+    ext = ext.lower()
+    try:
+        if not ext or ext in (".csv", ".tsv", ".txt") or "json" in ext:
+            return _preview_text(filename, TEXT_PREVIEW_CHARS)
+        elif ext == ".py":
+            return _preview_text(filename, CODE_PREVIEW_CHARS)
+        elif ext in PREVIEW_HANDLERS:
+            return PREVIEW_HANDLERS[ext](filename)
+    except ImportError:
+        # optional readers (numpy, pyarrow, h5py, openpyxl) are not installed
+        return None
+    except Exception:
+        return None
+    return None
+
+
+def _sample_files(root_dir):
+    """Picks a few representative files per (directory, extension) group, shallowest first."""
+    groups = defaultdict(list)
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            ext = os.path.splitext(filename)[1].lower()
+            group = groups[(dirpath, ext)]
+            if len(group) < MAX_FILES_PER_GROUP:
+                group.append(os.path.join(dirpath, filename))
+    return sorted(
+        (path for group in groups.values() for path in group),
+        key=lambda p: (p.count(os.sep), p),
+    )
+
+
+def build_data_preview(root_dir, char_budget, display_root='/uploads'):
+    preview = ''
+    for path in _sample_files(root_dir):
+        file_preview = generate_file_preview(path)
+        if not file_preview:
+            continue
+        display_name = f"{display_root}/{os.path.relpath(path, root_dir)}"
+        section = f"[START Preview of {display_name}]\n{file_preview}[END Preview of {display_name}]\n"
+        if len(preview) + len(section) > char_budget:
+            remaining = char_budget - len(preview)
+            if remaining > 200:
+                preview += section[:remaining] + '\n...\n'
+            preview += '... (remaining previews omitted)\n'
+            break
+        preview += section
+    return preview
+
+
+@sync_to_async
+def _build_uploads_context(uploads_dir, tree_token_budget, preview_token_budget):
+    tree = build_folder_tree(uploads_dir, tree_token_budget * CHARS_PER_TOKEN)
+    preview = build_data_preview(uploads_dir, preview_token_budget * CHARS_PER_TOKEN)
+    return tree, preview
+
+
+async def build_uploads_context(uploads_dir, cache_key=None, tree_token_budget=TREE_TOKEN_BUDGET, preview_token_budget=PREVIEW_TOKEN_BUDGET):
+    """Returns the (folder tree, data preview) strings for the uploads directory.
+
+    Results are cached by cache_key, normally the digest of the session's uploads manifest,
+    so unchanged uploads are never walked twice.
+    """
+    key = None
+    if cache_key is not None:
+        key = json.dumps([cache_key, tree_token_budget, preview_token_budget])
+        if key in _context_cache:
+            _context_cache.move_to_end(key)
+            return _context_cache[key]
+
+    context = await _build_uploads_context(uploads_dir, tree_token_budget, preview_token_budget)
+
+    if key is not None:
+        _context_cache[key] = context
+        while len(_context_cache) > MAX_CACHED_CONTEXTS:
+            _context_cache.popitem(last=False)
+    return context
@@ -0,0 +1,134 @@
+from collections import deque
+from metrics import Histogram
+import asyncio
+import cProfile
+import os
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import config
+
+try:
+    import yappi
+except ImportError:
+    yappi = None
+
+loop_lag = Histogram('event_loop_lag_seconds', 'Delay of the event loop heartbeat beyond its scheduled interval',
+                     buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+
+
+class LoopLagMonitor:
+    """Detects coroutines that block the event loop and logs where they are stuck.
+
+    A heartbeat task records when the loop last ran and a watchdog thread checks it. When the
+    loop has not run for `threshold` seconds, the watchdog logs the stack of the loop thread
+    and the name of the task that is running, once per stall.
+    """
+
+    def __init__(self, threshold: float = None, interval: float = None, max_reports: int = 50):
+        self.threshold = threshold or config.LOOP_LAG_THRESHOLD
+        self.interval = interval or config.LOOP_LAG_INTERVAL
+        self.reports = deque(maxlen=max_reports)
+        self.loop = None
+        self.loop_thread_id = None
+        self.last_beat = time.monotonic()
+        self.heartbeat_task = None
+        self.watchdog = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.stopped.clear()
+        self.heartbeat_task = asyncio.create_task(self._heartbeat(), name="loop-lag-heartbeat")
+        self.watchdog = threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True)
+        self.watchdog.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            loop_lag.observe(max(0, now - expected))
+            self.last_beat = now
+
+    def _running_task(self, frame):
+        """Returns the task whose coroutine is on the loop thread's stack, None if there is none.
+
+        The loop's tasks are read from another thread, which is racy but fine for a report.
+        """
+        frames = set()
+        while frame is not None:
+            frames.add(frame)
+            frame = frame.f_back
+        try:
+            tasks = asyncio.all_tasks(self.loop)
+        except RuntimeError:
+            return None
+        for task in tasks:
+            if getattr(task.get_coro(), 'cr_frame', None) in frames:
+                return task
+        return None
+
+    def _watch(self):
+        reported_beat = None
+        while not self.stopped.wait(self.interval):
+            beat = self.last_beat
+            lag = time.monotonic() - beat
+            if lag < self.threshold or beat == reported_beat:
+                continue
+            reported_beat = beat
+
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+            task = self._running_task(frame)
+            report = {
+                'time': time.time(),
+                'lag': lag,
+                'task': task.get_name() if task is not None else None,
+                'stack': stack,
+            }
+            self.reports.append(report)
+            print(f"Event loop blocked for {lag:.2f}s in task {report['task']}:\n{stack}", flush=True)
+
+
+loop_lag_monitor = LoopLagMonitor()
+
+profile_lock = asyncio.Lock()
+
+
+async def capture_profile(seconds: float, clock: str = 'wall'):
+    """Profiles the whole process for `seconds` and returns the path of a pstats file.
+
+    Uses yappi when it is installed, which attributes time to coroutines across awaits, and
+    falls back to cProfile on the event loop thread. The caller removes the file.
+    """
+    fd, path = tempfile.mkstemp(prefix="profile-", suffix=".pstats")
+    os.close(fd)
+    if yappi is not None:
+        yappi.clear_stats()
+        yappi.set_clock_type(clock)
+        yappi.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            yappi.stop()
+        yappi.get_func_stats().save(path, type='pstat')
+        yappi.clear_stats()
+    else:
+        profiler = cProfile.Profile(time.perf_counter if clock == 'wall' else time.process_time)
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+        profiler.dump_stats(path)
+    return path
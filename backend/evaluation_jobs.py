@@ -0,0 +1,116 @@
+from collections import OrderedDict
+from broker import broker
+import asyncio
+import time
+import uuid
+import config
+
+EVAL_SCRIPT = "evaluation_scripts/eval_script.py"
+
+
+class EvaluationQueue:
+    """Runs evaluation scripts as subprocesses on a bounded number of slots.
+
+    The script is run as `python3 evaluation_scripts/eval_script.py <instance_id>` and evaluates
+    whatever state it reads for the instance, which can change between runs, so results are not
+    cached. Jobs are identified by id and kept for polling. A submission for an instance that
+    already has a queued or running job joins that job instead of starting another one. Status
+    changes are published to the job's agent session, if it has one.
+    """
+
+    def __init__(self, concurrency: int = None, timeout: float = None, max_jobs: int = 1000):
+        self.concurrency = concurrency or config.EVALUATION_CONCURRENCY
+        self.timeout = timeout or config.EVALUATION_TIMEOUT
+        self.max_jobs = max_jobs
+        self.semaphore = None
+        self.jobs = OrderedDict()
+        self.tasks = {}
+        self.active = {} # instance id -> id of the queued/running job
+
+    def get(self, job_id: str):
+        return self.jobs.get(job_id)
+
+    def submit(self, instance_id: str, agent_session_id: str = None):
+        if instance_id in self.active:
+            return self.jobs[self.active[instance_id]]
+
+        job = {
+            'id': str(uuid.uuid4()),
+            'instance_id': instance_id,
+            'agent_session_id': agent_session_id,
+            'status': 'queued',
+            'output': None,
+            'error': None,
+            'created_at': time.time(),
+            'finished_at': None,
+        }
+        self.jobs[job['id']] = job
+        while len(self.jobs) > self.max_jobs:
+            self.jobs.popitem(last=False)
+
+        self.active[instance_id] = job['id']
+        self.tasks[job['id']] = asyncio.create_task(self._run(job), name=f"evaluation-{job['id']}")
+        return job
+
+    async def wait(self, job_id: str):
+        task = self.tasks.get(job_id)
+        if task is not None:
+            # asyncio.wait neither cancels the job when the waiter is cancelled nor raises its errors
+            await asyncio.wait([task])
+        return self.jobs.get(job_id)
+
+    async def _publish(self, job: dict):
+        if job['agent_session_id']:
+            await broker.publish(job['agent_session_id'], {'type': 'evaluation', 'job': job})
+
+    def _finish(self, job: dict, status: str):
+        job['status'] = status
+        job['finished_at'] = time.time()
+        self.active.pop(job['instance_id'], None)
+        self.tasks.pop(job['id'], None)
+
+    async def _run(self, job: dict):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        try:
+            await self._publish(job)
+            async with self.semaphore:
+                job['status'] = 'running'
+                await self._publish(job)
+                output, returncode = await self._evaluate(job['instance_id'])
+            job['output'] = output
+            if returncode == 0:
+                self._finish(job, 'done')
+            else:
+                job['error'] = f"Evaluation script exited with code {returncode}"
+                self._finish(job, 'failed')
+        except asyncio.CancelledError:
+            job['error'] = "Evaluation cancelled"
+            self._finish(job, 'cancelled')
+            await self._publish(job)
+            raise
+        except asyncio.TimeoutError:
+            job['error'] = f"Evaluation timed out after {self.timeout}s"
+            self._finish(job, 'failed')
+        except Exception as e:
+            print("Evaluation failed:", job['instance_id'], e)
+            job['error'] = str(e)
+            self._finish(job, 'failed')
+        await self._publish(job)
+
+    async def _evaluate(self, instance_id: str):
+        process = await asyncio.create_subprocess_exec(
+            "python3", EVAL_SCRIPT, instance_id,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=self.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            process.kill()
+            await process.wait()
+            raise
+        if process.returncode != 0:
+            print("Evaluation script failed:", instance_id, stderr.decode('utf-8', errors='replace')[-2000:])
+        return stdout.decode('utf-8', errors='replace'), process.returncode
+
+
+evaluation_queue = EvaluationQueue()
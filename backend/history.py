@@ -0,0 +1,127 @@
+from llm_engine import LLMEngine
+import re
+
+
+# Approximate per-message overhead of the chat format (role markers, separators)
+MESSAGE_TOKEN_OVERHEAD = 4
+
+KEEP_LAST_TURNS = 2 # most recent prompt/response pairs that are always sent verbatim
+MAX_SUMMARY_CHARS = 600
+CODE_BLOCK_PATTERN = re.compile(r"```python(.*?)```", re.DOTALL)
+
+
+async def count_message_tokens(llm_engine: LLMEngine, message: dict):
+    """Returns the token count of a history message, caching it on the message as `num_tokens`."""
+    if message.get('num_tokens') is None:
+        message['num_tokens'] = await llm_engine.acount_tokens(message['content'])
+    return message['num_tokens'] + MESSAGE_TOKEN_OVERHEAD
+
+
+async def assemble_history(llm_engine: LLMEngine, history: list, max_tokens: int):
+    """Selects the messages to send for a follow-up request within a token budget.
+
+    The first message (the system prompt) is always kept, then as many of the most recent
+    messages as fit. Token counts are taken from the `num_tokens` stored with each message, so
+    only messages without a cached count are tokenized.
+    """
+    if not history:
+        return []
+
+    first, rest = history[0], history[1:]
+    first_tokens = await count_message_tokens(llm_engine, first)
+    if first_tokens > max_tokens:
+        content, _ = await llm_engine.atruncate_text(first['content'], max_tokens - MESSAGE_TOKEN_OVERHEAD)
+        return [{'role': first['role'], 'content': content}]
+
+    budget = max_tokens - first_tokens
+    selected = []
+    for message in reversed(rest):
+        num_tokens = await count_message_tokens(llm_engine, message)
+        if num_tokens > budget:
+            break
+        budget -= num_tokens
+        selected.append(message)
+
+    # keep roles alternating after the first message, which some providers require
+    while selected and selected[-1]['role'] == first['role']:
+        selected.pop()
+
+    return [{'role': m['role'], 'content': m['content']} for m in [first, *reversed(selected)]]
+
+
+def is_debug_prompt(message: dict):
+    if message['role'] != 'user':
+        return False
+    return message.get('tag') == 'self_debug' or 'Traceback (most recent call last)' in message['content']
+
+
+def summarize_debug_prompt(content: str):
+    """Reduces an error report to its first line and the final exception lines."""
+    lines = [line for line in content.strip().splitlines() if line.strip()]
+    if len(lines) <= 6 and len(content) <= MAX_SUMMARY_CHARS:
+        return content
+    summary = "[Earlier error report, summarized]\n" + lines[0] + "\n...\n" + "\n".join(lines[-3:])
+    return summary[:MAX_SUMMARY_CHARS]
+
+
+def replace_superseded_programs(content: str, block_filenames: dict, latest_filename: str):
+    """Replaces code blocks of older programs with a reference to the program file."""
+    index = -1
+    all_superseded = True
+
+    def _replace(match):
+        nonlocal index, all_superseded
+        index += 1
+        filename = block_filenames.get(index)
+        if filename is None or filename == latest_filename:
+            all_superseded = False
+            return match.group(0)
+        return f"[program {filename} omitted, it was superseded by a later version]"
+
+    return CODE_BLOCK_PATTERN.sub(_replace, content), all_superseded
+
+
+def compact_history(history: list, code_files: list, summaries: dict, keep_last_turns=KEEP_LAST_TURNS):
+    """Shrinks older parts of a conversation before it is sent to the model.
+
+    The first message (the system prompt) and the last keep_last_turns prompt/response pairs
+    are kept verbatim. In older messages, programs that have been superseded by a later code
+    file are replaced by a reference to the file, and self-debug error reports are summarized.
+    Compacted contents are looked up in and added to summaries (keyed by message id), so each
+    message is only compacted once. Returns the compacted history and the new summaries.
+    """
+    if len(history) <= 1 + 2 * keep_last_turns:
+        return history, {}
+
+    block_filenames = {}
+    for code_file in code_files:
+        if code_file.get('filename'):
+            block_filenames.setdefault(code_file['history_id'], {})[code_file['block_index']] = code_file['filename']
+    generated = [cf for cf in code_files if not cf.get('is_gold')]
+    latest_filename = generated[-1]['filename'] if generated else None
+
+    cutoff = len(history) - 2 * keep_last_turns
+    compacted = [history[0]]
+    new_summaries = {}
+    for message in history[1:cutoff]:
+        summary = summaries.get(message.get('id'))
+        if summary is None:
+            content = None
+            if is_debug_prompt(message):
+                content = summarize_debug_prompt(message['content'])
+                cacheable = True
+            elif message['role'] == 'assistant' and message.get('id') in block_filenames:
+                content, cacheable = replace_superseded_programs(
+                    message['content'], block_filenames[message['id']], latest_filename)
+
+            if content is None or content == message['content']:
+                compacted.append(message)
+                continue
+            summary = {'content': content}
+            if cacheable and message.get('id'):
+                new_summaries[message['id']] = summary
+
+        compacted.append({**message, 'content': summary['content'], 'num_tokens': summary.get('num_tokens')})
+
+    compacted.extend(history[cutoff:])
+    return compacted, new_summaries
@@ -0,0 +1,131 @@
+from aioshutil import sync_to_async
+import hashlib
+import json
+import os
+import threading
+import time
+import config
+
+
+# Bump when the format of the cached stream events changes
+CACHE_VERSION = 2
+
+# eviction frees space down to this fraction of max_bytes, so the directory is scanned rarely
+EVICT_TO = 0.9
+
+
+class LLMCacheMiss(Exception):
+    pass
+
+
+class LLMResponseCache:
+    """Disk-backed cache of LLM responses.
+
+    Each entry is a JSON file holding the streamed events of one response (text chunks and
+    usage), keyed by a hash of the model, messages and sampling parameters. Entries are
+    evicted least recently used first once the cache grows beyond max_bytes. The size of the
+    cache is scanned once and then counted as entries are written, the directory is only
+    scanned again when the count passes max_bytes (picking up entries of other processes).
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.size = None # bytes of the cache since the last scan plus the entries written since
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model: str, messages: list, temperature, top_p, stream: bool):
+        data = json.dumps({
+            'version': CACHE_VERSION,
+            'model': model,
+            'messages': messages,
+            'temperature': temperature,
+            'top_p': top_p,
+            'stream': stream,
+        }, sort_keys=True, default=str)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str):
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    @sync_to_async
+    def get(self, key: str):
+        path = self._path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        # refresh the access time used for LRU eviction
+        os.utime(path, None)
+        return entry
+
+    @sync_to_async
+    def put(self, key: str, entry: dict):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        size = os.path.getsize(tmp_path)
+        try:
+            size -= os.path.getsize(path)
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            if self.size is None:
+                self.size = self._evict(self.max_bytes)
+            else:
+                self.size += size
+                if self.size > self.max_bytes:
+                    self.size = self._evict(int(self.max_bytes * EVICT_TO))
+
+    def _evict(self, target_bytes: int):
+        """Scans the cache and removes the least recently used entries until it fits in target_bytes, returns its size."""
+        entries = []
+        total_size = 0
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if not filename.endswith('.json'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total_size += stat.st_size
+
+        if total_size <= self.max_bytes:
+            return total_size
+        for _, size, path in sorted(entries):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            if total_size <= target_bytes:
+                break
+        return total_size
+
+
+_cache = None
+
+
+def get_llm_cache():
+    """Returns the process-wide response cache, or None if caching is disabled in config."""
+    global _cache
+    if not config.LLM_CACHE_MODE:
+        return None
+    if config.LLM_CACHE_MODE not in ('record', 'replay'):
+        raise ValueError(f"Unsupported LLM_CACHE_MODE: {config.LLM_CACHE_MODE}")
+    if _cache is None:
+        _cache = LLMResponseCache(config.LLM_CACHE_DIR, config.LLM_CACHE_MAX_BYTES)
+    return _cache
+
+
+def make_entry(events: list):
+    return {'created_at': int(time.time()), 'events': events}
@@ -1,27 +1,290 @@
-from litellm import cost_per_token, acompletion
-from litellm.utils import trim_messages
+from llm_cache import get_llm_cache, make_entry, LLMCacheMiss
+from metrics import llm_latency, model_label
+from rate_limiter import Admission, get_rate_limiter
+from collections import OrderedDict
+import httpx
+import os
+import asyncio
+import hashlib
+import random
+import time
 import config
 
 
+# Upper bound on characters per token used to pre-truncate text before it is tokenized
+MAX_CHARS_PER_TOKEN = 8
+TRUNCATION_MARKER = "\n...\n"
+
+MAX_RETRY_DELAY = 30
+
+
+MAX_REGISTERED_ENGINES = 64
+PRICING_SAMPLE_TOKENS = 1_000_000
+
+_engines = OrderedDict()
+_http_client = None
+
+# litellm takes seconds to import, so it is loaded on first use (or by warm_llm_engine at startup)
+litellm = None
+_retryable_errors = None
+
+
+def import_litellm():
+    global litellm, _retryable_errors
+    if litellm is None:
+        import litellm as _litellm
+        from litellm.exceptions import RateLimitError, ServiceUnavailableError, InternalServerError, APIConnectionError, Timeout
+        _retryable_errors = (RateLimitError, ServiceUnavailableError, InternalServerError, APIConnectionError, Timeout, asyncio.TimeoutError)
+        if _http_client is not None:
+            _litellm.aclient_session = _http_client
+        litellm = _litellm
+    return litellm
+
+
+def retryable_errors():
+    import_litellm()
+    return _retryable_errors
+
+
+def get_http_client():
+    """Returns the process-wide async HTTP client, which litellm reuses for every request."""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=120),
+            timeout=httpx.Timeout(config.LLM_REQUEST_TIMEOUT or None, connect=10),
+        )
+        if litellm is not None:
+            litellm.aclient_session = _http_client
+    return _http_client
+
+
+def get_llm_engine(llm_engine_name, api_key=None, base_url=None, fallback_engine_names=None):
+    """Returns a shared engine for the given model, endpoint and credentials."""
+    base_url = base_url or config.LLM_BASE_URL
+    api_key_hash = hashlib.sha256(api_key.encode('utf-8')).hexdigest() if api_key else None
+    key = (llm_engine_name, base_url, api_key_hash, tuple(fallback_engine_names or []))
+    engine = _engines.get(key)
+    if engine is None:
+        engine = LLMEngine(llm_engine_name, api_key=api_key, base_url=base_url, fallback_engine_names=fallback_engine_names)
+        # the configured limits describe the server's quota, requests with a user's own key are not limited
+        if api_key in (None, os.getenv('LLM_API_KEY')):
+            engine.rate_limiter = get_rate_limiter(llm_engine_name)
+        _engines[key] = engine
+        while len(_engines) > MAX_REGISTERED_ENGINES:
+            _engines.popitem(last=False)
+    else:
+        _engines.move_to_end(key)
+    return engine
+
+
+async def warm_llm_engine(llm_engine_name, api_key=None, base_url=None, fallback_engine_names=None):
+    """Imports litellm, resolves pricing and opens a connection to the provider ahead of the first request."""
+    await asyncio.to_thread(import_litellm)
+    engine = get_llm_engine(llm_engine_name, api_key=api_key, base_url=base_url, fallback_engine_names=fallback_engine_names)
+    await asyncio.to_thread(engine.resolve_pricing)
+
+    url = engine.get_api_base()
+    if url:
+        try:
+            await get_http_client().head(url)
+        except httpx.HTTPError as e:
+            print(f"Failed to warm connection to {url}: {e}")
+    return engine
+
+
+async def close_stream(stream):
+    """Closes a streamed response so the connection is released and the provider stops generating."""
+    aclose = getattr(stream, 'aclose', None)
+    if aclose is None:
+        return
+    try:
+        await aclose()
+    except Exception as e:
+        print("Failed to close LLM stream:", e)
+
+
+def retry_delay(attempt: int):
+    # exponential backoff with full jitter
+    return random.uniform(0, min(MAX_RETRY_DELAY, config.LLM_RETRY_BASE_DELAY * 2 ** attempt))
+
+
 class LLMEngine():
-    def __init__(self, llm_engine_name, api_key=None, base_url=None):
+    def __init__(self, llm_engine_name, api_key=None, base_url=None, fallback_engine_names=None):
         self.llm_engine_name = llm_engine_name
         self.api_key = api_key
         self.base_url = base_url or config.LLM_BASE_URL
+        self.fallback_engine_names = fallback_engine_names or []
+        self.pricing = None
+        self.pricing_resolved = False
+        self.rate_limiter = None
+
+    def get_engine_chain(self):
+        # fallback engines use the server's provider credentials from the environment
+        return [self, *[get_llm_engine(name) for name in self.fallback_engine_names if name != self.llm_engine_name]]
 
-    def get_cost(self, prompt_tokens, completion_tokens):
-        prompt_cost, completion_cost = cost_per_token(
+    def admit(self, messages):
+        """Waits for the engine's rate limiter, if it has one, before a request is sent."""
+        if self.rate_limiter is None:
+            return Admission(None, 0)
+        return self.rate_limiter.admit(messages)
+
+    def get_api_base(self):
+        if self.base_url:
+            return self.base_url
+        try:
+            _, provider, _, api_base = import_litellm().get_llm_provider(self.llm_engine_name)
+        except Exception:
+            return None
+        if api_base:
+            return api_base
+        if provider == 'bedrock':
+            return f"https://bedrock-runtime.{config.LLM_REGION_NAME}.amazonaws.com"
+        return None
+
+    def _cost_per_token(self, prompt_tokens, completion_tokens, cache_read_tokens=0, cache_write_tokens=0):
+        prompt_cost, completion_cost = import_litellm().cost_per_token(
             model=self.llm_engine_name,
             prompt_tokens=prompt_tokens,
             completion_tokens=completion_tokens,
+            cache_read_input_tokens=cache_read_tokens,
+            cache_creation_input_tokens=cache_write_tokens,
+        )
+        return prompt_cost + completion_cost
+
+    def resolve_pricing(self):
+        """Derives per-token prices once so get_cost does not look up the model on every call."""
+        n = PRICING_SAMPLE_TOKENS
+        self.pricing_resolved = True
+        try:
+            prompt_price = self._cost_per_token(n, 0) / n
+            self.pricing = {
+                'prompt': prompt_price,
+                'completion': self._cost_per_token(0, n) / n,
+                # cache token prices are relative to regular prompt tokens they replace
+                'cache_read': self._cost_per_token(n, 0, cache_read_tokens=n) / n - prompt_price,
+                'cache_write': self._cost_per_token(n, 0, cache_write_tokens=n) / n - prompt_price,
+            }
+        except Exception as e:
+            print(f"Could not resolve pricing for {self.llm_engine_name}: {e}")
+            self.pricing = None
+        return self.pricing
+
+    def get_cost(self, prompt_tokens, completion_tokens, cache_read_tokens=0, cache_write_tokens=0):
+        if not self.pricing_resolved:
+            self.resolve_pricing()
+        if self.pricing is None:
+            return self._cost_per_token(prompt_tokens, completion_tokens, cache_read_tokens, cache_write_tokens)
+        cost = (
+            prompt_tokens * self.pricing['prompt'] +
+            completion_tokens * self.pricing['completion'] +
+            cache_read_tokens * self.pricing['cache_read'] +
+            cache_write_tokens * self.pricing['cache_write']
         )
-        cost = prompt_cost + completion_cost
         return cost
 
+    def supports_cache_control(self):
+        # Anthropic models (directly or through Bedrock/Vertex) need explicit cache breakpoints,
+        # OpenAI and others cache a stable prompt prefix automatically
+        name = self.llm_engine_name.lower()
+        return 'anthropic' in name or 'claude' in name
+
+    def add_cache_breakpoints(self, messages):
+        """Marks the stable prefix of a conversation as cacheable.
+
+        A breakpoint is always placed on the first message (the system prompt with the dataset
+        context), which every self-debug iteration re-sends. Longer conversations also get one on
+        the last message before the new user turn, so the next follow-up reuses that prefix.
+        """
+        if not config.LLM_PROMPT_CACHING or not self.supports_cache_control() or len(messages) < 2:
+            return messages
+
+        breakpoints = {0}
+        if len(messages) > 3:
+            breakpoints.add(len(messages) - 2)
+        prepared = []
+        for i, message in enumerate(messages):
+            if i in breakpoints and isinstance(message['content'], str) and message['content']:
+                message = {
+                    **message,
+                    'content': [{'type': 'text', 'text': message['content'], 'cache_control': {'type': 'ephemeral'}}],
+                }
+            prepared.append(message)
+        return prepared
+
+    @staticmethod
+    def parse_usage(usage):
+        prompt_details = getattr(usage, 'prompt_tokens_details', None)
+        cache_read_tokens = getattr(usage, 'cache_read_input_tokens', None) or getattr(prompt_details, 'cached_tokens', None) or 0
+        cache_write_tokens = getattr(usage, 'cache_creation_input_tokens', None) or 0
+        return {
+            'prompt_tokens': usage.prompt_tokens or 0,
+            'completion_tokens': usage.completion_tokens or 0,
+            'cache_read_tokens': cache_read_tokens,
+            'cache_write_tokens': cache_write_tokens,
+        }
+
     async def respond_stream(self, user_input, temperature, top_p):
-        response = await acompletion(
+        cache = get_llm_cache()
+        if cache is None:
+            async for event in self._respond_stream(user_input, temperature, top_p):
+                yield event
+            return
+
+        key = cache.make_key(self.llm_engine_name, user_input, temperature, top_p, stream=True)
+        entry = await cache.get(key)
+        if entry is not None:
+            for event in entry['events']:
+                yield tuple(event)
+            return
+        if config.LLM_CACHE_MODE == 'replay':
+            raise LLMCacheMiss(f"No cached response for {self.llm_engine_name} request {key}")
+
+        events = []
+        async for event in self._respond_stream(user_input, temperature, top_p):
+            events.append(event)
+            yield event
+        # only complete responses are recorded
+        await cache.put(key, make_entry(events))
+
+    async def _respond_stream(self, user_input, temperature, top_p):
+        """Streams a response, retrying and falling back to other engines before the first token.
+
+        Once any output has been yielded the response cannot be restarted, so later errors
+        propagate to the caller.
+        """
+        last_error = None
+        for engine in self.get_engine_chain():
+            for attempt in range(config.LLM_MAX_RETRIES + 1):
+                started = False
+                try:
+                    async with engine.admit(user_input) as admission:
+                        async for event in engine._stream_with_deadlines(user_input, temperature, top_p):
+                            started = True
+                            if event[1]:
+                                admission.record_usage(event[1])
+                            yield event
+                    return
+                except retryable_errors() as e:
+                    if started:
+                        raise
+                    last_error = e
+                    if attempt < config.LLM_MAX_RETRIES:
+                        delay = retry_delay(attempt)
+                        print(f"LLM request to {engine.llm_engine_name} failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                        await asyncio.sleep(delay)
+                except Exception as e:
+                    if started:
+                        raise
+                    last_error = e
+                    break
+            print(f"LLM engine {engine.llm_engine_name} failed: {last_error}")
+        raise last_error
+
+    async def _open_stream(self, user_input, temperature, top_p):
+        response = await import_litellm().acompletion(
             model=self.llm_engine_name,
-            messages=user_input,
+            messages=self.add_cache_breakpoints(user_input),
             temperature=temperature,
             top_p=top_p,
             stream=True,
@@ -30,34 +293,155 @@ class LLMEngine():
             api_base=self.base_url,
             region_name=config.LLM_REGION_NAME,
         )
+        stream = response.__aiter__()
+        try:
+            first_chunk = await stream.__anext__()
+        except BaseException:
+            await close_stream(stream)
+            raise
+        return first_chunk, stream
+
+    async def _open_stream_hedged(self, user_input, temperature, top_p):
+        """Opens the stream, launching a second identical request if the first token is slow.
+
+        Every stream other than the one returned is closed, so the provider stops generating it.
+        """
+        requests = [asyncio.create_task(self._open_stream(user_input, temperature, top_p))]
+        winner = None
+        try:
+            if config.LLM_HEDGE_AFTER_MS:
+                done, _ = await asyncio.wait(requests, timeout=config.LLM_HEDGE_AFTER_MS / 1000)
+                if not done:
+                    print(f"No first token from {self.llm_engine_name} after {config.LLM_HEDGE_AFTER_MS}ms, sending hedged request")
+                    requests.append(asyncio.create_task(self._open_stream(user_input, temperature, top_p)))
+
+            last_error = None
+            pending = set(requests)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        return task.result()
+                    last_error = task.exception()
+            raise last_error
+        finally:
+            for task in requests:
+                if not task.done():
+                    task.cancel()
+            for task in requests:
+                if task is not winner and task.done() and not task.cancelled() and task.exception() is None:
+                    await close_stream(task.result()[1])
+
+    async def _stream_with_deadlines(self, user_input, temperature, top_p):
+        start_time = time.perf_counter()
+        first_chunk, stream = await asyncio.wait_for(
+            self._open_stream_hedged(user_input, temperature, top_p),
+            timeout=config.LLM_FIRST_TOKEN_TIMEOUT,
+        )
+        llm_latency.observe(time.perf_counter() - start_time, model=model_label(self.llm_engine_name), phase='first_token')
 
-        async for chunk in response:
-            if hasattr(chunk, 'usage'):
-                prompt_tokens = chunk.usage.prompt_tokens
-                completion_tokens = chunk.usage.completion_tokens
-                yield None, prompt_tokens, completion_tokens
-            elif chunk.choices and len(chunk.choices) > 0:
-                content = chunk.choices[0].delta.content
-                yield content, 0, 0
-        
+        deadline = start_time + config.LLM_REQUEST_TIMEOUT if config.LLM_REQUEST_TIMEOUT else None
+        chunk = first_chunk
+        try:
+            while True:
+                if getattr(chunk, 'usage', None):
+                    yield None, self.parse_usage(chunk.usage)
+                elif chunk.choices and len(chunk.choices) > 0:
+                    content = chunk.choices[0].delta.content
+                    yield content, None
+
+                try:
+                    if deadline is None:
+                        chunk = await stream.__anext__()
+                    else:
+                        chunk = await asyncio.wait_for(stream.__anext__(), timeout=max(0, deadline - time.perf_counter()))
+                except StopAsyncIteration:
+                    break
+        finally:
+            await close_stream(stream)
+
+        llm_latency.observe(time.perf_counter() - start_time, model=model_label(self.llm_engine_name), phase='total')
     
     async def respond(self, user_input, temperature, top_p):
-        response = await acompletion(
-            model=self.llm_engine_name,
-            messages=user_input,
-            temperature=temperature,
-            top_p=top_p,
-            stream=False,
-            stream_options={"include_usage": True},
-            api_key=self.api_key,
-            api_base=self.base_url,
-            region_name=config.LLM_REGION_NAME,
-        )
+        cache = get_llm_cache()
+        key = None
+        if cache is not None:
+            key = cache.make_key(self.llm_engine_name, user_input, temperature, top_p, stream=False)
+            entry = await cache.get(key)
+            if entry is not None:
+                response = import_litellm().ModelResponse(**entry['response'])
+                return response, self.parse_usage(response.usage)
+            if config.LLM_CACHE_MODE == 'replay':
+                raise LLMCacheMiss(f"No cached response for {self.llm_engine_name} request {key}")
+
+        response = await self._respond_with_retries(user_input, temperature, top_p)
+
+        if cache is not None:
+            await cache.put(key, {**make_entry([]), 'response': response.model_dump()})
 
         content = response
-        input_tokens = response.usage.prompt_tokens
-        output_tokens = response.usage.completion_tokens
-        return content, input_tokens, output_tokens
+        return content, self.parse_usage(response.usage)
+
+    async def _respond_with_retries(self, user_input, temperature, top_p):
+        last_error = None
+        for engine in self.get_engine_chain():
+            for attempt in range(config.LLM_MAX_RETRIES + 1):
+                try:
+                    async with engine.admit(user_input) as admission:
+                        start_time = time.perf_counter()
+                        response = await asyncio.wait_for(import_litellm().acompletion(
+                            model=engine.llm_engine_name,
+                            messages=engine.add_cache_breakpoints(user_input),
+                            temperature=temperature,
+                            top_p=top_p,
+                            stream=False,
+                            stream_options={"include_usage": True},
+                            api_key=engine.api_key,
+                            api_base=engine.base_url,
+                            region_name=config.LLM_REGION_NAME,
+                        ), timeout=config.LLM_REQUEST_TIMEOUT)
+                        admission.record_usage(engine.parse_usage(response.usage))
+                    llm_latency.observe(time.perf_counter() - start_time, model=model_label(engine.llm_engine_name), phase='total')
+                    return response
+                except retryable_errors() as e:
+                    last_error = e
+                    if attempt < config.LLM_MAX_RETRIES:
+                        await asyncio.sleep(retry_delay(attempt))
+                except Exception as e:
+                    last_error = e
+                    break
+            print(f"LLM engine {engine.llm_engine_name} failed: {last_error}")
+        raise last_error
 
     def trim_messages(self, messages, max_tokens):
-        return trim_messages(messages, self.llm_engine_name, max_tokens)
+        return import_litellm().utils.trim_messages(messages, self.llm_engine_name, max_tokens)
+
+    def count_tokens(self, text: str):
+        return import_litellm().token_counter(model=self.llm_engine_name, text=text)
+
+    def truncate_text(self, text: str, max_tokens: int):
+        """Shortens text to at most max_tokens by cutting out the middle.
+
+        The text is first cut down by characters so that only a bounded amount of it is ever
+        tokenized, no matter how large the input is. Returns the text and whether it was cut.
+        """
+        max_chars = max_tokens * MAX_CHARS_PER_TOKEN
+        truncated = len(text) > max_chars
+        if truncated:
+            text = text[:max_chars // 2] + TRUNCATION_MARKER + text[-(max_chars // 2):]
+
+        num_tokens = self.count_tokens(text)
+        while num_tokens > max_tokens:
+            keep = int(len(text) * max_tokens / num_tokens * 0.95) // 2
+            text = text[:keep] + TRUNCATION_MARKER + text[-keep:] if keep > 0 else ""
+            truncated = True
+            num_tokens = self.count_tokens(text)
+        return text, truncated
+
+    async def acount_tokens(self, text: str):
+        # tokenizing large strings is CPU bound, keep it off the event loop
+        return await asyncio.to_thread(self.count_tokens, text)
+
+    async def atruncate_text(self, text: str, max_tokens: int):
+        return await asyncio.to_thread(self.truncate_text, text, max_tokens)
@@ -0,0 +1,208 @@
+from collections import deque
+import bisect
+import contextvars
+import functools
+import inspect
+import time
+import config
+
+# every metric created in the process, rendered by render()
+REGISTRY = []
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+# phase durations of the websocket command being executed, filled in by Timer and record_phase
+command_phases = contextvars.ContextVar('command_phases', default=None)
+
+
+def _format_labels(key: tuple, extra: tuple = ()):
+    labels = [*key, *extra]
+    if not labels:
+        return ''
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+def _format_value(value: float):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Keeps a sliding window of recent observations per label set to report percentiles.
+
+    Observations are also counted into cumulative buckets for the Prometheus exposition.
+    """
+
+    def __init__(self, name: str, description: str, window: int = 1000, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.window = window
+        self.buckets = tuple(buckets)
+        self.samples = {}
+        self.totals = {} # label key -> [count per bucket (last is +Inf), sum]
+        REGISTRY.append(self)
+
+    @staticmethod
+    def _key(labels: dict):
+        return tuple(sorted(labels.items()))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        if key not in self.samples:
+            self.samples[key] = deque(maxlen=self.window)
+            self.totals[key] = [[0] * (len(self.buckets) + 1), 0]
+        self.samples[key].append(value)
+        totals = self.totals[key]
+        totals[0][bisect.bisect_left(self.buckets, value)] += 1
+        totals[1] += value
+
+    def percentile(self, q: float, **labels):
+        samples = sorted(self.samples.get(self._key(labels), []))
+        if not samples:
+            return None
+        index = min(len(samples) - 1, max(0, round(q / 100 * len(samples)) - 1))
+        return samples[index]
+
+    def summary(self):
+        results = []
+        for key, samples in self.samples.items():
+            labels = dict(key)
+            results.append({
+                'labels': labels,
+                'count': len(samples),
+                'p50': self.percentile(50, **labels),
+                'p90': self.percentile(90, **labels),
+                'p99': self.percentile(99, **labels),
+            })
+        return results
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total) in list(self.totals.items()):
+            cumulative = 0
+            for bound, count in zip([*self.buckets, float('inf')], counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(key, (('le', _format_value(bound)),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """Holds the current value per label set."""
+
+    TYPE = 'gauge'
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.values = {}
+        REGISTRY.append(self)
+
+    def set(self, value: float, **labels):
+        self.values[Histogram._key(labels)] = value
+
+    def remove(self, **labels):
+        self.values.pop(Histogram._key(labels), None)
+
+    def get(self, **labels):
+        return self.values.get(Histogram._key(labels))
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.TYPE}"]
+        for key, value in list(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Gauge):
+    """Monotonically increasing count per label set."""
+
+    TYPE = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = Histogram._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(Histogram._key(labels), 0)
+
+
+def model_label(llm_engine_name: str):
+    """Engine names come from clients, only configured ones are used as labels so their number stays bounded."""
+    if llm_engine_name == config.LLM_ENGINE_NAME or llm_engine_name in config.LLM_FALLBACK_ENGINES or llm_engine_name in config.LLM_RATE_LIMITS:
+        return llm_engine_name
+    return 'other'
+
+
+def render():
+    """Returns all metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.expose())
+    return '\n'.join(lines) + '\n'
+
+
+def _add_command_phase(phase: str, seconds: float):
+    phases = command_phases.get()
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0) + seconds
+
+
+def record_phase(phase: str, seconds: float):
+    phase_latency.observe(seconds, phase=phase)
+    _add_command_phase(phase, seconds)
+
+
+class Timer:
+    """Context manager that records the elapsed time in seconds into a histogram.
+
+    Time recorded with a `phase` label is also added to the current command's phases.
+    """
+
+    def __init__(self, histogram: Histogram, **labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+        self.elapsed = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
+        self.histogram.observe(self.elapsed, **self.labels)
+        if 'phase' in self.labels:
+            _add_command_phase(self.labels['phase'], self.elapsed)
+        return False
+
+
+def time_methods(cls, histogram: Histogram):
+    """Records the duration of every public async method of a class by method name."""
+    for name, method in list(vars(cls).items()):
+        if name.startswith('_') or not (inspect.isfunction(method) and inspect.iscoroutinefunction(method)):
+            continue
+
+        def _wrap(method, name):
+            @functools.wraps(method)
+            async def _timed(*args, **kwargs):
+                with Timer(histogram, method=name):
+                    return await method(*args, **kwargs)
+            return _timed
+
+        setattr(cls, name, _wrap(method, name))
+    return cls
+
+
+llm_latency = Histogram('llm_latency_seconds', 'LLM request latency by phase (first_token, total)')
+llm_tokens_per_second = Histogram('llm_tokens_per_second', 'Completion tokens per second after the first token by model',
+                                  buckets=(1, 5, 10, 20, 50, 100, 200, 500, 1000))
+llm_tokens = Counter('llm_tokens_total', 'LLM tokens by model and kind (prompt, completion)')
+phase_latency = Histogram('agent_phase_seconds', 'Duration of agent phases (llm_queue, generate, sync_uploads, install_*, run_program, hash_outputs, upload_outputs, container_*)')
+command_latency = Histogram('command_seconds', 'Duration of websocket commands by command')
+session_backend_latency = Histogram('agent_session_backend_seconds', 'Duration of agent session backend calls by method')
+broker_queue_depth = Gauge('broker_queue_depth', 'Deepest subscriber queue per session, labelled with a hash of the session id')
+broker_overflows = Counter('broker_overflows_total', 'Messages dropped or merged and subscribers disconnected because a subscriber queue was full, by policy and action')
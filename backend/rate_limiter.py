@@ -0,0 +1,203 @@
+from collections import OrderedDict, deque
+from broker import broker
+from metrics import Gauge, record_phase
+import asyncio
+import contextvars
+import time
+import config
+
+# agent session the current LLM request is made for, used to queue fairly and to report the queue position
+llm_session = contextvars.ContextVar('llm_session', default=None)
+
+CHARS_PER_TOKEN_ESTIMATE = 4
+# charged on admission for the response, corrected with the reported usage when the request finishes
+COMPLETION_TOKENS_ESTIMATE = 1000
+
+llm_queue_depth = Gauge('llm_queue_depth', 'LLM requests waiting for the rate limiter by model')
+
+_limiters = {}
+
+
+def estimate_tokens(messages: list):
+    chars = sum(len(m['content']) if isinstance(m['content'], str) else len(str(m['content'])) for m in messages)
+    return chars // CHARS_PER_TOKEN_ESTIMATE + COMPLETION_TOKENS_ESTIMATE
+
+
+def get_rate_limiter(llm_engine_name: str):
+    """Returns the shared limiter for an engine, or None if LLM_RATE_LIMITS has no entry for it."""
+    limits = config.LLM_RATE_LIMITS.get(llm_engine_name)
+    if not limits:
+        return None
+    if llm_engine_name not in _limiters:
+        _limiters[llm_engine_name] = LLMRateLimiter(llm_engine_name, **limits)
+    return _limiters[llm_engine_name]
+
+
+class TokenBucket:
+    """Refills continuously at `per_minute` units per minute up to a burst of one minute's worth.
+
+    The level may go negative when a request turns out to use more than was reserved for it,
+    which delays the requests after it.
+    """
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def available(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.level
+
+    def wait_time(self, amount: float):
+        """Seconds until `amount` can be taken. Amounts above the capacity wait for a full bucket."""
+        missing = min(amount, self.capacity) - self.available()
+        return max(0, missing / self.rate)
+
+    def consume(self, amount: float):
+        self.level = min(self.capacity, self.available() - amount)
+
+
+class Admission:
+    """Holds the limiter's admission for one LLM request while it runs.
+
+    Used as `async with limiter.admit(messages) as admission`, with the usage reported through
+    `record_usage` so the token bucket is charged what the request actually used.
+    """
+
+    def __init__(self, limiter, tokens: int):
+        self.limiter = limiter
+        self.tokens = tokens
+        self.used = None
+
+    def record_usage(self, usage: dict):
+        self.used = (self.used or 0) + usage['prompt_tokens'] + usage['completion_tokens']
+
+    async def __aenter__(self):
+        if self.limiter is not None:
+            await self.limiter.acquire(self.tokens)
+        return self
+
+    async def __aexit__(self, *exc):
+        if self.limiter is not None:
+            self.limiter.release(self.tokens, self.used)
+        return False
+
+
+class LLMRateLimiter:
+    """Admits requests to one engine within requests per minute, tokens per minute and concurrency limits.
+
+    Waiting requests are queued per agent session and admitted round-robin across sessions, so a
+    session with several requests in flight (e.g. candidates) cannot starve the others. While a
+    request waits, its session is sent `llm_queue` events with its position and an estimated wait.
+    """
+
+    def __init__(self, name: str, rpm: float = None, tpm: float = None, concurrency: int = None):
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.concurrency = concurrency
+        self.in_flight = 0
+        self.queues = OrderedDict() # session id -> waiting requests, in round-robin order
+        self.changed = asyncio.Event()
+
+    def admit(self, messages: list):
+        return Admission(self, estimate_tokens(messages))
+
+    def _notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def _wait_time(self, tokens: int):
+        """Seconds until a request of `tokens` fits in the buckets, None if it has to wait for a release."""
+        if self.concurrency and self.in_flight >= self.concurrency:
+            return None
+        delays = [0]
+        if self.requests:
+            delays.append(self.requests.wait_time(1))
+        if self.tokens:
+            delays.append(self.tokens.wait_time(tokens))
+        return max(delays)
+
+    def _position(self, session_id, waiter, tokens: int):
+        """Returns the number of requests admitted before `waiter` and an estimate of the seconds until it is admitted."""
+        index = self.queues[session_id].index(waiter)
+        rank = list(self.queues).index(session_id)
+        ahead = 0
+        for i, queue in enumerate(self.queues.values()):
+            # one request per session and round, sessions earlier in the rotation go first
+            ahead += min(len(queue), index)
+            if i < rank and len(queue) > index:
+                ahead += 1
+
+        eta = 0
+        if self.requests:
+            eta = max(eta, (ahead + 1 - self.requests.available()) / self.requests.rate)
+        if self.tokens:
+            eta = max(eta, ((ahead + 1) * tokens - self.tokens.available()) / self.tokens.rate)
+        return ahead, max(0, eta)
+
+    def _remove(self, session_id, waiter, admitted: bool):
+        queue = self.queues[session_id]
+        queue.remove(waiter)
+        if not queue:
+            del self.queues[session_id]
+        elif admitted:
+            # the session goes to the back of the rotation once one of its requests is admitted
+            self.queues.move_to_end(session_id)
+        llm_queue_depth.set(sum(len(q) for q in self.queues.values()), model=self.name)
+
+    async def acquire(self, tokens: int):
+        session_id = llm_session.get()
+        waiter = object()
+        self.queues.setdefault(session_id, deque()).append(waiter)
+        llm_queue_depth.set(sum(len(q) for q in self.queues.values()), model=self.name)
+
+        start = time.perf_counter()
+        reported = None
+        try:
+            while True:
+                changed = self.changed
+                delay = None
+                if next(iter(self.queues)) == session_id and self.queues[session_id][0] is waiter:
+                    delay = self._wait_time(tokens)
+                    if delay == 0:
+                        break
+
+                ahead, eta = self._position(session_id, waiter, tokens)
+                if session_id is not None and ahead != reported:
+                    reported = ahead
+                    await broker.publish(session_id, {'type': 'llm_queue', 'engine': self.name, 'position': ahead + 1, 'eta': round(eta, 1)})
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            self._remove(session_id, waiter, admitted=False)
+            self._notify()
+            raise
+
+        self._remove(session_id, waiter, admitted=True)
+        self.in_flight += 1
+        if self.requests:
+            self.requests.consume(1)
+        if self.tokens:
+            self.tokens.consume(tokens)
+        self._notify()
+
+        record_phase('llm_queue', time.perf_counter() - start)
+        if reported is not None:
+            try:
+                await broker.publish(session_id, {'type': 'llm_queue', 'engine': self.name, 'position': 0, 'eta': 0})
+            except BaseException:
+                self.release(tokens)
+                raise
+
+    def release(self, tokens: int, used: int = None):
+        self.in_flight -= 1
+        if self.tokens and used is not None:
+            self.tokens.consume(used - tokens)
+        self._notify()
@@ -0,0 +1,52 @@
+from quart import Blueprint, request, Response
+from diagnostics import loop_lag_monitor, capture_profile, profile_lock
+import functools
+import hmac
+import os
+import config
+
+admin_blueprint = Blueprint('admin', __name__)
+
+
+def require_admin(route):
+    """Only lets requests with `Authorization: Bearer <ADMIN_TOKEN>` through. Disabled without ADMIN_TOKEN."""
+    @functools.wraps(route)
+    async def _route(*args, **kwargs):
+        token = os.getenv('ADMIN_TOKEN')
+        if not token:
+            return {"error": "Not found"}, 404
+        auth = request.headers.get("Authorization", "")
+        if not hmac.compare_digest(auth.encode('utf-8'), f"Bearer {token}".encode('utf-8')):
+            return {"error": "Unauthorized"}, 401
+        return await route(*args, **kwargs)
+    return _route
+
+
+@admin_blueprint.route("/loop_lag", methods=["GET"])
+@require_admin
+async def loop_lag():
+    return {"threshold": loop_lag_monitor.threshold, "reports": list(loop_lag_monitor.reports)}
+
+
+@admin_blueprint.route("/profile", methods=["GET"])
+@require_admin
+async def profile():
+    seconds = min(request.args.get("seconds", 10, type=float), config.PROFILE_MAX_SECONDS)
+    clock = request.args.get("clock", "wall")
+    if clock not in ("wall", "cpu"):
+        return {"error": "clock must be 'wall' or 'cpu'"}, 400
+    if profile_lock.locked():
+        return {"error": "A profile is already being captured"}, 409
+
+    async with profile_lock:
+        path = await capture_profile(seconds, clock)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    finally:
+        os.remove(path)
+
+    # inspect with `python -m pstats profile.pstats` or snakeviz
+    return Response(data, mimetype="application/octet-stream", headers={
+        "Content-Disposition": f'attachment; filename="profile-{clock}-{int(seconds)}s.pstats"',
+    })
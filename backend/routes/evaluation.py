@@ -1,21 +1,30 @@
 from quart import Blueprint, request
-import subprocess
+from evaluation_jobs import evaluation_queue
 
 evaluation_blueprint = Blueprint('evaluation', __name__)
 
 @evaluation_blueprint.route("/", methods=["POST"])
 async def evaluate_task():
-    data = request.json
+    data = await request.json
     instance_id = data.get('instance_id')
-    
-    try:
-        # Run the evaluation script with the instance ID as an argument
-        result = subprocess.run(
-            ["python3", "evaluation_scripts/eval_script.py", instance_id],
-            capture_output=True, text=True
-        )
-        
-        # Return the output of the evaluation script
-        return {"success": True, "output": result.stdout}
-    except Exception as e:
-        return {"success": False, "error": str(e)}
+    if not instance_id:
+        return {"success": False, "error": "No instance_id provided."}, 400
+
+    # With `async: true` the job is returned right away, poll GET /api/evaluate/<job_id> or listen
+    # for `evaluation` messages on the agent session's websocket for the result
+    job = evaluation_queue.submit(instance_id, data.get('agent_session_id'))
+    if data.get('async'):
+        return job, 202
+
+    job = await evaluation_queue.wait(job['id'])
+    if job['status'] != 'done':
+        return {"success": False, "error": job['error'], "output": job['output'], "job": job}
+    return {"success": True, "output": job['output'], "job": job}
+
+
+@evaluation_blueprint.route("/<string:job_id>", methods=["GET"])
+async def get_evaluation(job_id: str):
+    job = evaluation_queue.get(job_id)
+    if job is None:
+        return {"error": "Evaluation job not found."}, 404
+    return job
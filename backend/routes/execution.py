@@ -1,18 +1,25 @@
 from quart import Blueprint, request, websocket
 from agent_session import AgentSession
+from agent_session.base_backend import compact_state, page
 from agent import ScienceAgent
 from broker import broker
 from container import Container
 from storage import Storage
-from llm_engine import LLMEngine
-import json
+from llm_engine import get_llm_engine
+from archives import is_archive, extract_archive_to_storage, read_archive_manifest, remove_members, ARCHIVE_ERRORS
+from wire_format import WireFormat
+from metrics import Timer, command_latency, command_phases
 import asyncio
 import traceback
+import tempfile
 import config
 import os
 
 execution_blueprint = Blueprint('execution', __name__)
 
+# commands handled by execute_command, other names are reported as 'other' in the metrics
+COMMANDS = {'solve_task', 'follow_up', 'run_program', 'update_program', 'update_task_inputs', 'clear', 'cancel'}
+
 class AgentWebSocketConnection:
     def __init__(self, agent_session: AgentSession):
         self.agent_session = agent_session
@@ -26,9 +33,10 @@ class AgentWebSocketConnection:
 
     def get_llm_engine(self, data: dict):
         if data.get("llm_engine_name") and data.get("llm_api_key"):
-            llm_engine = LLMEngine(data.get("llm_engine_name"), api_key=data.get("llm_api_key"), base_url=data.get("llm_base_url"))
+            llm_engine = get_llm_engine(data.get("llm_engine_name"), api_key=data.get("llm_api_key"), base_url=data.get("llm_base_url"))
         else:
-            llm_engine = LLMEngine(config.LLM_ENGINE_NAME, api_key=os.getenv('LLM_API_KEY'), base_url=config.LLM_BASE_URL)
+            llm_engine = get_llm_engine(config.LLM_ENGINE_NAME, api_key=os.getenv('LLM_API_KEY'), base_url=config.LLM_BASE_URL,
+                                        fallback_engine_names=config.LLM_FALLBACK_ENGINES)
         return llm_engine
 
     async def execute_command(self, command: str, data: dict):
@@ -37,6 +45,7 @@ class AgentWebSocketConnection:
                 self.container,
                 self.get_llm_engine(data),
                 data.get("use_self_debug", True),
+                min(int(data.get("num_candidates", 1)), config.MAX_CANDIDATES),
             )
         elif command == 'follow_up':
             await self.agent.ask_follow_up(
@@ -77,8 +86,13 @@ class AgentWebSocketConnection:
         command_id = data['command_id']
 
         async def _run():
+            # phases recorded while the command runs are sent to the client in a `timing` message
+            phases = {}
+            command_phases.set(phases)
+            timer = Timer(command_latency, command=command if command in COMMANDS else 'other')
             try:
-                result = await self.execute_command(command, data)
+                with timer:
+                    result = await self.execute_command(command, data)
                 if not result:
                     result = {}
                 result["command_id"] = command_id
@@ -94,6 +108,11 @@ class AgentWebSocketConnection:
                 print("Error while executing command:", command)
                 traceback.print_exc()
                 await broker.publish(self.agent_session.id, {"type": "error", "message": "Internal server error", "command_id": command_id})
+            finally:
+                if timer.elapsed is not None:
+                    await broker.publish(self.agent_session.id, {
+                        "type": "timing", "command": command, "command_id": command_id, "total": timer.elapsed, "phases": dict(phases),
+                    })
 
         new_task = asyncio.create_task(_run())
 
@@ -113,8 +132,15 @@ class AgentWebSocketConnection:
 
 @execution_blueprint.websocket("/ws/<string:agent_session_id>")
 async def ws(agent_session_id: str):
+    # clients that reconnect with the seq of the last event they received only get the missed events
+    since = websocket.args.get("since", type=int)
+    # clients that page in older history, logs and code file contents can ask for a small initial state
+    compact = websocket.args.get("state") == "compact"
+    # ?format=msgpack, see WireFormat
+    wire_format = WireFormat.from_args(websocket.args)
     try:
         agent_session = AgentSession(agent_session_id)
+        seq = await broker.latest_seq(agent_session_id)
         initial_state = await agent_session.get()
         if not initial_state:
             return {"error": "Invalid Agent Session ID"}, 403
@@ -124,13 +150,20 @@ async def ws(agent_session_id: str):
         print("Error getting session state:", e)
         return {"error": "Internal server error"}, 403
 
+    async def _send_state(state: dict, seq: int):
+        if compact:
+            state = compact_state(state, config.STATE_HISTORY_LIMIT, config.STATE_EXECUTION_LOG_LIMIT)
+        response = {
+            "type": "state",
+            "state": state,
+            "has_default_llm": bool(config.LLM_ENGINE_NAME),
+            "seq": seq,
+        }
+        await websocket.send(wire_format.encode(response))
+
     # Send the initial session state to the client
-    response = {
-        "type": "state",
-        "state": initial_state,
-        "has_default_llm": bool(config.LLM_ENGINE_NAME),
-    }
-    await websocket.send(json.dumps(response))
+    if since is None:
+        await _send_state(initial_state, seq)
 
     connection = AgentWebSocketConnection(agent_session)
     await connection.init()
@@ -139,11 +172,17 @@ async def ws(agent_session_id: str):
         while True:
             message = await websocket.receive()
             print(f"Session {agent_session_id} command: {message}")
-            connection.handle_message(json.loads(message))
+            connection.handle_message(wire_format.decode(message))
 
     async def _send():
-        async for message in broker.subscribe(agent_session_id):
-            await websocket.send(json.dumps(message))
+        async for message in broker.subscribe(agent_session_id, since=since):
+            if message.get("type") == "resync":
+                # the missed events are no longer available, send a full snapshot instead
+                await _send_state(await agent_session.get(), message["seq"])
+                continue
+            if message.get("type") == "resume":
+                message["has_default_llm"] = bool(config.LLM_ENGINE_NAME)
+            await websocket.send(wire_format.encode(message))
 
     try:
         print("WebSocket connection established for session", agent_session_id)
@@ -169,18 +208,55 @@ async def create_session():
     return { "agent_session_id": agent_session_id }
 
 
+async def get_user_session_state(agent_session_id: str):
+    """Returns (state, None) for a user session, or (None, error response) if it does not exist or is not a user session."""
+    try:
+        state = await AgentSession(agent_session_id).get()
+    except FileNotFoundError:
+        state = None
+    if not state:
+        return None, ({"error": "Invalid Agent Session ID"}, 404)
+    if state.get('metadata', {}).get('source') != 'user':
+        return None, ({"error": "Only user sessions can be modified"}, 403)
+    return state, None
+
+
 @execution_blueprint.route("/agent_session/validate", methods=["POST"])
 async def validate_session():
     data = await request.json
-    agent_session_id = data.get("agent_session_id")
-    initial_state = await AgentSession(agent_session_id).get()
-    if not initial_state:
-        return {"error": "Invalid Agent Session ID"}, 404
-    if initial_state.get('metadata', {}).get('source') != 'user':
-        return {"error": "Only user sessions can be modified"}, 400
+    _, error = await get_user_session_state(data.get("agent_session_id"))
+    if error:
+        return error
     return { "message": "Valid session" }
 
 
+@execution_blueprint.route("/agent_session/<string:agent_session_id>/history", methods=["GET"])
+async def get_history_page(agent_session_id: str):
+    state, error = await get_user_session_state(agent_session_id)
+    if error:
+        return error
+    return page(state.get('history', []), request.args.get("before", type=int), request.args.get("limit", 50, type=int))
+
+
+@execution_blueprint.route("/agent_session/<string:agent_session_id>/execution_log", methods=["GET"])
+async def get_execution_log_page(agent_session_id: str):
+    state, error = await get_user_session_state(agent_session_id)
+    if error:
+        return error
+    return page(state.get('execution_log', []), request.args.get("before", type=int), request.args.get("limit", 20, type=int))
+
+
+@execution_blueprint.route("/agent_session/<string:agent_session_id>/code_files/<string:code_file_id>", methods=["GET"])
+async def get_code_file(agent_session_id: str, code_file_id: str):
+    state, error = await get_user_session_state(agent_session_id)
+    if error:
+        return error
+    for code_file in state.get('code_files', []):
+        if code_file['id'] == code_file_id:
+            return code_file
+    return {"error": "Code file not found."}, 404
+
+
 @execution_blueprint.route("/upload/<string:agent_session_id>", methods=["POST"])
 async def upload_file(agent_session_id: str):
     if not agent_session_id:
@@ -193,6 +269,9 @@ async def upload_file(agent_session_id: str):
         return {"error": "No selected file"}, 400
 
     object_name = f"{agent_session_id}/{file.filename}"
+    if is_archive(file.filename):
+        return await upload_archive(AgentSession(agent_session_id), file, object_name)
+
     await Storage.upload_file_stream(file, object_name)
     file_size = request.content_length or 0
     file_info = {'name': file.filename, 'size': file_size, 'object_name': object_name, 'source': 'user'}
@@ -201,15 +280,49 @@ async def upload_file(agent_session_id: str):
     return file_info
 
 
+async def upload_archive(agent_session: AgentSession, file, object_name: str):
+    # Archives are extracted once here so that sessions only ever download the members. The
+    # session stores a single entry for the archive, its members are listed in a manifest.
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        archive_path = os.path.join(tmp_dir, os.path.basename(file.filename))
+        await file.save(archive_path)
+        await Storage.upload_file(archive_path, object_name)
+        file_info = {'name': file.filename, 'size': os.path.getsize(archive_path), 'object_name': object_name, 'source': 'user'}
+
+        try:
+            num_members, manifest_object_name = await extract_archive_to_storage(
+                archive_path, file.filename, agent_session.id)
+        except ARCHIVE_ERRORS as e:
+            print("Failed to extract archive", file.filename, e)
+            file_info['extract_error'] = str(e)
+            await agent_session.add_uploaded_file(file_info)
+            return file_info
+        except BaseException:
+            await Storage.remove_file(object_name)
+            raise
+
+    file_info['extracted'] = True
+    file_info['manifest'] = manifest_object_name
+    file_info['members'] = num_members
+    await agent_session.add_uploaded_file(file_info)
+
+    return file_info
+
+
 @execution_blueprint.route("/upload/<string:agent_session_id>/<string:filename>", methods=["DELETE"])
 async def remove_file(agent_session_id: str, filename: str):
     if not agent_session_id:
         return {"error": "No Agent Session ID provided."}, 400
 
-    file = await AgentSession(agent_session_id).remove_uploaded_file(filename)
+    agent_session = AgentSession(agent_session_id)
+    file = await agent_session.remove_uploaded_file(filename)
 
     # Only delete user-uploaded files, not preloaded dataset files
     if file and file.get('source') == 'user':
         await Storage.remove_file(file.get('object_name'))
 
+        if file.get('extracted'):
+            await remove_members(await read_archive_manifest(file['manifest']))
+            await Storage.remove_file(file['manifest'])
+
     return {"message": "File deleted."}
@@ -0,0 +1,203 @@
+# This script runs the agent over the ScienceAgentBench tasks uploaded by `preload_benchmark.py`
+# without the web interface. Each task gets a new user session, like opening it in the UI.
+# Results are appended to a JSONL file as tasks finish, and tasks already in it are skipped,
+# so an interrupted run can be resumed by running the same command again.
+#   python run_benchmark.py [--containers 4] [--llm-slots 8] [--timeout 3600] [--results benchmark_results.jsonl]
+
+from agent_session import AgentSession
+from agent import ScienceAgent
+from broker import broker
+from container import Container
+from llm_engine import get_llm_engine
+from metrics import Histogram, llm_latency
+import argparse
+import asyncio
+import json
+import os
+import time
+import traceback
+import config
+
+
+class LimitedLLMEngine:
+    """Wraps an LLM engine so that at most `slots` requests are in flight across all tasks."""
+
+    def __init__(self, engine, slots: int):
+        self.engine = engine
+        self.slots = asyncio.Semaphore(slots)
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    async def respond_stream(self, *args, **kwargs):
+        async with self.slots:
+            async for item in self.engine.respond_stream(*args, **kwargs):
+                yield item
+
+    async def respond(self, *args, **kwargs):
+        async with self.slots:
+            return await self.engine.respond(*args, **kwargs)
+
+
+async def track_phases(agent_session_id: str, phases: dict):
+    """Records the duration of every LLM response and command of a session by phase."""
+    responses = {}
+    commands = {}
+    async for message in broker.subscribe(agent_session_id):
+        now = time.perf_counter()
+        kind = message.get('type') # command results have no type
+        if kind == 'response_start':
+            responses[message['id']] = now
+        elif kind == 'response_end' and message['id'] in responses:
+            phases.setdefault('llm', []).append(now - responses.pop(message['id']))
+        elif kind == 'execution_start':
+            commands.setdefault(message.get('tag') or 'command', []).append(now)
+        elif kind == 'execution_end':
+            started = commands.get(message.get('tag') or 'command')
+            if started:
+                phases.setdefault(message.get('tag') or 'command', []).append(now - started.pop(0))
+
+
+def summarize_session(session: dict):
+    runs = [log for log in session.get('execution_log', []) if log.get('tag') == 'run']
+    return {
+        'valid_execution': bool(runs) and runs[-1]['exit_code'] == 0 and bool(session.get('output_files')),
+        'program_runs': len(runs),
+        'prompt_tokens': session.get('total_prompt_tokens', 0),
+        'completion_tokens': session.get('total_completion_tokens', 0),
+        'cost': float(session.get('total_cost', 0)),
+    }
+
+
+async def run_task(task: dict, llm_engine, args):
+    instance_id = task['metadata'].get('instance_id')
+    prefill = {k: v for k, v in task.items() if k != 'id'}
+    prefill['metadata'] = {**task['metadata'], 'source': 'user'}
+    agent_session = AgentSession(await AgentSession.create(prefill))
+
+    container = Container(agent_session)
+    agent = ScienceAgent(agent_session)
+    phases = {}
+    tracker = asyncio.create_task(track_phases(agent_session.id, phases))
+    await asyncio.sleep(0) # let the tracker subscribe before the agent publishes anything
+
+    result = {'instance_id': instance_id, 'agent_session_id': agent_session.id, 'status': 'success', 'error': None}
+    start = time.perf_counter()
+    try:
+        await container.make_dirs()
+        await asyncio.wait_for(
+            agent.solve_task(container, llm_engine, not args.no_self_debug, args.num_candidates),
+            timeout=args.timeout)
+    except asyncio.TimeoutError:
+        result['status'] = 'timeout'
+    except Exception as e:
+        traceback.print_exc()
+        result['status'] = 'error'
+        result['error'] = str(e)
+    finally:
+        result['wall_time'] = time.perf_counter() - start
+        tracker.cancel()
+        try:
+            await container.destroy()
+        except Exception as e:
+            print("Failed to destroy container for", instance_id, e)
+
+    result.update(summarize_session(await agent_session.get()))
+    if result['status'] == 'success' and not result['valid_execution']:
+        result['status'] = 'failed'
+    result['phases'] = phases
+    return result
+
+
+def write_report(results: list, wall_time: float, path: str):
+    phase_latency = Histogram('benchmark_phase_seconds', 'Duration of each LLM response and command by phase', window=None)
+    task_time = Histogram('benchmark_task_seconds', 'Wall time per task', window=None)
+    for result in results:
+        task_time.observe(result['wall_time'])
+        for phase, durations in result.get('phases', {}).items():
+            for duration in durations:
+                phase_latency.observe(duration, phase=phase)
+
+    statuses = {}
+    for result in results:
+        statuses[result['status']] = statuses.get(result['status'], 0) + 1
+
+    report = {
+        'tasks': len(results),
+        'statuses': statuses,
+        'success_rate': statuses.get('success', 0) / len(results) if results else 0,
+        'prompt_tokens': sum(r['prompt_tokens'] for r in results),
+        'completion_tokens': sum(r['completion_tokens'] for r in results),
+        'cost': sum(r['cost'] for r in results),
+        'wall_time': wall_time,
+        'task_wall_time': task_time.summary(),
+        'phase_latency': phase_latency.summary(),
+        'llm_latency': llm_latency.summary(),
+    }
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=4)
+
+    print(f"{report['tasks']} tasks: {statuses}, success rate {report['success_rate']:.1%}")
+    print(f"tokens: {report['prompt_tokens']} prompt, {report['completion_tokens']} completion, cost ${report['cost']:.2f}")
+    print(f"wall time: {wall_time:.0f}s for this run")
+    for row in report['phase_latency']:
+        print(f"  {row['labels']['phase']}: n={row['count']} p50={row['p50']:.1f}s p90={row['p90']:.1f}s p99={row['p99']:.1f}s")
+    print("Report written to", path)
+
+
+async def run_benchmark(args):
+    results = []
+    if os.path.exists(args.results):
+        with open(args.results) as f:
+            results = [json.loads(line) for line in f if line.strip()]
+    if args.retry_failed:
+        results = [r for r in results if r['status'] == 'success']
+    done = {r['instance_id'] for r in results}
+
+    tasks = sorted(await AgentSession.get_benchmark_tasks(), key=lambda t: int(t['metadata'].get('instance_id', 0)))
+    if args.instance_ids:
+        tasks = [t for t in tasks if str(t['metadata'].get('instance_id')) in args.instance_ids]
+    tasks = [t for t in tasks if t['metadata'].get('instance_id') not in done]
+    if args.limit:
+        tasks = tasks[:args.limit]
+    print(f"Running {len(tasks)} tasks ({len(done)} already in {args.results})")
+
+    llm_engine = LimitedLLMEngine(
+        get_llm_engine(args.llm_engine, api_key=os.getenv('LLM_API_KEY'), base_url=config.LLM_BASE_URL,
+                       fallback_engine_names=config.LLM_FALLBACK_ENGINES),
+        args.llm_slots)
+    containers = asyncio.Semaphore(args.containers)
+
+    if args.retry_failed:
+        # rewrite the results without the failures that are about to be retried
+        with open(args.results, 'w') as f:
+            f.writelines(json.dumps(r) + '\n' for r in results)
+
+    async def _run(task):
+        async with containers:
+            print("Starting task", task['metadata'].get('instance_id'))
+            result = await run_task(task, llm_engine, args)
+        print(f"Finished task {result['instance_id']}: {result['status']} in {result['wall_time']:.0f}s")
+        with open(args.results, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+        results.append(result)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[_run(task) for task in tasks])
+    write_report(results, time.perf_counter() - start, args.report)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--containers', type=int, default=4, help="tasks (and their containers) running at the same time")
+    parser.add_argument('--llm-slots', type=int, default=8, help="LLM requests in flight at the same time")
+    parser.add_argument('--timeout', type=float, default=3600, help="seconds per task")
+    parser.add_argument('--results', default='benchmark_results.jsonl')
+    parser.add_argument('--report', default='benchmark_report.json')
+    parser.add_argument('--llm-engine', default=config.LLM_ENGINE_NAME)
+    parser.add_argument('--num-candidates', type=int, default=1)
+    parser.add_argument('--no-self-debug', action='store_true')
+    parser.add_argument('--limit', type=int, default=None, help="run at most this many tasks")
+    parser.add_argument('--instance-ids', nargs='*', default=None)
+    parser.add_argument('--retry-failed', action='store_true', help="rerun tasks whose stored result is not a success")
+    asyncio.run(run_benchmark(parser.parse_args()))
@@ -0,0 +1,161 @@
+from container import Container
+import ast
+import functools
+import importlib.resources
+import os
+import re
+import sys
+
+
+# pip package names for common modules whose import name differs from the distribution name
+PACKAGE_NAMES = {
+    'sklearn': 'scikit-learn',
+    'skimage': 'scikit-image',
+    'cv2': 'opencv-python',
+    'PIL': 'Pillow',
+    'yaml': 'PyYAML',
+    'Bio': 'biopython',
+    'bs4': 'beautifulsoup4',
+    'dateutil': 'python-dateutil',
+    'docx': 'python-docx',
+    'umap': 'umap-learn',
+    'igraph': 'python-igraph',
+    'mpl_toolkits': 'matplotlib',
+    'osgeo': 'GDAL',
+    'Crypto': 'pycryptodome',
+    'google.protobuf': 'protobuf',
+}
+
+# packages installed under their import name, other modules are only installed through a known mapping
+KNOWN_PACKAGES = {
+    'numpy', 'pandas', 'scipy', 'matplotlib', 'seaborn', 'statsmodels', 'sympy', 'networkx', 'plotly',
+    'h5py', 'xarray', 'netCDF4', 'pyarrow', 'openpyxl', 'tables', 'zarr',
+    'torch', 'torchvision', 'tensorflow', 'keras', 'xgboost', 'lightgbm', 'catboost', 'transformers',
+    'joblib', 'tqdm', 'numba', 'nltk', 'requests',
+    'geopandas', 'shapely', 'pyproj', 'rasterio', 'fiona', 'astropy', 'nibabel', 'mne',
+    'rdkit', 'pymatgen', 'ase', 'deepchem', 'scanpy', 'anndata', 'pysam', 'biotite',
+}
+
+# top-level names shared by many distributions, only full module names in PACKAGE_NAMES are installed
+NAMESPACE_PACKAGES = {'google', 'azure', 'jaraco', 'zope'}
+
+CHECK_IMPORTS_SCRIPT = (
+    "import importlib.util, sys\n"
+    "print('MISSING:' + ' '.join(m for m in sys.argv[1:] if importlib.util.find_spec(m) is None))"
+)
+
+
+class CodeFenceParser:
+    """Incrementally finds complete ```python blocks in a streamed response."""
+
+    OPEN_FENCE = "```python"
+    CLOSE_FENCE = "```"
+
+    def __init__(self):
+        self.buffer = ''
+        self.pos = 0 # everything before pos has been scanned
+        self.block_start = None
+
+    def feed(self, chunk: str):
+        """Adds a chunk of the response and returns the code blocks completed by it."""
+        self.buffer += chunk
+        blocks = []
+        while True:
+            if self.block_start is None:
+                index = self.buffer.find(self.OPEN_FENCE, self.pos)
+                if index == -1:
+                    # a fence may be split across chunks, rescan the tail next time
+                    self.pos = max(self.pos, len(self.buffer) - len(self.OPEN_FENCE))
+                    return blocks
+                self.block_start = index + len(self.OPEN_FENCE)
+                self.pos = self.block_start
+            else:
+                index = self.buffer.find(self.CLOSE_FENCE, self.pos)
+                if index == -1:
+                    self.pos = max(self.pos, len(self.buffer) - len(self.CLOSE_FENCE))
+                    return blocks
+                blocks.append(self.buffer[self.block_start:index].strip())
+                self.block_start = None
+                self.pos = index + len(self.CLOSE_FENCE)
+
+
+def extract_imports(code: str):
+    """Returns the top-level third-party module names imported by a program."""
+    modules = set()
+    try:
+        tree = ast.parse(code)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                modules.update(alias.name for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                modules.add(node.module)
+    except SyntaxError:
+        for match in re.finditer(r'^\s*(?:from\s+([\w.]+)\s+import|import\s+([\w.]+))', code, re.MULTILINE):
+            modules.add(match.group(1) or match.group(2))
+
+    names = set()
+    for module in modules:
+        if module in PACKAGE_NAMES:
+            names.add(module)
+            continue
+        top_level = module.split('.')[0]
+        if top_level and top_level not in sys.stdlib_module_names and top_level != '__future__':
+            names.add(top_level)
+    return sorted(names)
+
+
+@functools.lru_cache(maxsize=None)
+def pipreqs_mapping():
+    """Import name to distribution name mapping shipped with pipreqs."""
+    try:
+        text = importlib.resources.files('pipreqs').joinpath('mapping').read_text()
+    except (ModuleNotFoundError, FileNotFoundError) as e:
+        print("pipreqs mapping not available:", e)
+        return {}
+    return dict(line.strip().split(':', 1) for line in text.splitlines() if ':' in line)
+
+
+def package_name(module: str):
+    """Returns the pip package for a module, or None if it is not known well enough to install it
+    before the program has run (it is then left to the regular pipreqs install)."""
+    if module in PACKAGE_NAMES:
+        return PACKAGE_NAMES[module]
+    if module in NAMESPACE_PACKAGES:
+        return None
+    if module in KNOWN_PACKAGES:
+        return module
+    return pipreqs_mapping().get(module)
+
+
+def is_local_module(container: Container, module: str):
+    top_level = module.split('.')[0]
+    eval_dir = container.get_eval_dir()
+    return os.path.exists(os.path.join(eval_dir, top_level + '.py')) or os.path.isdir(os.path.join(eval_dir, top_level))
+
+
+async def install_missing_packages(container: Container, modules: list):
+    """Installs pip packages for the modules that cannot be imported in the container.
+
+    Only modules with a known package are considered. Returns the list of packages that were
+    installed, or None if checking the imports or installing failed.
+    """
+    # modules of the workspace itself and names that do not map to a known package are skipped
+    modules = [m for m in modules if package_name(m) and not is_local_module(container, m)]
+    if not modules:
+        return []
+
+    output, exit_code = await container.run_command(
+        ["python", "-c", CHECK_IMPORTS_SCRIPT, *modules], message_tag="install")
+    if exit_code != 0:
+        return None
+    missing_lines = [line for line in output.splitlines() if line.startswith('MISSING:')]
+    if not missing_lines:
+        return []
+
+    missing = missing_lines[-1][len('MISSING:'):].split()
+    if not missing:
+        return []
+
+    packages = sorted({package_name(m) for m in missing})
+    _, exit_code = await container.run_command(["pip", "install", *packages], message_tag="install")
+    return packages if exit_code == 0 else None
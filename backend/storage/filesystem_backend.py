@@ -1,3 +1,4 @@
+from contextlib import nullcontext
 import os
 import aiofiles.os
 import config
@@ -5,6 +6,10 @@ import aiofiles
 import aioshutil
 
 class FilesystemStorage:
+    @staticmethod
+    def initialize():
+        pass
+
     @staticmethod
     async def upload_file_stream(file, object_name: str):
         save_path = os.path.join(config.STORAGE_DIR, object_name)
@@ -18,7 +23,11 @@ class FilesystemStorage:
         return save_path
 
     @staticmethod
-    async def upload_file(local_path: str, object_name: str):
+    def client():
+        return nullcontext()
+
+    @staticmethod
+    async def upload_file(local_path: str, object_name: str, client=None):
         os.makedirs(os.path.dirname(local_path), exist_ok=True)
         async with aiofiles.open(local_path, 'rb') as f:
             content = await f.read()
@@ -29,13 +38,13 @@ class FilesystemStorage:
             await f.write(content)
 
     @staticmethod
-    async def download_file(object_name: str, local_path: str):
+    async def download_file(object_name: str, local_path: str, client=None):
         await aioshutil.copyfile(
             os.path.join(config.STORAGE_DIR, object_name),
             local_path
         )
 
     @staticmethod
-    async def remove_file(object_name: str):
+    async def remove_file(object_name: str, client=None):
         file_path = os.path.join(config.STORAGE_DIR, object_name)
         await aiofiles.os.remove(file_path)
\ No newline at end of file
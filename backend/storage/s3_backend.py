@@ -1,25 +1,38 @@
-import aioboto3
+from aws import get_boto3_session
 import config
 
-boto3_session = aioboto3.Session(region_name=config.AWS_REGION)
-
 class S3Storage:
+    @staticmethod
+    def initialize():
+        get_boto3_session()
+
     @staticmethod
     async def upload_file_stream(file, object_name: str):
-        async with boto3_session.client('s3') as s3:
+        async with get_boto3_session().client('s3') as s3:
             await s3.upload_fileobj(file.stream, config.S3_BUCKET, object_name)
 
     @staticmethod
-    async def upload_file(local_path: str, object_name: str):
-        async with boto3_session.client('s3') as s3:
-            await s3.upload_file(local_path, config.S3_BUCKET, object_name)
+    def client():
+        """Opens a client that many transfers can share by passing it as `client`."""
+        return get_boto3_session().client('s3')
+
+    @staticmethod
+    async def upload_file(local_path: str, object_name: str, client=None):
+        if client is None:
+            async with S3Storage.client() as s3:
+                return await s3.upload_file(local_path, config.S3_BUCKET, object_name)
+        await client.upload_file(local_path, config.S3_BUCKET, object_name)
 
     @staticmethod
-    async def download_file(object_name: str, local_path: str):
-        async with boto3_session.client('s3') as s3:
-            await s3.download_file(config.S3_BUCKET, object_name, local_path)
+    async def download_file(object_name: str, local_path: str, client=None):
+        if client is None:
+            async with S3Storage.client() as s3:
+                return await s3.download_file(config.S3_BUCKET, object_name, local_path)
+        await client.download_file(config.S3_BUCKET, object_name, local_path)
 
     @staticmethod
-    async def remove_file(object_name: str):
-        async with boto3_session.client('s3') as s3:
-            await s3.delete_object(Bucket=config.S3_BUCKET, Key=object_name)
\ No newline at end of file
+    async def remove_file(object_name: str, client=None):
+        if client is None:
+            async with S3Storage.client() as s3:
+                return await s3.delete_object(Bucket=config.S3_BUCKET, Key=object_name)
+        await client.delete_object(Bucket=config.S3_BUCKET, Key=object_name)
\ No newline at end of file
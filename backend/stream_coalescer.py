@@ -0,0 +1,50 @@
+from broker import broker
+import asyncio
+import config
+
+
+class StreamCoalescer:
+    """Batches streamed response deltas into fewer `response_chunk` messages.
+
+    Deltas for the same response id are buffered and published together once the buffer has
+    been open for window_ms or holds max_bytes of text, whichever comes first. flush() must be
+    called before the matching `response_end` is published.
+    """
+
+    def __init__(self, agent_session_id: str, window_ms=None, max_bytes=None):
+        self.agent_session_id = agent_session_id
+        self.window = (config.STREAM_COALESCE_WINDOW_MS if window_ms is None else window_ms) / 1000
+        self.max_bytes = config.STREAM_COALESCE_MAX_BYTES if max_bytes is None else max_bytes
+        self.buffers = {}
+        self.buffer_size = 0
+        self.flush_task = None
+        self.lock = asyncio.Lock()
+
+    async def add(self, response_id: str, text: str):
+        if self.window <= 0:
+            await broker.publish(self.agent_session_id, {'type': 'response_chunk', 'text': text, 'id': response_id})
+            return
+
+        self.buffers.setdefault(response_id, []).append(text)
+        self.buffer_size += len(text)
+        if self.buffer_size >= self.max_bytes:
+            await self.flush()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self.flush_task = None
+        await self._flush()
+
+    async def flush(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self._flush()
+
+    async def _flush(self):
+        async with self.lock:
+            buffers, self.buffers, self.buffer_size = self.buffers, {}, 0
+            for response_id, parts in buffers.items():
+                await broker.publish(self.agent_session_id, {'type': 'response_chunk', 'text': ''.join(parts), 'id': response_id})
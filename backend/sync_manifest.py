@@ -0,0 +1,50 @@
+from aioshutil import sync_to_async
+import hashlib
+import json
+import os
+
+
+def fingerprint(obj) -> str:
+    """Stable short hash of a JSON-serializable object."""
+    data = json.dumps(obj, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()[0:32]
+
+
+class SyncManifest:
+    """Records what has already been synced into a session's uploads directory.
+
+    `files` maps each storage object name to its local name and the fingerprint of the uploaded
+    file entry it was downloaded from, and `extracted` maps archive names to the fingerprint of the archive that
+    was unpacked. `digest` is the fingerprint of the whole uploaded file list, which lets a sync
+    with no changes return without touching the filesystem.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.digest = None
+        self.files = {}
+        self.extracted = {}
+
+    @sync_to_async
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            data = {}
+        self.digest = data.get('digest')
+        self.files = data.get('files', {})
+        self.extracted = data.get('extracted', {})
+
+    @sync_to_async
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'digest': self.digest, 'files': self.files, 'extracted': self.extracted}, f)
+        os.replace(tmp_path, self.path)
+
+    def reset(self):
+        self.digest = None
+        self.files = {}
+        self.extracted = {}
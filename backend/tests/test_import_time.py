@@ -0,0 +1,28 @@
+import os
+import subprocess
+import sys
+from benchmarks.import_time import measure
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# imported on first use, importing any of them at module level slows down every worker start
+DEFERRED_MODULES = ['litellm', 'aiodocker', 'aioboto3', 'openai', 'pandas', 'datasets', 'pipreqs']
+
+# generous enough for a slow CI machine, `import app` takes about 250ms locally
+IMPORT_BUDGET_MS = 2000
+
+
+def test_app_does_not_import_heavy_modules():
+    result = subprocess.run(
+        [sys.executable, '-c', f"import app, sys; print(','.join(m for m in {DEFERRED_MODULES!r} if m in sys.modules))"],
+        cwd=BACKEND, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr[-2000:]
+    imported = result.stdout.strip().splitlines()[-1] if result.stdout.strip() else ''
+    assert imported == '', f"`import app` imported {imported}"
+
+
+def test_app_import_time_is_within_budget(monkeypatch):
+    monkeypatch.chdir(BACKEND)
+    # fastest of a few runs, so a busy machine does not fail the test
+    total = min(measure('app')[0] for _ in range(3))
+    assert total / 1000 <= IMPORT_BUDGET_MS, f"`import app` took {total / 1000:.0f}ms"
@@ -0,0 +1,172 @@
+import asyncio
+import pytest
+import config
+from broker import RedisBroker
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa") # fakeredis needs it to run the publish script
+
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, timeout=10))
+
+
+async def receive(messages, count: int):
+    return [await asyncio.wait_for(messages.__anext__(), timeout=2) for _ in range(count)]
+
+
+async def subscribed(broker: RedisBroker, agent_session_id: str, since: int = None):
+    """Starts a subscription and waits until its channel is subscribed, so no live message is missed."""
+    messages = broker.subscribe(agent_session_id, since=since)
+    first = asyncio.ensure_future(messages.__anext__())
+    while broker.pubsub is None or broker._channel(agent_session_id).encode() not in broker.pubsub.channels:
+        await asyncio.sleep(0.01)
+    return messages, first
+
+
+async def logged(broker: RedisBroker, agent_session_id: str, output: str):
+    """Waits until the message with `output` is the last one in the session's log, publishes are sent in the background."""
+    while True:
+        _, log = await broker._read_log(agent_session_id)
+        if log and log[-1].get('output') == output:
+            return log
+        await asyncio.sleep(0.01)
+
+
+def test_publish_subscribe_in_order():
+    async def main():
+        broker = RedisBroker(client=fakeredis.FakeAsyncRedis())
+        messages, first = await subscribed(broker, 's1')
+        for i in range(5):
+            await broker.publish('s1', {'type': 'execution_chunk', 'output': str(i)})
+        received = [await first, *await receive(messages, 4)]
+        assert [m['output'] for m in received] == ['0', '1', '2', '3', '4']
+        seqs = [m['seq'] for m in received]
+        assert seqs == list(range(seqs[0], seqs[0] + 5))
+        assert await broker.latest_seq('s1') == seqs[-1]
+        await messages.aclose()
+        await broker.close()
+    run(main())
+
+
+def test_subscribers_on_other_processes_receive_messages():
+    async def main():
+        server = fakeredis.FakeServer()
+        publisher = RedisBroker(client=fakeredis.FakeAsyncRedis(server=server))
+        subscriber = RedisBroker(client=fakeredis.FakeAsyncRedis(server=server))
+        messages, first = await subscribed(subscriber, 's1')
+        await publisher.publish('s1', {'type': 'state_update', 'n': 1})
+        assert (await first)['n'] == 1
+        await messages.aclose()
+        await publisher.close()
+        await subscriber.close()
+    run(main())
+
+
+def test_resume_since_sends_only_missed_events():
+    async def main():
+        broker = RedisBroker(client=fakeredis.FakeAsyncRedis())
+        for i in range(5):
+            await broker.publish('s1', {'type': 'execution_chunk', 'output': str(i)})
+        await logged(broker, 's1', '4')
+        latest = await broker.latest_seq('s1')
+
+        messages, first = await subscribed(broker, 's1', since=latest - 2)
+        resume = await first
+        assert resume == {'type': 'resume', 'seq': latest - 2}
+        missed = await receive(messages, 2)
+        assert [m['output'] for m in missed] == ['3', '4']
+
+        await broker.publish('s1', {'type': 'execution_chunk', 'output': '5'})
+        live, = await receive(messages, 1)
+        assert live['output'] == '5' and live['seq'] == latest + 1
+        await messages.aclose()
+        await broker.close()
+    run(main())
+
+
+def test_resume_from_latest_seq_sends_no_events():
+    async def main():
+        broker = RedisBroker(client=fakeredis.FakeAsyncRedis())
+        await broker.publish('s1', {'type': 'execution_chunk', 'output': '0'})
+        await logged(broker, 's1', '0')
+        latest = await broker.latest_seq('s1')
+        messages, first = await subscribed(broker, 's1', since=latest)
+        assert await first == {'type': 'resume', 'seq': latest}
+        await messages.aclose()
+        await broker.close()
+    run(main())
+
+
+def test_resync_when_missed_events_were_trimmed(monkeypatch):
+    monkeypatch.setattr(config, 'BROKER_REPLAY_SIZE', 3)
+
+    async def main():
+        broker = RedisBroker(client=fakeredis.FakeAsyncRedis())
+        for i in range(10):
+            await broker.publish('s1', {'type': 'execution_chunk', 'output': str(i)})
+        log = await logged(broker, 's1', '9')
+        latest = await broker.latest_seq('s1')
+        assert [m['output'] for m in log] == ['7', '8', '9']
+
+        messages, first = await subscribed(broker, 's1', since=latest - 5)
+        assert await first == {'type': 'resync', 'seq': latest}
+        await messages.aclose()
+        await broker.close()
+    run(main())
+
+
+def test_resync_when_the_log_is_gone():
+    async def main():
+        client = fakeredis.FakeAsyncRedis()
+        broker = RedisBroker(client=client)
+        await broker.publish('s1', {'type': 'execution_chunk', 'output': '0'})
+        await logged(broker, 's1', '0')
+        stale = await broker.latest_seq('s1')
+        await client.flushall()
+
+        await broker.publish('s1', {'type': 'execution_chunk', 'output': '1'})
+        await logged(broker, 's1', '1')
+        latest = await broker.latest_seq('s1')
+        assert latest > stale # sequence numbers keep increasing after the log is lost
+        messages, first = await subscribed(broker, 's1', since=stale)
+        assert await first == {'type': 'resync', 'seq': latest}
+        await messages.aclose()
+        await broker.close()
+    run(main())
+
+
+def test_retried_batch_keeps_its_seqs():
+    from redis.exceptions import ConnectionError as RedisConnectionError
+
+    async def main():
+        client = fakeredis.FakeAsyncRedis()
+        broker = RedisBroker(client=client, batch_size=4, max_retry_delay=0.01)
+        pipeline = client.pipeline
+        failures = [1]
+
+        def flaky_pipeline(transaction=True, **kwargs):
+            pipe = pipeline(transaction=transaction, **kwargs)
+            if transaction:
+                return pipe # only the publisher's batches fail, not the test's log reads
+            execute = pipe.execute
+
+            async def _execute(**kw):
+                result = await execute(**kw)
+                if failures[0]:
+                    # the batch was applied but the reply was lost
+                    failures[0] -= 1
+                    raise RedisConnectionError("connection lost")
+                return result
+            pipe.execute = _execute
+            return pipe
+        client.pipeline = flaky_pipeline
+
+        for i in range(6):
+            await broker.publish('s1', {'type': 'execution_chunk', 'output': str(i)})
+        log = await logged(broker, 's1', '5')
+        assert [m['output'] for m in log] == ['0', '1', '2', '3', '4', '5']
+        seqs = [m['seq'] for m in log]
+        assert seqs == list(range(seqs[0], seqs[0] + 6))
+        await broker.close()
+    run(main())
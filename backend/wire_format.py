@@ -0,0 +1,46 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def dumps_json(message: dict):
+    if orjson is not None:
+        return orjson.dumps(message).decode('utf-8')
+    return json.dumps(message)
+
+
+class WireFormat:
+    """Encodes websocket messages in the format a connection negotiated.
+
+    `json` (default) sends text frames, `msgpack` sends binary MessagePack frames. Compression is
+    left to the RFC 7692 permessage-deflate extension, which Hypercorn negotiates with every
+    client that offers it (all browsers do), so clients need no decoder of their own.
+    """
+
+    def __init__(self, format: str = None):
+        if format == 'msgpack' and msgpack is None:
+            print("msgpack is not installed, falling back to JSON")
+            format = None
+        self.format = format or 'json'
+
+    @staticmethod
+    def from_args(args):
+        return WireFormat(args.get("format"))
+
+    def encode(self, message: dict):
+        if self.format == 'msgpack':
+            return msgpack.packb(message)
+        return dumps_json(message)
+
+    def decode(self, data):
+        if isinstance(data, bytes) and self.format == 'msgpack':
+            return msgpack.unpackb(data)
+        return json.loads(data)